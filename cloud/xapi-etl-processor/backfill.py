@@ -0,0 +1,289 @@
+"""Re-ingest historical xAPI objects from S3 without going through SQS.
+
+Object keys come from an S3 prefix listing, an S3 Inventory CSV (plain or
+gzipped; the first two columns are bucket and URL-encoded key) or a manifest
+with one ``s3://bucket/key`` per line. Keys are split into tasks of
+``--objects-per-task`` and spread over ``--processes`` worker processes. Each
+task loads its objects with ``lambda_function.load_json_lines_as_table`` and
+inserts them through ``flush_current_batch``, so row targets, insert formats,
+HTTP compression and the source-derived deduplication tokens are the same as
+in Lambda. Every pipeline knob is read from the environment as usual.
+
+Objects in committed sub-batches are appended to ``--state-file`` as each task
+finishes. A rerun with the same state file skips them, so an interrupted
+backfill resumes where it stopped; failed objects are retried. Objects seen by
+a ``--dry-run`` are recorded but never skipped.
+
+Usage::
+
+    python backfill.py --prefix s3://xapi-bucket/section/2024/ --suffix .jsonl \\
+        --processes 32 --state-file backfill-2024.state
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+from urllib.parse import unquote_plus
+
+import lambda_function
+from lambda_function import S3ObjectRef
+
+logger = logging.getLogger("backfill")
+
+
+@dataclass
+class TaskResult:
+    committed: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    rows: int = 0
+
+
+def object_uri(ref: S3ObjectRef) -> str:
+    return f"s3://{ref.bucket}/{ref.key}"
+
+
+def iter_prefix_refs(uri: str, suffix: Optional[str] = None) -> Iterator[S3ObjectRef]:
+    bucket, prefix = lambda_function._split_s3_uri(uri)  # pylint: disable=protected-access
+    # Keep the caller's trailing slash: s3://bucket/2024/ must not match 2024-old/.
+    if uri.endswith("/") and prefix:
+        prefix += "/"
+    paginator = lambda_function.s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for entry in page.get("Contents", []):
+            key = entry["Key"]
+            if key.endswith("/") or (suffix and not key.endswith(suffix)):
+                continue
+            yield S3ObjectRef(bucket=bucket, key=key, size=entry.get("Size"), etag=entry.get("ETag"))
+
+
+def iter_inventory_refs(path: str, suffix: Optional[str] = None) -> Iterator[S3ObjectRef]:
+    """Read bucket/key pairs from an S3 Inventory CSV report."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", newline="", encoding="utf-8") as handle:
+        for row in csv.reader(handle):
+            if len(row) < 2 or not row[1]:
+                continue
+            key = unquote_plus(row[1])
+            if key.endswith("/") or (suffix and not key.endswith(suffix)):
+                continue
+            yield S3ObjectRef(bucket=row[0], key=key)
+
+
+def iter_manifest_refs(path: str, suffix: Optional[str] = None) -> Iterator[S3ObjectRef]:
+    """Read one ``s3://bucket/key`` per line; blank lines and ``#`` comments are skipped."""
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            uri = line.strip()
+            if not uri or uri.startswith("#"):
+                continue
+            bucket, key = lambda_function._split_s3_uri(uri)  # pylint: disable=protected-access
+            if suffix and not key.endswith(suffix):
+                continue
+            yield S3ObjectRef(bucket=bucket, key=key)
+
+
+def load_checkpoint(path: str) -> Set[str]:
+    """Return the object URIs a previous run committed."""
+    committed: Set[str] = set()
+    if not os.path.exists(path):
+        return committed
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a partial last line.
+                continue
+            if entry.get("status") == "committed":
+                committed.add(entry["uri"])
+    return committed
+
+
+def ingest_objects(refs: List[S3ObjectRef], dry_run: bool) -> TaskResult:
+    """Load and insert one task's objects; runs inside a worker process."""
+    result = TaskResult()
+    batch = lambda_function.BatchAccumulator()
+
+    def flush(reason: str) -> None:
+        outcome = lambda_function.flush_current_batch(batch, None, dry_run_enabled=dry_run, flush_reason=reason)
+        result.committed.extend(outcome.inserted_message_ids())
+        for uri in outcome.retry_message_ids():
+            result.failed[uri] = f"sub-batch {outcome.status}"
+
+    for ref in refs:
+        uri = object_uri(ref)
+        try:
+            table = lambda_function.load_json_lines_as_table(ref)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Failed to load %s", uri)
+            result.failed[uri] = str(exc)
+            continue
+        if table is None or table.num_rows == 0:
+            result.committed.append(uri)
+            continue
+        result.rows += table.num_rows
+        batch.add(lambda_function.PreparedMessage(message_id=uri, table=table, object_count=1))
+        reason = lambda_function.determine_flush_reason(batch, force=False)
+        if reason:
+            flush(reason)
+    if not batch.is_empty():
+        flush("end_of_task")
+    return result
+
+
+def iter_tasks(refs: Iterable[S3ObjectRef], skip: Set[str], objects_per_task: int) -> Iterator[List[S3ObjectRef]]:
+    task: List[S3ObjectRef] = []
+    for ref in refs:
+        if object_uri(ref) in skip:
+            continue
+        task.append(ref)
+        if len(task) >= objects_per_task:
+            yield task
+            task = []
+    if task:
+        yield task
+
+
+class Checkpoint:
+    """Append-only JSONL record of finished objects, synced after every task.
+
+    Dry runs record their objects as ``dry_run``, which ``load_checkpoint``
+    ignores, so a real run with the same state file still inserts them.
+    """
+
+    def __init__(self, path: str, *, dry_run: bool = False) -> None:
+        self._handle = open(path, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+        self._committed_status = "dry_run" if dry_run else "committed"
+
+    def record(self, result: TaskResult) -> None:
+        for uri in result.committed:
+            self._handle.write(json.dumps({"uri": uri, "status": self._committed_status}) + "\n")
+        for uri, error in result.failed.items():
+            self._handle.write(json.dumps({"uri": uri, "status": "failed", "error": error}) + "\n")
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+    def close(self) -> None:
+        self._handle.close()
+
+
+def run_backfill(
+    refs: Iterable[S3ObjectRef],
+    *,
+    state_file: str,
+    processes: int,
+    objects_per_task: int,
+    dry_run: bool = False,
+) -> TaskResult:
+    """Ingest ``refs`` not yet committed in ``state_file``; returns the combined result."""
+    skip = load_checkpoint(state_file)
+    tasks = iter_tasks(refs, skip, max(1, objects_per_task))
+    totals = TaskResult()
+    started = time.perf_counter()
+    checkpoint = Checkpoint(state_file, dry_run=dry_run)
+    lambda_function.log_stage(
+        "backfill_start",
+        processes=processes,
+        skipped_objects=len(skip),
+        state_file=state_file,
+        dry_run=dry_run,
+    )
+
+    def finish(result: TaskResult) -> None:
+        checkpoint.record(result)
+        totals.committed.extend(result.committed)
+        totals.failed.update(result.failed)
+        totals.rows += result.rows
+        elapsed = time.perf_counter() - started
+        lambda_function.log_stage(
+            "backfill_progress",
+            committed_objects=len(totals.committed),
+            failed_objects=len(totals.failed),
+            row_count=totals.rows,
+            rows_per_second=round(totals.rows / elapsed, 1) if elapsed > 0 else None,
+        )
+
+    try:
+        if processes <= 1:
+            for task in tasks:
+                finish(ingest_objects(task, dry_run))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_configure_logging,
+            ) as executor:
+                # Keep a bounded number of tasks queued so a huge listing streams.
+                pending: Set[Future] = set()
+                for task in tasks:
+                    pending.add(executor.submit(ingest_objects, task, dry_run))
+                    if len(pending) >= processes * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            finish(future.result())
+                for future in pending:
+                    finish(future.result())
+    finally:
+        checkpoint.close()
+
+    lambda_function.log_stage(
+        "backfill_complete",
+        committed_objects=len(totals.committed),
+        failed_objects=len(totals.failed),
+        row_count=totals.rows,
+        duration_ms=lambda_function.elapsed_ms(started),
+    )
+    return totals
+
+
+def _configure_logging() -> None:
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format="%(asctime)s %(process)d %(levelname)s %(name)s %(message)s")
+    logger.setLevel(lambda_function.logger.level)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--prefix", help="s3://bucket/prefix to list")
+    source.add_argument("--inventory", help="S3 Inventory CSV (optionally .gz) with bucket,key columns")
+    source.add_argument("--manifest", help="file with one s3://bucket/key per line")
+    parser.add_argument("--suffix", help="only keys ending with this, e.g. .jsonl")
+    parser.add_argument("--state-file", required=True, help="checkpoint of finished objects; reuse it to resume")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--objects-per-task", type=int, default=50, help="objects per worker task")
+    parser.add_argument("--dry-run", action="store_true", help="parse and serialize without inserting")
+    args = parser.parse_args(argv)
+
+    _configure_logging()
+    refs: Iterable[S3ObjectRef]
+    if args.prefix:
+        refs = iter_prefix_refs(args.prefix, args.suffix)
+    elif args.inventory:
+        refs = iter_inventory_refs(args.inventory, args.suffix)
+    else:
+        refs = iter_manifest_refs(args.manifest, args.suffix)
+    result = run_backfill(
+        refs,
+        state_file=args.state_file,
+        processes=args.processes,
+        objects_per_task=args.objects_per_task,
+        dry_run=args.dry_run or lambda_function.env_flag("DRY_RUN", default=False),
+    )
+    for uri, error in sorted(result.failed.items()):
+        print(f"FAILED {uri}: {error}", file=sys.stderr)
+    return 1 if result.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
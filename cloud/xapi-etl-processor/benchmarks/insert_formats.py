@@ -0,0 +1,110 @@
+"""Compare ClickHouse insert wire formats on a synthetic ``raw_events`` batch.
+
+For every format in ``lambda_function.INSERT_FORMATS`` the script reports the
+median encode time and payload size. When ``CLICKHOUSE_URL`` (or the host/port
+variables) plus ``CLICKHOUSE_DATABASE``/``CLICKHOUSE_TABLE`` are set, each
+payload is also inserted and the server-side elapsed time from the
+``X-ClickHouse-Summary`` header is reported alongside the round-trip time and
+the bytes sent after any ``CLICKHOUSE_HTTP_COMPRESSION``.
+
+Usage::
+
+    python benchmarks/insert_formats.py --rows 20000 --repeat 5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import lambda_function  # noqa: E402  pylint: disable=wrong-import-position
+from xapi_synthetic import synthetic_statement  # noqa: E402  pylint: disable=wrong-import-position
+
+
+def build_synthetic_batch(row_count: int) -> "lambda_function.pa.Table":
+    builder = lambda_function.XapiColumnBuilder(bucket="benchmark", key="synthetic.jsonl", etag='"synthetic"')
+    for index in range(row_count):
+        statement = synthetic_statement(index)
+        builder.append(statement, raw_bytes=json.dumps(statement).encode("utf-8"), line_number=index + 1)
+    return builder.finish()
+
+
+def clickhouse_configured() -> bool:
+    has_endpoint = bool(os.getenv("CLICKHOUSE_URL") or os.getenv("CLICKHOUSE_HOST"))
+    has_target = bool(os.getenv("CLICKHOUSE_INSERT_SQL")) or bool(
+        os.getenv("CLICKHOUSE_DATABASE") and os.getenv("CLICKHOUSE_TABLE")
+    )
+    return has_endpoint and has_target
+
+
+def benchmark_format(
+    table: "lambda_function.pa.Table", insert_format: "lambda_function.InsertFormat", repeat: int, insert: bool
+) -> Dict[str, Any]:
+    encode_ms: List[float] = []
+    payload = b""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        payload = insert_format.encode(table)
+        encode_ms.append((time.perf_counter() - started) * 1000)
+
+    result: Dict[str, Any] = {
+        "format": insert_format.name,
+        "rows": table.num_rows,
+        "encode_ms_median": round(statistics.median(encode_ms), 3),
+        "payload_bytes": len(payload),
+    }
+    if insert:
+        os.environ["CLICKHOUSE_INSERT_FORMAT"] = insert_format.name
+        round_trip_ms: List[float] = []
+        server_ms: List[float] = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            insert_result = lambda_function.insert_into_clickhouse(payload, table.num_rows)
+            round_trip_ms.append((time.perf_counter() - started) * 1000)
+            if "elapsed_ns" in insert_result.summary:
+                server_ms.append(insert_result.summary["elapsed_ns"] / 1_000_000)
+        result["http_compression"] = insert_result.content_encoding
+        result["wire_bytes"] = insert_result.wire_bytes
+        result["insert_round_trip_ms_median"] = round(statistics.median(round_trip_ms), 3)
+        if server_ms:
+            result["server_elapsed_ms_median"] = round(statistics.median(server_ms), 3)
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000, help="rows in the synthetic batch")
+    parser.add_argument("--repeat", type=int, default=5, help="iterations per format")
+    parser.add_argument(
+        "--formats",
+        default=",".join(fmt.name for fmt in lambda_function.INSERT_FORMATS.values()),
+        help="comma separated formats to compare",
+    )
+    parser.add_argument("--no-insert", action="store_true", help="skip ClickHouse inserts even if configured")
+    args = parser.parse_args(argv)
+
+    table = build_synthetic_batch(args.rows)
+    insert = clickhouse_configured() and not args.no_insert
+    original_format = os.environ.get("CLICKHOUSE_INSERT_FORMAT")
+    try:
+        for name in args.formats.split(","):
+            os.environ["CLICKHOUSE_INSERT_FORMAT"] = name.strip()
+            insert_format = lambda_function.resolve_insert_format()
+            print(json.dumps(benchmark_format(table, insert_format, max(1, args.repeat), insert)))
+    finally:
+        if original_format is None:
+            os.environ.pop("CLICKHOUSE_INSERT_FORMAT", None)
+        else:
+            os.environ["CLICKHOUSE_INSERT_FORMAT"] = original_format
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,324 @@
+"""End-to-end throughput benchmark for ``lambda_handler`` without AWS or ClickHouse.
+
+Synthetic xAPI JSONL objects (see ``xapi_synthetic.py``) are written to an
+in-process S3 stand-in that serves ``get_object`` with ``Range``/``IfMatch``
+like the real API, and inserts go over HTTP to a local server that answers
+like ClickHouse (``X-ClickHouse-Summary`` included). Each run invokes the
+handler on one SQS batch and reads the structured ``ETL stage`` logs to report
+rows/s and milliseconds per stage:
+
+* fetch / parse / normalize - summed over objects from ``object_parsed``
+  (objects are fetched concurrently, so these can exceed wall time)
+* concat / serialize / insert - summed over sub-batches
+
+Every other knob is read from the environment as in Lambda, so runs can be
+compared across settings, e.g. ``CLICKHOUSE_INSERT_FORMAT=ArrowStream``.
+Results are printed and, with ``--output``, written as JSON together with the
+git revision and library versions so releases can be compared.
+
+Usage::
+
+    python benchmarks/pipeline.py --messages 20 --rows-per-object 5000 --repeat 3 \\
+        --output results/pipeline-$(git rev-parse --short HEAD).json
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from unittest import mock
+
+from botocore.response import StreamingBody
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import lambda_function  # noqa: E402  pylint: disable=wrong-import-position
+from xapi_synthetic import synthetic_jsonl_lines  # noqa: E402  pylint: disable=wrong-import-position
+
+BUCKET = "benchmark-bucket"
+STAGE_FIELDS = {
+    "fetch": ("object_parsed", "fetch_ms"),
+    "parse": ("object_parsed", "parse_ms"),
+    "normalize": ("object_parsed", "normalize_ms"),
+    "concat": ("sub_batch_concatenated", "duration_ms"),
+    "serialize": ("sub_batch_serialized", "duration_ms"),
+    "insert": ("sub_batch_committed", "duration_ms"),
+}
+
+
+class LocalS3:
+    """In-memory ``get_object`` with the response fields the loader reads."""
+
+    def __init__(self, latency_ms: float = 0.0) -> None:
+        self.objects: Dict[str, Dict[str, Any]] = {}
+        self.latency_seconds = latency_ms / 1000
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, key: str, data: bytes, content_encoding: Optional[str] = None) -> Dict[str, Any]:
+        etag = f'"{hashlib.md5(data).hexdigest()}"'  # noqa: S324 - mirrors S3's single-part ETag
+        self.objects[key] = {"data": data, "etag": etag, "content_encoding": content_encoding}
+        return {"key": key, "size": len(data), "eTag": etag.strip('"')}
+
+    def get_object(self, Bucket: str, Key: str, Range: Optional[str] = None, IfMatch: Optional[str] = None,
+                   **_: Any) -> Dict[str, Any]:  # noqa: N803 - boto3 argument names
+        with self._lock:
+            self.request_count += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        stored = self.objects[Key]
+        if IfMatch is not None and IfMatch != stored["etag"]:
+            raise RuntimeError(f"PreconditionFailed for s3://{Bucket}/{Key}")
+        data = stored["data"]
+        response: Dict[str, Any] = {"ETag": stored["etag"]}
+        if stored["content_encoding"]:
+            response["ContentEncoding"] = stored["content_encoding"]
+        if Range:
+            start, end = (int(value) for value in Range.split("=", 1)[1].split("-"))
+            data = data[start : end + 1]
+            response["ContentRange"] = f"bytes {start}-{start + len(data) - 1}/{len(stored['data'])}"
+        response["ContentLength"] = len(data)
+        response["Body"] = StreamingBody(BytesIO(data), len(data))
+        return response
+
+
+class FakeClickHouse:
+    """HTTP endpoint that accepts insert bodies and replies like ClickHouse."""
+
+    def __init__(self, latency_ms: float = 0.0) -> None:
+        self.insert_count = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        latency_seconds = latency_ms / 1000
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self) -> None:  # noqa: N802 - http.server naming
+                started = time.perf_counter()
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    size = 0
+                    while True:
+                        chunk_size = int(self.rfile.readline().split(b";", 1)[0].strip(), 16)
+                        if chunk_size == 0:
+                            self.rfile.readline()
+                            break
+                        size += len(self.rfile.read(chunk_size))
+                        self.rfile.readline()
+                else:
+                    size = len(self.rfile.read(int(self.headers.get("Content-Length", "0"))))
+                if latency_seconds:
+                    time.sleep(latency_seconds)
+                with server._lock:  # pylint: disable=protected-access
+                    server.insert_count += 1
+                    server.bytes_received += size
+                summary = {"written_bytes": str(size), "elapsed_ns": str(int((time.perf_counter() - started) * 1e9))}
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.send_header("X-ClickHouse-Summary", json.dumps(summary))
+                self.end_headers()
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeClickHouse":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class StageCollector(logging.Handler):
+    """Collect the JSON payloads of ``log_stage`` records."""
+
+    def __init__(self) -> None:
+        super().__init__(level=logging.INFO)
+        self.stages: List[Dict[str, Any]] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.msg == "ETL stage %s":
+            self.stages.append(json.loads(record.args[0]))
+
+
+class FakeContext:
+    def __init__(self, timeout_ms: int) -> None:
+        self._deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self._deadline - time.monotonic()) * 1000)
+
+
+def populate_objects(s3: LocalS3, messages: int, objects_per_message: int, rows_per_object: int,
+                     compression: str) -> List[Dict[str, Any]]:
+    """Write the synthetic objects and return one SQS record per message."""
+    records = []
+    row_index = 0
+    for message in range(messages):
+        s3_records = []
+        for part in range(objects_per_message):
+            data = b"\n".join(synthetic_jsonl_lines(row_index, rows_per_object)) + b"\n"
+            row_index += rows_per_object
+            key = f"benchmark/{message:05d}-{part:03d}.jsonl"
+            if compression == "gzip":
+                data, key = gzip.compress(data, compresslevel=6), key + ".gz"
+            elif compression == "zstd":
+                data, key = lambda_function.pa.compress(data, "zstd", asbytes=True), key + ".zst"
+            s3_records.append({"s3": {"bucket": {"name": BUCKET}, "object": s3.put_object(key, data)}})
+        records.append({"messageId": f"bench-{message:05d}", "body": json.dumps({"Records": s3_records})})
+    return records
+
+
+def summarize_run(stages: List[Dict[str, Any]], wall_seconds: float) -> Dict[str, Any]:
+    rows = sum(stage.get("row_count", 0) for stage in stages if stage["stage"] == "object_parsed")
+    committed_rows = sum(
+        stage.get("row_count", 0) for stage in stages if stage["stage"] == "sub_batch_committed"
+    )
+    stage_ms = {
+        name: round(sum(stage.get(field) or 0 for stage in stages if stage["stage"] == stage_name), 3)
+        for name, (stage_name, field) in STAGE_FIELDS.items()
+    }
+    return {
+        "wall_ms": round(wall_seconds * 1000, 3),
+        "rows": rows,
+        "committed_rows": committed_rows,
+        "rows_per_second": round(rows / wall_seconds, 1) if wall_seconds else None,
+        "sub_batches": sum(1 for stage in stages if stage["stage"] == "sub_batch_committed"),
+        "stage_ms": stage_ms,
+    }
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    s3 = LocalS3(latency_ms=args.s3_latency_ms)
+    records = populate_objects(s3, args.messages, args.objects_per_message, args.rows_per_object, args.compression)
+    object_bytes = sum(len(stored["data"]) for stored in s3.objects.values())
+    collector = StageCollector()
+    runs = []
+    with FakeClickHouse(latency_ms=args.clickhouse_latency_ms) as clickhouse:
+        env = {
+            "CLICKHOUSE_URL": clickhouse.url,
+            "CLICKHOUSE_DATABASE": "benchmark",
+            "CLICKHOUSE_TABLE": "raw_events",
+        }
+        previous_level = lambda_function.logger.level
+        lambda_function.logger.addHandler(collector)
+        lambda_function.logger.setLevel(logging.INFO)
+        lambda_function.logger.propagate = False
+        try:
+            with mock.patch.object(lambda_function, "s3_client", s3), mock.patch.dict(os.environ, env):
+                for _ in range(max(1, args.repeat)):
+                    collector.stages.clear()
+                    started = time.perf_counter()
+                    response = lambda_function.lambda_handler({"Records": records}, FakeContext(args.timeout_ms))
+                    run = summarize_run(collector.stages, time.perf_counter() - started)
+                    run["failed_messages"] = len(response.get("batchItemFailures", []))
+                    runs.append(run)
+        finally:
+            lambda_function.logger.removeHandler(collector)
+            lambda_function.logger.setLevel(previous_level)
+            lambda_function.logger.propagate = True
+        clickhouse_bytes = clickhouse.bytes_received
+
+    return {
+        "benchmark": "pipeline",
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "pyarrow": lambda_function.pa.__version__,
+        "parameters": {
+            "messages": args.messages,
+            "objects_per_message": args.objects_per_message,
+            "rows_per_object": args.rows_per_object,
+            "compression": args.compression,
+            "s3_latency_ms": args.s3_latency_ms,
+            "clickhouse_latency_ms": args.clickhouse_latency_ms,
+            "repeat": len(runs),
+            "object_bytes": object_bytes,
+            "environment": {key: value for key, value in sorted(os.environ.items()) if key in documented_env_vars()},
+        },
+        "s3_requests": s3.request_count,
+        "clickhouse_bytes_received": clickhouse_bytes,
+        "median": {
+            "rows_per_second": statistics.median(run["rows_per_second"] or 0 for run in runs),
+            "wall_ms": statistics.median(run["wall_ms"] for run in runs),
+            "stage_ms": {
+                name: statistics.median(run["stage_ms"][name] for run in runs) for name in STAGE_FIELDS
+            },
+        },
+        "runs": runs,
+    }
+
+
+def documented_env_vars() -> List[str]:
+    """Environment knobs listed in the lambda_function module docstring."""
+    names = []
+    for line in (lambda_function.__doc__ or "").splitlines():
+        token = line.split(" ", 1)[0]
+        if token and token.isupper() and token.replace("_", "").isalnum():
+            names.append(token)
+    return names
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10, help="SQS messages in the batch")
+    parser.add_argument("--objects-per-message", type=int, default=1, help="S3 objects per message")
+    parser.add_argument("--rows-per-object", type=int, default=5000, help="statements per S3 object")
+    parser.add_argument("--compression", choices=("none", "gzip", "zstd"), default="none",
+                        help="compress the synthetic objects")
+    parser.add_argument("--repeat", type=int, default=3, help="handler invocations to time")
+    parser.add_argument("--s3-latency-ms", type=float, default=0.0, help="added delay per S3 request")
+    parser.add_argument("--clickhouse-latency-ms", type=float, default=0.0, help="added delay per insert")
+    parser.add_argument("--timeout-ms", type=int, default=900_000, help="simulated Lambda timeout")
+    parser.add_argument("--output", help="write the JSON result to this path")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args)
+    rendered = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        output = Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(rendered + "\n", encoding="utf-8")
+    print(rendered)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
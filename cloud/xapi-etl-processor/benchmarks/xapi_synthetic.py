@@ -0,0 +1,165 @@
+"""Synthetic xAPI statements shaped like the OLI Torus event stream.
+
+``synthetic_statement`` cycles through every branch of
+``lambda_function._determine_event_type`` (each video verb, activity, page and
+part attempts, page views and an unmapped verb) and fills in the context,
+result and object extensions the ETL actually reads, so parse and normalize
+costs resemble production objects rather than a minimal document.
+"""
+from __future__ import annotations
+
+import json
+import random
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+_OLI_EXT = "http://oli.cmu.edu/extensions/"
+_VIDEO_EXT = "https://w3id.org/xapi/video/extensions/"
+_HOME_PAGE = "https://proton.oli.cmu.edu"
+
+VIDEO_VERBS = [
+    "https://w3id.org/xapi/video/verbs/played",
+    "https://w3id.org/xapi/video/verbs/paused",
+    "https://w3id.org/xapi/video/verbs/seeked",
+    "https://w3id.org/xapi/video/verbs/completed",
+    "http://adlnet.gov/expapi/verbs/experienced",
+]
+
+
+def _base(index: int, rng: random.Random, verb_id: str, object_id: str, object_type: str) -> Dict[str, Any]:
+    section_id = 2000 + index % 40
+    return {
+        "id": f"{index:08x}-{rng.getrandbits(32):08x}-4000-8000-{rng.getrandbits(48):012x}",
+        "actor": {
+            "objectType": "Agent",
+            "account": {"name": 10000 + rng.randrange(5000), "homePage": _HOME_PAGE},
+        },
+        "verb": {"id": verb_id, "display": {"en-US": verb_id.rsplit("/", 1)[-1]}},
+        "object": {
+            "objectType": "Activity",
+            "id": object_id,
+            "definition": {"type": object_type, "name": {"en-US": f"Resource {index % 311}"}},
+        },
+        "context": {
+            "platform": "OLI Torus",
+            "registration": f"reg-{section_id}-{index % 5000}",
+            "extensions": {
+                f"{_OLI_EXT}section_id": section_id,
+                f"{_OLI_EXT}project_id": 40 + index % 7,
+                f"{_OLI_EXT}publication_id": 900 + index % 11,
+                f"{_OLI_EXT}page_id": 7000 + index % 311,
+                f"{_OLI_EXT}session_id": f"session-{index // 50:06d}",
+            },
+        },
+        "timestamp": f"2025-05-{1 + index % 28:02d}T{index // 3600 % 24:02d}:{index // 60 % 60:02d}:"
+        f"{index % 60:02d}.{index % 1000:03d}Z",
+    }
+
+
+def _video(index: int, rng: random.Random) -> Dict[str, Any]:
+    verb_id = VIDEO_VERBS[index % len(VIDEO_VERBS)]
+    length = 600.0 + index % 1800
+    position = round(rng.uniform(0, length), 3)
+    statement = _base(index, rng, verb_id, f"https://cdn.example.edu/videos/{index % 53}.mp4",
+                      "https://w3id.org/xapi/video/activity-type/video")
+    statement["context"]["extensions"][f"{_OLI_EXT}content_element_id"] = f"video-{index % 53}"
+    result_ext: Dict[str, Any] = {
+        f"{_VIDEO_EXT}time": position,
+        f"{_VIDEO_EXT}length": length,
+        f"{_VIDEO_EXT}progress": round(position / length, 4),
+        f"{_VIDEO_EXT}played-segments": f"0[.]{position}",
+    }
+    if verb_id.endswith("/seeked"):
+        result_ext[f"{_VIDEO_EXT}time-from"] = round(max(0.0, position - 30), 3)
+        result_ext[f"{_VIDEO_EXT}time-to"] = position
+    statement["result"] = {"extensions": result_ext}
+    if verb_id.endswith("/completed"):
+        statement["result"]["completion"] = True
+    return statement
+
+
+def _activity_attempt(index: int, rng: random.Random) -> Dict[str, Any]:
+    statement = _base(index, rng, "http://adlnet.gov/expapi/verbs/completed",
+                      f"{_HOME_PAGE}/activity_attempt/{index}", f"{_OLI_EXT}activity_attempt")
+    statement["context"]["extensions"].update(
+        {
+            f"{_OLI_EXT}activity_attempt_guid": f"activity-{index}",
+            f"{_OLI_EXT}activity_attempt_number": 1 + index % 3,
+            f"{_OLI_EXT}page_attempt_guid": f"page-{index // 10}",
+            f"{_OLI_EXT}page_attempt_number": 1,
+            f"{_OLI_EXT}activity_id": 30000 + index % 997,
+            f"{_OLI_EXT}activity_revision_id": 80000 + index % 997,
+        }
+    )
+    raw = rng.randrange(0, 5)
+    statement["result"] = {"score": {"raw": raw, "max": 4, "scaled": raw / 4}, "completion": True}
+    return statement
+
+
+def _page_attempt(index: int, rng: random.Random) -> Dict[str, Any]:
+    statement = _base(index, rng, "http://adlnet.gov/expapi/verbs/completed",
+                      f"{_HOME_PAGE}/page_attempt/{index}", f"{_OLI_EXT}page_attempt")
+    statement["object"]["definition"]["subType"] = "graded" if index % 2 else "practice"
+    statement["context"]["extensions"].update(
+        {f"{_OLI_EXT}page_attempt_guid": f"page-{index // 10}", f"{_OLI_EXT}page_attempt_number": 1 + index % 2}
+    )
+    raw = rng.randrange(0, 21)
+    statement["result"] = {"score": {"raw": raw, "max": 20, "scaled": raw / 20}, "completion": True}
+    return statement
+
+
+def _page_viewed(index: int, rng: random.Random) -> Dict[str, Any]:
+    statement = _base(index, rng, "http://id.tincanapi.com/verb/viewed",
+                      f"{_HOME_PAGE}/page/{7000 + index % 311}", f"{_OLI_EXT}types/page")
+    statement["object"]["definition"]["subType"] = "basic"
+    statement["context"]["extensions"][f"{_OLI_EXT}page_attempt_guid"] = f"page-{index // 10}"
+    return statement
+
+
+def _part_attempt(index: int, rng: random.Random) -> Dict[str, Any]:
+    statement = _base(index, rng, "http://adlnet.gov/expapi/verbs/completed",
+                      f"{_HOME_PAGE}/part_attempt/{index}", "http://adlnet.gov/expapi/activities/question")
+    statement["context"]["extensions"].update(
+        {
+            f"{_OLI_EXT}part_attempt_guid": f"part-{index}",
+            f"{_OLI_EXT}part_attempt_number": 1 + index % 4,
+            f"{_OLI_EXT}activity_attempt_guid": f"activity-{index // 3}",
+            f"{_OLI_EXT}activity_id": 30000 + index % 997,
+            f"{_OLI_EXT}part_id": f"part{1 + index % 3}",
+            f"{_OLI_EXT}hints_requested": [f"hint-{n}" for n in range(index % 3)],
+            f"{_OLI_EXT}attached_objectives": [5000 + index % 17, 5100 + index % 13],
+        }
+    )
+    correct = rng.random() < 0.6
+    statement["result"] = {
+        "score": {"raw": 1 if correct else 0, "max": 1},
+        "success": correct,
+        "response": {"input": f"choice-{rng.randrange(4)}", "files": []},
+        "extensions": {
+            f"{_OLI_EXT}feedback": {
+                "content": [{"type": "p", "children": [{"text": "Correct!" if correct else "Try again."}]}]
+            },
+        },
+    }
+    return statement
+
+
+def _unknown(index: int, rng: random.Random) -> Dict[str, Any]:
+    return _base(index, rng, "http://adlnet.gov/expapi/verbs/interacted",
+                 f"{_HOME_PAGE}/widget/{index % 29}", "http://adlnet.gov/expapi/activities/interaction")
+
+
+# Weights roughly follow production: part attempts and video events dominate.
+STATEMENT_KINDS: List[Callable[[int, random.Random], Dict[str, Any]]] = (
+    [_part_attempt] * 4 + [_video] * 5 + [_activity_attempt] * 2 + [_page_viewed] * 2 + [_page_attempt, _unknown]
+)
+
+
+def synthetic_statement(index: int, rng: Optional[random.Random] = None) -> Dict[str, Any]:
+    kind = STATEMENT_KINDS[index % len(STATEMENT_KINDS)]
+    return kind(index, rng or random.Random(index))
+
+
+def synthetic_jsonl_lines(start: int, count: int, seed: int = 0) -> Iterator[bytes]:
+    rng = random.Random(seed + start)
+    for index in range(start, start + count):
+        yield json.dumps(synthetic_statement(index, rng), separators=(",", ":")).encode("utf-8")
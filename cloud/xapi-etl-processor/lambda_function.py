@@ -3,8 +3,9 @@
 The handler expects to be invoked by an SQS event where each message body is an
 S3 ObjectCreated notification in JSON format. For every SQS message the Lambda
 reads the referenced JSON Lines object from S3, converts the payload into an
-Arrow table, batches the successful records into a single Parquet payload, and
-streams that payload into ClickHouse using the HTTP interface.
+Arrow table, batches the successful records into a single insert payload
+(Parquet by default, or Arrow IPC), and streams that payload into ClickHouse
+using the HTTP interface.
 
 Environment variables
 ---------------------
@@ -20,13 +21,54 @@ CLICKHOUSE_INSERT_COLUMNS  Comma separated column projection for inserts (option
 CLICKHOUSE_USER            Basic auth user (optional)
 CLICKHOUSE_PASSWORD        Basic auth password (optional)
 CLICKHOUSE_SETTINGS        Comma separated ClickHouse setting overrides
+CLICKHOUSE_INSERT_DEDUPLICATION
+                           "true" (default) sends each sub-batch's source-derived
+                           insert token as insert_deduplication_token
+CLICKHOUSE_INSERT_FORMAT   Insert wire format: Parquet (default), ArrowStream or
+                           Arrow. CLICKHOUSE_INSERT_SQL must end with the same
+                           FORMAT clause
 PARQUET_COMPRESSION        Compression codec (defaults to snappy)
+CLICKHOUSE_STREAMING_INSERT
+                           "true" streams row groups (or Arrow record batches)
+                           to ClickHouse with chunked transfer encoding instead
+                           of buffering the whole payload (default false)
+STREAMING_ROW_GROUP_ROWS   Rows per row group / record batch in streaming mode
+                           (default 5000)
 CLICKHOUSE_TIMEOUT_SECONDS Request timeout for HTTP insert (default 30)
-MAX_S3_OBJECT_BYTES        Soft cap per S3 object (bytes); raises if exceeded
+CLICKHOUSE_POOL_SIZE       Keep-alive connections pooled per ClickHouse host (default 4)
+CLICKHOUSE_CONNECT_RETRIES Connection-establishment retries for inserts (default 2)
+CLICKHOUSE_TCP_KEEPALIVE   Enable TCP keepalive probes on pooled connections (default true)
+CLICKHOUSE_HTTP_COMPRESSION
+                           Content-Encoding for insert bodies: none (default),
+                           gzip, zstd, lz4 or auto (picks per sub-batch from
+                           sampled compress time versus measured upload speed)
+MAX_S3_OBJECT_BYTES        Objects above this size (bytes) skip whole-object
+                           parsing and always stream through the per-line path
+JSONL_BATCH_ROWS           Rows per Arrow batch while parsing an object; Python
+                           row values are released after each batch (default 10000)
+EVENT_HASH_MODE            Per-row event_hash algorithm: sha256 (default, matches
+                           existing tables), blake2b128 or xxh3_128 (needs xxhash)
+EVENT_HASH_OUTPUT          "hex" (default) string or "binary" fixed-size digest
+                           (FixedString(N) in ClickHouse)
+JSONL_INGESTION_MODE       "python" (default) parses line by line; "arrow" parses
+                           8 MiB blocks with pyarrow.json and falls back to the
+                           per-line path from the first block the reader rejects
 TARGET_ROWS_PER_INSERT     Preferred row target before flushing (default 10000)
 MAX_ROWS_PER_INSERT        Hard row ceiling for a sub-batch (default 30000)
 MAX_PARQUET_BYTES_PER_INSERT
-                           Soft payload-size ceiling in bytes (default 16777216)
+                           Soft ceiling on the serialized payload in bytes,
+                           checked against a compression-aware estimate
+                           (default 16777216)
+PAYLOAD_ESTIMATOR_CALIBRATION_ROWS
+                           Rows serialized once per container to seed the
+                           payload-size estimator (default 2000, 0 disables)
+ADAPTIVE_BATCH_SIZING      "true" replaces TARGET_ROWS_PER_INSERT with a row
+                           target tuned from observed flush latency (default false)
+ADAPTIVE_TARGET_FLUSH_MS   Flush latency (concat + serialize + insert) the
+                           adaptive controller aims for (default 2000)
+ADAPTIVE_MIN_ROWS_PER_INSERT
+                           Lower bound for the adaptive row target (default 1000);
+                           MAX_ROWS_PER_INSERT is the upper bound
 MIN_REMAINING_TIME_TO_START_INSERT_MS
                            Minimum remaining Lambda time needed before insert
                            work may start (default 15000)
@@ -36,7 +78,61 @@ LAMBDA_TIMEOUT_SAFETY_MARGIN_MS
 MAX_MESSAGES_PER_INVOCATION_TO_PROCESS
                            Optional cap on how many SQS messages one invocation
                            should prepare before leaving the rest for retry
+S3_FETCH_CONCURRENCY       Number of SQS messages whose S3 objects are fetched
+                           and parsed concurrently (default 4, 1 disables)
+S3_MAX_POOL_CONNECTIONS    Minimum pooled connections for the S3 client
+                           (default 10); raised to S3_FETCH_CONCURRENCY x
+                           (S3_RANGE_CONCURRENCY + 1) when that is larger
+S3_RANGED_GET_THRESHOLD_BYTES
+                           Objects larger than this are downloaded with parallel
+                           HTTP Range requests (default 67108864, 0 disables)
+S3_RANGE_PART_BYTES        Bytes per Range request (default 8388608)
+S3_RANGE_CONCURRENCY       Range requests in flight per object (default 4)
+S3_OBJECT_COMPRESSION      Compression of the JSONL objects: auto (default)
+                           detects gzip/zstd from ContentEncoding, the key
+                           suffix or magic bytes; none, gzip or zstd force it
+MAX_INFLIGHT_INSERTS       Sub-batch flushes allowed to run in the background
+                           while later messages are prepared (default 0 runs
+                           every flush inline)
+BISECT_FAILED_SUB_BATCHES  "true" splits a sub-batch that ClickHouse rejects
+                           into halves and retries them while time remains, so
+                           only the offending messages are retried (default false)
 FAILURE_DLQ_URL            Optional SQS queue URL for permanently failed messages
+                           (the SQS client is created on the first send)
+TABLE_CACHE_MAX_BYTES      Memory budget for reusing prepared tables of
+                           unchanged S3 objects (bucket/key/etag) when SQS
+                           redelivers a message to a warm container (default 0
+                           disables the cache)
+TABLE_CACHE_DIR            Optional directory (e.g. /tmp/table-cache) where
+                           tables evicted from memory are kept as Arrow IPC files
+TABLE_CACHE_DIR_MAX_BYTES  Disk budget for TABLE_CACHE_DIR (default 536870912)
+QUARANTINE_SINK            Optional s3://bucket/prefix or local directory; when
+                           set, lines that fail to parse or transform are written
+                           there as JSONL and the object's good rows are inserted
+QUARANTINE_MAX_ERROR_RATE  Fraction of an object's lines that may be quarantined
+                           before the whole object fails as before (default 0.05;
+                           rounded down, so 0 quarantines nothing)
+PREWARM_ARROW              "true" runs one statement through parse, normalize
+                           and serialize at import so the first invocation does
+                           not pay Arrow's first-use costs (default false)
+PROFILE_SAMPLE_RATE        Fraction of invocations (0-1) run under the sampling
+                           profiler and tracemalloc (default 0); an event with
+                           "profile": true is always profiled
+PROFILE_INTERVAL_MS        Stack sampling interval while profiling (default 10)
+PROFILE_TOP_N              Functions / allocation sites kept in the profile
+                           summary (default 15)
+PROFILE_TRACEMALLOC_FRAMES Frames recorded per allocation (default 1, 0 turns
+                           tracemalloc off)
+PROFILE_S3_URI             Optional s3://bucket/prefix for full profile JSON;
+                           the summary is always logged as invocation_profile
+EMF_METRICS                "true" prints one CloudWatch Embedded Metric Format
+                           record set per invocation with rows, bytes, stage
+                           durations, flush reasons and failures (default false)
+EMF_NAMESPACE              CloudWatch namespace for EMF metrics (default
+                           XapiEtlProcessor)
+EMF_DIMENSIONS             Comma separated EMF dimensions from FunctionName,
+                           InsertFormat and EventType (default FunctionName);
+                           EventType adds per-event-type committed row counts
 
 The handler returns the partial batch response structure required for SQS event
 source mappings with the "ReportBatchItemFailures" feature.
@@ -46,38 +142,75 @@ from __future__ import annotations
 import hashlib
 import importlib
 import io
+import itertools
 import json
 import logging
 import math
 import os
 import platform
+import random
+import re
+import socket
+import threading
 import time
 import sys
+import tracemalloc
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 from urllib.parse import unquote_plus, urlparse
 
-import boto3
-from botocore.config import Config
-import requests
-from requests.auth import HTTPBasicAuth
+# Each module-init step is timed and reported in RUNTIME_METADATA["init_timings_ms"].
+_MODULE_INIT_STARTED = time.perf_counter()
+_INIT_TIMINGS_MS: Dict[str, float] = {}
+_init_step_started = _MODULE_INIT_STARTED
+
+
+def _record_init_step(name: str) -> None:
+    global _init_step_started  # noqa: PLW0603 -- only called during module init
+    now = time.perf_counter()
+    _INIT_TIMINGS_MS[name] = round((now - _init_step_started) * 1000, 3)
+    _init_step_started = now
+
+
+# pylint: disable=wrong-import-position
+import boto3  # noqa: E402
+from botocore.config import Config  # noqa: E402
+import requests  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
+from requests.auth import HTTPBasicAuth  # noqa: E402
+from urllib3.connection import HTTPConnection  # noqa: E402
+from urllib3.util.retry import Retry  # noqa: E402
+# pylint: enable=wrong-import-position
+
+_record_init_step("import_boto3_requests")
 
 try:  # Preload PyArrow but keep diagnostics if it fails
     import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.json as pa_json
     import pyarrow.parquet as pq
     PYARROW_IMPORT_ERROR: Optional[Exception] = None
 except Exception as exc:  # pylint: disable=broad-except
     pa = None  # type: ignore[assignment]
+    pc = None  # type: ignore[assignment]
+    pa_json = None  # type: ignore[assignment]
     pq = None  # type: ignore[assignment]
     PYARROW_IMPORT_ERROR = exc
 
-try:
-    import numpy  # pylint: disable=import-outside-toplevel
-    NUMPY_IMPORT_ERROR: Optional[Exception] = None
-except Exception as exc:  # pylint: disable=broad-except
-    numpy = None  # type: ignore[assignment]
-    NUMPY_IMPORT_ERROR = exc
+_record_init_step("import_pyarrow")
+
+try:  # Unix only; used to report peak RSS per S3 object
+    import resource
+except ImportError:
+    resource = None  # type: ignore[assignment]
+
+try:  # Optional: only needed for EVENT_HASH_MODE=xxh3_128
+    import xxhash
+except ImportError:
+    xxhash = None  # type: ignore[assignment]
 
 logger = logging.getLogger(__name__)
 
@@ -97,34 +230,139 @@ def _build_runtime_metadata() -> Dict[str, Any]:
         metadata["pyarrow_version"] = getattr(pa, "__version__", "unknown")
     else:
         metadata["pyarrow_error"] = str(PYARROW_IMPORT_ERROR)
-    try:
-        import numpy  # pylint: disable=import-outside-toplevel
-
-        metadata["numpy_version"] = getattr(numpy, "__version__", "unknown")
-    except Exception as exc:  # pylint: disable=broad-except
-        metadata["numpy_version_error"] = str(exc)
+    # pyarrow loads numpy itself; report it without paying for a separate import.
+    numpy_module = sys.modules.get("numpy")
+    metadata["numpy_version"] = getattr(numpy_module, "__version__", "unknown") if numpy_module else "not_loaded"
+    metadata["init_timings_ms"] = _INIT_TIMINGS_MS
     return metadata
 
 
 RUNTIME_METADATA = _build_runtime_metadata()
-logger.info("Lambda cold start runtime metadata: %s", json.dumps(RUNTIME_METADATA))
+_record_init_step("runtime_metadata")
 
 _S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT_SECONDS", "5"))
 _S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT_SECONDS", "60"))
 _S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "3"))
 
+
+def resolve_s3_fetch_concurrency() -> int:
+    return max(1, int(os.getenv("S3_FETCH_CONCURRENCY", "4")))
+
+
+def resolve_s3_range_concurrency() -> int:
+    return max(1, int(os.getenv("S3_RANGE_CONCURRENCY", "4")))
+
+
+def resolve_s3_max_pool_connections() -> int:
+    """Pool size that covers every prefetch worker's ranged GETs plus its first GET."""
+    configured = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "10"))
+    return max(configured, resolve_s3_fetch_concurrency() * (resolve_s3_range_concurrency() + 1))
+
+
+_S3_MAX_POOL_CONNECTIONS = resolve_s3_max_pool_connections()
+
 s3_client = boto3.client(
     "s3",
     config=Config(
         connect_timeout=_S3_CONNECT_TIMEOUT,
         read_timeout=_S3_READ_TIMEOUT,
         retries={"max_attempts": _S3_MAX_ATTEMPTS},
+        max_pool_connections=_S3_MAX_POOL_CONNECTIONS,
     ),
 )
+_record_init_step("s3_client")
 
 
 _FAILURE_DLQ_URL = os.getenv("FAILURE_DLQ_URL")
-_sqs_client = boto3.client("sqs") if _FAILURE_DLQ_URL else None
+# Created on the first DLQ send; most invocations never need it.
+_sqs_client: Optional[Any] = None
+_SQS_CLIENT_LOCK = threading.Lock()
+
+# Reused across warm invocations so inserts skip the TCP/TLS handshake.
+_CLICKHOUSE_SESSION: Optional[requests.Session] = None
+_CLICKHOUSE_SESSION_LOCK = threading.Lock()
+
+# HTTP body compression. Auto mode weighs codec cost on a payload sample
+# against an EWMA of observed upload throughput for this container.
+_HTTP_COMPRESSION_CODECS = ("gzip", "zstd", "lz4")
+_HTTP_COMPRESSION_CHUNK_BYTES = 1024 * 1024
+_AUTO_COMPRESSION_CANDIDATES = ("lz4", "zstd")
+_AUTO_COMPRESSION_SAMPLE_BYTES = 256 * 1024
+
+# Compressed JSONL objects, decoded as a stream while lines are parsed.
+_S3_READ_CHUNK_BYTES = 64 * 1024
+# Decompressed bytes handed to ``pyarrow.json`` at a time in arrow ingestion mode.
+_ARROW_JSON_BLOCK_BYTES = 8 * 1024 * 1024
+_OBJECT_COMPRESSION_CODECS = ("gzip", "zstd")
+_OBJECT_COMPRESSION_MAGIC = ((b"\x1f\x8b", "gzip"), (b"\x28\xb5\x2f\xfd", "zstd"))
+_OBJECT_COMPRESSION_SUFFIXES = ((".gz", "gzip"), (".gzip", "gzip"), (".zst", "zstd"), (".zstd", "zstd"))
+_OBJECT_CONTENT_ENCODINGS = {"gzip": "gzip", "x-gzip": "gzip", "zstd": "zstd"}
+_DEFAULT_UPLOAD_BYTES_PER_SECOND = 50 * 1024 * 1024
+_UPLOAD_THROUGHPUT_MIN_SAMPLE_BYTES = 64 * 1024
+_UPLOAD_THROUGHPUT_EWMA_ALPHA = 0.3
+_UPLOAD_BYTES_PER_SECOND: Optional[float] = None
+
+# Sub-batches rejected by ClickHouse are split and retried when
+# BISECT_FAILED_SUB_BATCHES is on, except for responses every half would share.
+BISECT_FLUSH_REASON = "bisect"
+_NON_BISECTABLE_STATUS_CODES = frozenset({401, 403, 404, 407, 408, 429, 502, 503, 504})
+
+# Adaptive sub-batch sizing state, kept for the lifetime of the container.
+_ADAPTIVE_BATCH_CONTROLLER: Optional["AdaptiveBatchController"] = None
+_ADAPTIVE_BATCH_CONTROLLER_LOCK = threading.Lock()
+
+# Learned serialized-size ratios per insert format, kept for the container lifetime.
+_PAYLOAD_SIZE_ESTIMATORS: Dict[str, "PayloadSizeEstimator"] = {}
+_PAYLOAD_SIZE_ESTIMATORS_LOCK = threading.Lock()
+
+# Prepared tables reused when SQS redelivers a message to this container.
+_TABLE_CACHE: Optional["TableCache"] = None
+_TABLE_CACHE_LOCK = threading.Lock()
+
+# EMF metrics aggregated from ``log_stage`` for the invocation in progress.
+# Deliberately module-global rather than thread-local: fetch and insert worker
+# threads record into it too. That assumes one invocation at a time per
+# process, which Lambda guarantees and sqs_worker enforces with --threads 1.
+_INVOCATION_METRICS: Optional["InvocationMetrics"] = None
+_EMF_DIMENSION_NAMES = ("FunctionName", "InsertFormat", "EventType")
+# stage -> ((log field, metric name, unit), ...); each value is summed per invocation.
+_EMF_STAGE_METRICS: Dict[str, Tuple[Tuple[str, str, str], ...]] = {
+    "invocation_start": (("message_count", "MessagesReceived", "Count"),),
+    "object_parsed": (
+        ("row_count", "RowsParsed", "Count"),
+        ("object_bytes", "ObjectBytes", "Bytes"),
+        ("fetch_ms", "FetchDuration", "Milliseconds"),
+        ("parse_ms", "ParseDuration", "Milliseconds"),
+        ("normalize_ms", "NormalizeDuration", "Milliseconds"),
+    ),
+    "object_decompressed": (("decompress_ms", "DecompressDuration", "Milliseconds"),),
+    "sub_batch_concatenated": (("duration_ms", "ConcatDuration", "Milliseconds"),),
+    "sub_batch_serialized": (
+        ("duration_ms", "SerializeDuration", "Milliseconds"),
+        ("payload_bytes", "PayloadBytes", "Bytes"),
+    ),
+    "sub_batch_committed": (
+        ("row_count", "RowsCommitted", "Count"),
+        ("duration_ms", "InsertDuration", "Milliseconds"),
+        ("wire_bytes", "WireBytes", "Bytes"),
+    ),
+    "sub_batch_failed": (("row_count", "RowsFailed", "Count"),),
+    "object_rows_quarantined": (("quarantined_rows", "RowsQuarantined", "Count"),),
+    "invocation_complete": (
+        ("committed_messages", "MessagesCommitted", "Count"),
+        ("failed_messages", "MessagesFailed", "Count"),
+        ("untouched_messages", "MessagesUntouched", "Count"),
+        ("table_cache_hits", "TableCacheHits", "Count"),
+        ("table_cache_misses", "TableCacheMisses", "Count"),
+    ),
+}
+# Stages counted once per occurrence.
+_EMF_STAGE_COUNTS = {
+    "sub_batch_committed": "SubBatchesCommitted",
+    "sub_batch_failed": "SubBatchesFailed",
+    "sub_batch_no_progress": "SubBatchesNoProgress",
+    "processing_stopped": "ProcessingStopped",
+}
 
 
 # Column order for the unified raw_events table as defined in
@@ -176,12 +414,25 @@ DEFAULT_CLICKHOUSE_INSERT_COLUMNS: List[str] = [
 ]
 
 _CLICKHOUSE_TYPE_MAP: Optional[Dict[str, "pa.DataType"]] = None
+_XAPI_ARROW_SCHEMAS: Dict[Tuple[Tuple[str, str], ...], "pa.Schema"] = {}
+# Fields whose JSON type differs between statement producers, keyed by the
+# column path ``pyarrow.json`` names in its errors. The first kind is read by
+# default; the others are tried when the reader reports a change to them.
+_XAPI_ARROW_VARIANT_KINDS: Dict[str, Tuple[str, ...]] = {
+    "/actor/account/name": ("number", "string"),
+    "/result/response": ("object", "string"),
+    "/result/extensions/http://oli.cmu.edu/extensions/feedback": ("object", "string"),
+}
+_ARROW_JSON_KIND_CHANGE_RE = re.compile(r"Column\((?P<path>.*)\) changed from \w+ to (?P<kind>\w+)")
 
 
 @dataclass(frozen=True)
 class S3ObjectRef:
     bucket: str
     key: str
+    # Optional hints from the S3 event record; not part of the object identity.
+    size: Optional[int] = field(default=None, compare=False)
+    etag: Optional[str] = field(default=None, compare=False)
 
 
 @dataclass
@@ -202,7 +453,7 @@ class BatchAccumulator:
         self.prepared_messages.append(prepared_message)
         self.total_rows += prepared_message.table.num_rows
         self.total_objects += prepared_message.object_count
-        self.estimated_bytes += estimate_table_size_bytes(prepared_message.table)
+        self.estimated_bytes += estimate_payload_bytes(prepared_message.table)
 
     def is_empty(self) -> bool:
         return not self.prepared_messages
@@ -219,6 +470,103 @@ class BatchAccumulator:
         self.total_objects = 0
         self.estimated_bytes = 0
 
+    def detach(self) -> "BatchAccumulator":
+        """Move the accumulated messages into a new accumulator and reset this one."""
+        detached = BatchAccumulator(
+            prepared_messages=list(self.prepared_messages),
+            total_rows=self.total_rows,
+            total_objects=self.total_objects,
+            estimated_bytes=self.estimated_bytes,
+        )
+        self.reset()
+        return detached
+
+
+@dataclass(frozen=True)
+class FetchedMessage:
+    s3_refs: List[S3ObjectRef]
+    table: Optional["pa.Table"]
+    fetch_elapsed_seconds: float
+
+
+class FetchCancelled(Exception):
+    """Raised inside a fetch worker once nobody is waiting for its result."""
+
+
+# Each prefetch worker thread points ``cancelled`` at its prefetcher's event so
+# the S3 read loops deep inside ``fetch_message_table`` can stop early.
+_FETCH_STATE = threading.local()
+
+
+def raise_if_fetch_cancelled() -> None:
+    cancelled = getattr(_FETCH_STATE, "cancelled", None)
+    if cancelled is not None and cancelled.is_set():
+        raise FetchCancelled()
+
+
+class MessagePrefetcher:
+    """Fetch and parse upcoming SQS messages on a bounded thread pool.
+
+    Work is scheduled lazily: when the handler asks for message ``index`` the
+    prefetcher makes sure that message and the next ``concurrency - 1``
+    messages are in flight. ``limit`` caps that window at the number of
+    messages the handler may still process, so read-ahead never fetches past
+    MAX_MESSAGES_PER_INVOCATION. ``close`` cancels queued read-ahead, makes
+    running fetches stop at their next S3 chunk and waits for them, so no
+    download outlives the invocation into the next thawed one. Results are
+    keyed by record index so every table maps back to the messageId that
+    referenced it regardless of completion order. With a concurrency of 1
+    messages are fetched inline.
+    """
+
+    def __init__(self, records: List[Dict[str, Any]], concurrency: int) -> None:
+        self._records = records
+        self._concurrency = max(1, concurrency)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if self._concurrency > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._concurrency,
+                thread_name_prefix="s3-fetch",
+            )
+        self._futures: Dict[int, Future] = {}
+        self._next_index = 0
+        self._cancelled = threading.Event()
+
+    def take(self, index: int, limit: Optional[int] = None) -> FetchedMessage:
+        if self._executor is None:
+            return fetch_message_table(self._records[index])
+        window = self._concurrency if limit is None else max(1, min(self._concurrency, limit))
+        self._schedule(index, window)
+        return self._futures.pop(index).result()
+
+    def close(self) -> None:
+        if self._executor is None:
+            return
+        # Prefetched work for messages that will not be processed is discarded.
+        # Running fetches abort at their next chunk; waiting for them keeps a
+        # frozen download from resuming inside the next invocation.
+        self._cancelled.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._futures.clear()
+
+    def _fetch(self, record: Dict[str, Any]) -> FetchedMessage:
+        _FETCH_STATE.cancelled = self._cancelled
+        try:
+            return fetch_message_table(record)
+        finally:
+            _FETCH_STATE.cancelled = None
+
+    def _schedule(self, index: int, window: int) -> None:
+        assert self._executor is not None
+        if index not in self._futures:
+            self._futures[index] = self._executor.submit(self._fetch, self._records[index])
+        window_end = min(len(self._records), index + window)
+        for ahead in range(max(self._next_index, index + 1), window_end):
+            if ahead in self._futures or is_s3_test_event(self._records[ahead]):
+                continue
+            self._futures[ahead] = self._executor.submit(self._fetch, self._records[ahead])
+        self._next_index = max(self._next_index, window_end)
+
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """Entry point for Lambda."""
@@ -227,8 +575,27 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         logger.info("Diagnostics request served")
         return {"statusCode": 200, "body": json.dumps(diagnostics)}
 
+    profiler = start_invocation_profile(event)
+    try:
+        return process_sqs_event(event, context)
+    finally:
+        if profiler is not None:
+            finish_invocation_profile(profiler, context)
+
+
+def process_sqs_event(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """Load, transform and insert the S3 objects referenced by an SQS batch."""
     ensure_pyarrow_available()
+    start_invocation_metrics(context)
+    try:
+        return _process_sqs_records(event, context)
+    finally:
+        # Emitted even when the batch raises: failed invocations are the ones
+        # the metrics matter most for, and it clears the container-wide record.
+        emit_invocation_metrics()
 
+
+def _process_sqs_records(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     records = event.get("Records", [])
     logger.info("Received %d SQS messages", len(records))
 
@@ -241,6 +608,13 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     dry_run_enabled = env_flag("DRY_RUN", default=False)
     current_batch = BatchAccumulator()
     processed_message_count = 0
+    prefetcher = MessagePrefetcher(records, resolve_s3_fetch_concurrency())
+    pipeline = InsertPipeline(
+        resolve_max_inflight_inserts(), context, dry_run_enabled=dry_run_enabled
+    )
+    insert_failed = False
+    table_cache = get_table_cache()
+    cache_stats_before = table_cache.stats() if table_cache is not None else None
 
     log_stage(
         "invocation_start",
@@ -249,134 +623,146 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         remaining_time_ms=get_remaining_time_ms(context),
     )
 
-    for index, record in enumerate(records):
-        message_id = record.get("messageId", "<unknown>")
-        if should_stop_processing_records(context, current_batch):
-            untouched_message_ids.extend(remaining_message_ids(records[index:]))
-            log_stage(
-                "processing_stopped",
-                outcome="remaining_time_low",
-                remaining_time_ms=get_remaining_time_ms(context),
-                current_batch_rows=current_batch.total_rows,
-                current_batch_messages=len(current_batch.prepared_messages),
-                untouched_messages=len(untouched_message_ids),
-            )
-            break
-
-        max_messages_per_invocation = resolve_max_messages_per_invocation_to_process()
-        if (
-            max_messages_per_invocation is not None
-            and processed_message_count >= max_messages_per_invocation
-        ):
-            untouched_message_ids.extend(remaining_message_ids(records[index:]))
-            log_stage(
-                "processing_stopped",
-                outcome="max_messages_per_invocation_reached",
-                max_messages_per_invocation=max_messages_per_invocation,
-                current_batch_rows=current_batch.total_rows,
-                current_batch_messages=len(current_batch.prepared_messages),
-                untouched_messages=len(untouched_message_ids),
-            )
-            break
-
-        logger.info("Processing message %s", message_id)
+    try:
         try:
-            if is_s3_test_event(record):
-                logger.info(
-                    "Message %s is an S3 test event; acknowledging without processing",
-                    message_id,
-                )
-                empty_message_ids.append(message_id)
-                continue
-
-            s3_refs = list(extract_s3_references(record))
-            if not s3_refs:
-                raise ValueError("SQS record did not contain any S3 references")
-
-            logger.debug(
-                "Message %s references %d S3 objects", message_id, len(s3_refs)
-            )
-
-            fetch_started = time.perf_counter()
-            table = build_arrow_table_from_s3_objects(s3_refs)
-            fetch_elapsed = time.perf_counter() - fetch_started
-            logger.info(
-                "Completed fetch for message %s in %.2fs",
-                message_id,
-                fetch_elapsed,
-            )
-            if table is None or table.num_rows == 0:
-                logger.info("Message %s produced no rows; acknowledging without insert", message_id)
-                empty_message_ids.append(message_id)
-                continue
-
-            processed_message_count += 1
-            total_rows += table.num_rows
-            total_objects += len(s3_refs)
-            current_batch.add(
-                PreparedMessage(
-                    message_id=message_id,
-                    table=table,
-                    object_count=len(s3_refs),
-                )
-            )
-            logger.info(
-                "Prepared %d rows from %d S3 objects for message %s",
-                table.num_rows,
-                len(s3_refs),
-                message_id,
-            )
-            log_stage(
-                "message_prepared",
-                message_id=message_id,
-                row_count=table.num_rows,
-                object_count=len(s3_refs),
-                current_batch_rows=current_batch.total_rows,
-                current_batch_messages=len(current_batch.prepared_messages),
-                estimated_batch_bytes=current_batch.estimated_bytes,
-                remaining_time_ms=get_remaining_time_ms(context),
-            )
-        except Exception as exc:  # pylint: disable=broad-except
-            logger.exception("Failed to prepare SQS message %s: %s", message_id, exc)
-            logger.error(
-                "Message %s moved to DLQ (if configured); inspect the DLQ for full payload and reason details",
-                message_id,
-            )
-            forward_failure_to_dlq(record, reason=str(exc))
-            # Simple debug using repr to produce a safe string representation
-            logger.debug("SQS record for message %s: %r", message_id, record)
-            logger.debug("Full Lambda event: %r", event)
-
-            failed_message_ids.append(message_id)
-            continue
-
-        logger.info("Message %s prepared successfully", message_id)
-        flush_reason = determine_flush_reason(current_batch, force=False)
-        if flush_reason:
-            flush_outcome = flush_current_batch(
-                current_batch,
-                context,
-                dry_run_enabled=dry_run_enabled,
-                flush_reason=flush_reason,
-            )
-            if flush_outcome.status == "committed":
-                committed_message_ids.extend(flush_outcome.message_ids)
-                continue
-            failed_message_ids.extend(flush_outcome.message_ids)
-            untouched_message_ids.extend(remaining_message_ids(records[index + 1 :]))
-            break
-
-    if not current_batch.is_empty():
-        flush_outcome = flush_current_batch(
-            current_batch,
-            context,
-            dry_run_enabled=dry_run_enabled,
-            flush_reason="end_of_invocation",
-        )
-        if flush_outcome.status == "committed":
-            committed_message_ids.extend(flush_outcome.message_ids)
-        else:
-            failed_message_ids.extend(flush_outcome.message_ids)
+            for index, record in enumerate(records):
+                message_id = record.get("messageId", "<unknown>")
+                if should_stop_processing_records(context, current_batch):
+                    untouched_message_ids.extend(remaining_message_ids(records[index:]))
+                    log_stage(
+                        "processing_stopped",
+                        outcome="remaining_time_low",
+                        remaining_time_ms=get_remaining_time_ms(context),
+                        current_batch_rows=current_batch.total_rows,
+                        current_batch_messages=len(current_batch.prepared_messages),
+                        untouched_messages=len(untouched_message_ids),
+                    )
+                    break
+
+                max_messages_per_invocation = resolve_max_messages_per_invocation_to_process()
+                if (
+                    max_messages_per_invocation is not None
+                    and processed_message_count >= max_messages_per_invocation
+                ):
+                    untouched_message_ids.extend(remaining_message_ids(records[index:]))
+                    log_stage(
+                        "processing_stopped",
+                        outcome="max_messages_per_invocation_reached",
+                        max_messages_per_invocation=max_messages_per_invocation,
+                        current_batch_rows=current_batch.total_rows,
+                        current_batch_messages=len(current_batch.prepared_messages),
+                        untouched_messages=len(untouched_message_ids),
+                    )
+                    break
+
+                logger.info("Processing message %s", message_id)
+                try:
+                    if is_s3_test_event(record):
+                        logger.info(
+                            "Message %s is an S3 test event; acknowledging without processing",
+                            message_id,
+                        )
+                        empty_message_ids.append(message_id)
+                        continue
+
+                    fetched = prefetcher.take(
+                        index,
+                        None
+                        if max_messages_per_invocation is None
+                        else max_messages_per_invocation - processed_message_count,
+                    )
+                    s3_refs = fetched.s3_refs
+                    table = fetched.table
+
+                    logger.debug(
+                        "Message %s references %d S3 objects", message_id, len(s3_refs)
+                    )
+                    logger.info(
+                        "Completed fetch for message %s in %.2fs",
+                        message_id,
+                        fetched.fetch_elapsed_seconds,
+                    )
+                    if table is None or table.num_rows == 0:
+                        logger.info("Message %s produced no rows; acknowledging without insert", message_id)
+                        empty_message_ids.append(message_id)
+                        continue
+
+                    processed_message_count += 1
+                    total_rows += table.num_rows
+                    total_objects += len(s3_refs)
+                    current_batch.add(
+                        PreparedMessage(
+                            message_id=message_id,
+                            table=table,
+                            object_count=len(s3_refs),
+                        )
+                    )
+                    logger.info(
+                        "Prepared %d rows from %d S3 objects for message %s",
+                        table.num_rows,
+                        len(s3_refs),
+                        message_id,
+                    )
+                    log_stage(
+                        "message_prepared",
+                        message_id=message_id,
+                        row_count=table.num_rows,
+                        object_count=len(s3_refs),
+                        current_batch_rows=current_batch.total_rows,
+                        current_batch_messages=len(current_batch.prepared_messages),
+                        estimated_batch_bytes=current_batch.estimated_bytes,
+                        remaining_time_ms=get_remaining_time_ms(context),
+                    )
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.exception("Failed to prepare SQS message %s: %s", message_id, exc)
+                    logger.error(
+                        "Message %s moved to DLQ (if configured); inspect the DLQ for full payload and reason details",
+                        message_id,
+                    )
+                    forward_failure_to_dlq(record, reason=str(exc))
+                    # Simple debug using repr to produce a safe string representation
+                    logger.debug("SQS record for message %s: %r", message_id, record)
+                    logger.debug("Full Lambda event: %r", event)
+
+                    failed_message_ids.append(message_id)
+                    continue
+
+                logger.info("Message %s prepared successfully", message_id)
+                flush_reason = determine_flush_reason(current_batch, force=False)
+                if flush_reason:
+                    pipeline.submit(current_batch, flush_reason)
+
+                for flush_outcome in pipeline.collect_completed():
+                    committed_message_ids.extend(flush_outcome.inserted_message_ids())
+                    failed_message_ids.extend(flush_outcome.retry_message_ids())
+                    # A bisected sub-batch that isolated its poison messages still
+                    # reached ClickHouse, so keep preparing the rest of the batch.
+                    if not flush_outcome.made_progress:
+                        insert_failed = True
+                if insert_failed:
+                    # Messages prepared after the failed sub-batch was handed off have not
+                    # been inserted; leave them and the rest of the batch for SQS to retry.
+                    untouched_message_ids.extend(current_batch.message_ids())
+                    untouched_message_ids.extend(remaining_message_ids(records[index + 1 :]))
+                    current_batch.reset()
+                    log_stage(
+                        "processing_stopped",
+                        outcome="sub_batch_insert_failed",
+                        inflight_inserts=pipeline.inflight,
+                        untouched_messages=len(untouched_message_ids),
+                    )
+                    break
+        finally:
+            prefetcher.close()
+
+        if not current_batch.is_empty():
+            pipeline.submit(current_batch, "end_of_invocation")
+
+        for flush_outcome in pipeline.drain():
+            committed_message_ids.extend(flush_outcome.inserted_message_ids())
+            failed_message_ids.extend(flush_outcome.retry_message_ids())
+    finally:
+        pipeline.close()
 
     unique_failures = sorted(set(failed_message_ids + untouched_message_ids))
     summary = {
@@ -389,6 +775,14 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         "total_s3_objects": total_objects,
         "dry_run": dry_run_enabled,
     }
+    if table_cache is not None and cache_stats_before is not None:
+        cache_stats = table_cache.stats()
+        summary.update(
+            table_cache_hits=cache_stats["hits"] - cache_stats_before["hits"],
+            table_cache_misses=cache_stats["misses"] - cache_stats_before["misses"],
+            table_cache_memory_bytes=cache_stats["memory_bytes"],
+            table_cache_spilled_bytes=cache_stats["spilled_bytes"],
+        )
     if unique_failures:
         logger.warning("Batch completed with failures: %s", json.dumps(summary))
     else:
@@ -407,6 +801,160 @@ class FlushOutcome:
     status: str
     message_ids: List[str]
     reason: str
+    # Set on "partial" outcomes from a bisected sub-batch: the messages whose
+    # rows were inserted. The rest of ``message_ids`` must be retried.
+    committed_message_ids: List[str] = field(default_factory=list)
+    error: Optional[BaseException] = field(default=None, compare=False)
+    # Slices of an over-MAX_ROWS_PER_INSERT sub-batch that committed before a
+    # later slice failed. Such a sub-batch must be retried as a whole under its
+    # original slice tokens; bisecting it would re-insert those rows.
+    committed_slices: int = 0
+
+    @property
+    def made_progress(self) -> bool:
+        return self.status in {"committed", "partial"}
+
+    def inserted_message_ids(self) -> List[str]:
+        if self.status == "committed":
+            return list(self.message_ids)
+        if self.status == "partial":
+            return list(self.committed_message_ids)
+        return []
+
+    def retry_message_ids(self) -> List[str]:
+        inserted = set(self.inserted_message_ids())
+        return [message_id for message_id in self.message_ids if message_id not in inserted]
+
+
+class InsertPipeline:
+    """Run sub-batch flushes in the background, at most ``max_inflight`` at a time.
+
+    ``submit`` detaches the current batch and hands it to a worker thread so the
+    handler can keep fetching and parsing later messages while ClickHouse works.
+    When ``max_inflight`` sub-batches are already in flight, ``submit`` blocks on
+    the oldest one first. With ``max_inflight`` of 0 every flush runs inline.
+    Outcomes are returned in submission order.
+    """
+
+    def __init__(self, max_inflight: int, context: Any, *, dry_run_enabled: bool) -> None:
+        self._max_inflight = max_inflight
+        self._context = context
+        self._dry_run_enabled = dry_run_enabled
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if max_inflight > 0:
+            self._executor = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="clickhouse-insert")
+        self._pending: "deque[Future]" = deque()
+        self._completed: List[FlushOutcome] = []
+
+    def submit(self, current_batch: BatchAccumulator, flush_reason: str) -> None:
+        if self._executor is None:
+            self._completed.append(
+                flush_current_batch(
+                    current_batch,
+                    self._context,
+                    dry_run_enabled=self._dry_run_enabled,
+                    flush_reason=flush_reason,
+                )
+            )
+            return
+        while len(self._pending) >= self._max_inflight:
+            self._completed.append(self._pending.popleft().result())
+        self._pending.append(
+            self._executor.submit(
+                flush_current_batch,
+                current_batch.detach(),
+                self._context,
+                dry_run_enabled=self._dry_run_enabled,
+                flush_reason=flush_reason,
+            )
+        )
+
+    def collect_completed(self) -> List[FlushOutcome]:
+        while self._pending and self._pending[0].done():
+            self._completed.append(self._pending.popleft().result())
+        outcomes, self._completed = self._completed, []
+        return outcomes
+
+    def drain(self) -> List[FlushOutcome]:
+        while self._pending:
+            self._completed.append(self._pending.popleft().result())
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        return self.collect_completed()
+
+    def close(self) -> None:
+        """Release the worker threads; queued flushes that never started are cancelled."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._pending)
+
+
+class AdaptiveBatchController:
+    """Tune the sub-batch row target from measured flush latency.
+
+    Each committed flush contributes its concat, serialize and insert time to an
+    EWMA of milliseconds per row; the next target is the row count expected to
+    take ``ADAPTIVE_TARGET_FLUSH_MS``, moving at most a factor of two per flush
+    and clamped to the configured bounds. A failed insert halves the target.
+    """
+
+    _EWMA_ALPHA = 0.3
+    _MAX_STEP_FACTOR = 2.0
+
+    def __init__(self, initial_target_rows: int) -> None:
+        self._lock = threading.Lock()
+        self.target_rows = initial_target_rows
+        self.ms_per_row: Optional[float] = None
+        self.observations = 0
+        self.failures = 0
+
+    def current_target(self, min_rows: int, max_rows: int) -> int:
+        with self._lock:
+            return min(max(self.target_rows, min_rows), max_rows)
+
+    def observe(self, row_count: int, duration_ms: float, *, target_ms: int, min_rows: int, max_rows: int) -> None:
+        if row_count <= 0:
+            return
+        with self._lock:
+            sample = max(duration_ms, 1.0) / row_count
+            if self.ms_per_row is None:
+                self.ms_per_row = sample
+            else:
+                self.ms_per_row += self._EWMA_ALPHA * (sample - self.ms_per_row)
+            self.observations += 1
+            desired = target_ms / self.ms_per_row
+            lower = self.target_rows / self._MAX_STEP_FACTOR
+            upper = self.target_rows * self._MAX_STEP_FACTOR
+            stepped = min(max(desired, lower), upper)
+            self.target_rows = int(min(max(stepped, min_rows), max_rows))
+
+    def record_failure(self, *, min_rows: int) -> None:
+        with self._lock:
+            self.failures += 1
+            self.target_rows = max(min_rows, self.target_rows // 2)
+
+    def log_fields(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "adaptive_target_rows": self.target_rows,
+                "adaptive_ms_per_row": round(self.ms_per_row, 4) if self.ms_per_row is not None else None,
+                "adaptive_observations": self.observations,
+                "adaptive_failures": self.failures,
+            }
+
+
+def get_adaptive_batch_controller() -> Optional[AdaptiveBatchController]:
+    """Return the container-wide controller, or None when adaptive sizing is off."""
+    global _ADAPTIVE_BATCH_CONTROLLER  # noqa: PLW0603 -- persists across warm invocations
+    if not env_flag("ADAPTIVE_BATCH_SIZING", default=False):
+        return None
+    with _ADAPTIVE_BATCH_CONTROLLER_LOCK:
+        if _ADAPTIVE_BATCH_CONTROLLER is None:
+            _ADAPTIVE_BATCH_CONTROLLER = AdaptiveBatchController(resolve_target_rows_per_insert())
+        return _ADAPTIVE_BATCH_CONTROLLER
 
 
 def flush_current_batch(
@@ -415,12 +963,136 @@ def flush_current_batch(
     *,
     dry_run_enabled: bool,
     flush_reason: str,
+) -> FlushOutcome:
+    prepared_messages = list(current_batch.prepared_messages)
+    outcome = _flush_sub_batch(
+        current_batch,
+        context,
+        dry_run_enabled=dry_run_enabled,
+        flush_reason=flush_reason,
+    )
+    if (
+        outcome.status != "failed"
+        or outcome.committed_slices
+        or len(prepared_messages) < 2
+        or not env_flag("BISECT_FAILED_SUB_BATCHES", default=False)
+        or not is_bisectable_insert_error(outcome.error)
+    ):
+        return outcome
+    return bisect_failed_sub_batch(
+        prepared_messages,
+        context,
+        dry_run_enabled=dry_run_enabled,
+        flush_reason=flush_reason,
+    )
+
+
+def is_bisectable_insert_error(error: Optional[BaseException]) -> bool:
+    """Return True when ClickHouse rejected the payload itself.
+
+    Connection failures, timeouts, throttling and auth or missing-table errors
+    would fail every half the same way, so only other HTTP error responses
+    (bad data, constraint violations, oversized payloads) are bisected.
+    """
+    return (
+        isinstance(error, ClickHouseInsertError)
+        and error.status_code not in _NON_BISECTABLE_STATUS_CODES
+    )
+
+
+def bisect_failed_sub_batch(
+    prepared_messages: List[PreparedMessage],
+    context: Any,
+    *,
+    dry_run_enabled: bool,
+    flush_reason: str,
+) -> FlushOutcome:
+    """Split a rejected sub-batch in halves until the rejected messages are isolated.
+
+    Each half is flushed like any other sub-batch, so its insert token is stable
+    across SQS retries and ``can_start_insert`` stops the search once the Lambda
+    time budget runs low; halves not attempted are returned for retry.
+    """
+    started = time.perf_counter()
+    message_ids = [prepared.message_id for prepared in prepared_messages]
+    committed: List[str] = []
+    poison: List[str] = []
+    retry: List[str] = []
+    attempts = 0
+    pending: "deque[List[PreparedMessage]]" = deque([prepared_messages])
+    while pending:
+        group = pending.popleft()
+        middle = len(group) // 2
+        for half in (group[:middle], group[middle:]):
+            half_batch = BatchAccumulator()
+            for prepared in half:
+                half_batch.add(prepared)
+            half_ids = half_batch.message_ids()
+            attempts += 1
+            outcome = _flush_sub_batch(
+                half_batch,
+                context,
+                dry_run_enabled=dry_run_enabled,
+                flush_reason=BISECT_FLUSH_REASON,
+            )
+            if outcome.status == "committed":
+                committed.extend(half_ids)
+            elif (
+                outcome.status == "failed"
+                and not outcome.committed_slices
+                and is_bisectable_insert_error(outcome.error)
+            ):
+                if len(half) > 1:
+                    pending.append(half)
+                else:
+                    poison.extend(half_ids)
+                    log_stage(
+                        "sub_batch_poison_message",
+                        message_id=half_ids[0],
+                        row_count=half[0].table.num_rows,
+                        object_count=half[0].object_count,
+                        error=str(outcome.error),
+                    )
+            else:
+                retry.extend(half_ids)
+
+    log_stage(
+        "sub_batch_bisected",
+        flush_reason=flush_reason,
+        message_count=len(message_ids),
+        committed_messages=len(committed),
+        poison_messages=len(poison),
+        retry_messages=len(retry),
+        insert_attempts=attempts,
+        duration_ms=elapsed_ms(started),
+        remaining_time_ms=get_remaining_time_ms(context),
+    )
+    committed_set = set(committed)
+    return FlushOutcome(
+        status="partial" if committed else "failed",
+        message_ids=message_ids,
+        reason=flush_reason,
+        committed_message_ids=[message_id for message_id in message_ids if message_id in committed_set],
+    )
+
+
+def _flush_sub_batch(
+    current_batch: BatchAccumulator,
+    context: Any,
+    *,
+    dry_run_enabled: bool,
+    flush_reason: str,
 ) -> FlushOutcome:
     if current_batch.is_empty():
         return FlushOutcome(status="empty", message_ids=[], reason=flush_reason)
 
     message_ids = current_batch.message_ids()
-    insert_token = build_insert_token(message_ids, current_batch.total_rows)
+    # Retried sub-batches must reproduce the same rows in the same order for the
+    # server-side deduplication token to match, so order messages by source.
+    ordered_tables = sorted(current_batch.tables(), key=source_sort_key)
+    insert_token = build_source_insert_token(ordered_tables) or build_insert_token(
+        message_ids, current_batch.total_rows
+    )
     remaining_time_ms = get_remaining_time_ms(context)
     if not can_start_insert(context):
         log_stage(
@@ -450,7 +1122,7 @@ def flush_current_batch(
     )
 
     concat_started = time.perf_counter()
-    combined_table = concatenate_tables(current_batch.tables())
+    combined_table = concatenate_tables(ordered_tables)
     concat_duration_ms = elapsed_ms(concat_started)
     log_stage(
         "sub_batch_concatenated",
@@ -461,36 +1133,142 @@ def flush_current_batch(
         remaining_time_ms=get_remaining_time_ms(context),
     )
 
-    parquet_started = time.perf_counter()
-    parquet_payload = table_to_parquet(combined_table)
-    parquet_duration_ms = elapsed_ms(parquet_started)
-    payload_bytes = len(parquet_payload)
-    log_stage(
-        "sub_batch_serialized",
-        insert_token=insert_token,
-        row_count=combined_table.num_rows,
-        payload_bytes=payload_bytes,
-        duration_ms=parquet_duration_ms,
-        remaining_time_ms=get_remaining_time_ms(context),
-    )
+    # A single large object can exceed MAX_ROWS_PER_INSERT on its own, so the
+    # sub-batch is inserted in slices. Slice boundaries depend only on the rows
+    # and the limit, so a retry reproduces the same per-slice tokens and slices
+    # that were already committed are deduplicated by the server.
+    max_rows = resolve_max_rows_per_insert()
+    slice_count = max(1, math.ceil(combined_table.num_rows / max_rows))
+    for slice_index in range(slice_count):
+        if slice_index and not can_start_insert(context):
+            log_stage(
+                "sub_batch_no_progress",
+                outcome="cannot_start_insert",
+                flush_reason=flush_reason,
+                blocker="insufficient_remaining_time",
+                insert_token=insert_token,
+                slice_index=slice_index,
+                slice_count=slice_count,
+                row_count=combined_table.num_rows,
+                message_count=len(message_ids),
+                remaining_time_ms=get_remaining_time_ms(context),
+            )
+            current_batch.reset()
+            return FlushOutcome(
+                status="no_progress",
+                message_ids=message_ids,
+                reason=flush_reason,
+                committed_slices=slice_index,
+            )
+        table_slice = combined_table
+        slice_token = insert_token
+        slice_fields: Dict[str, Any] = {}
+        if slice_count > 1:
+            table_slice = combined_table.slice(slice_index * max_rows, max_rows)
+            slice_token = f"{insert_token}-{slice_index}"
+            slice_fields = {"slice_index": slice_index, "slice_count": slice_count}
+        status, error = _insert_table_slice(
+            table_slice,
+            context,
+            insert_token=slice_token,
+            dry_run_enabled=dry_run_enabled,
+            flush_reason=flush_reason,
+            message_count=len(message_ids),
+            estimated_payload_bytes=current_batch.estimated_bytes * table_slice.num_rows
+            // max(1, combined_table.num_rows),
+            concat_duration_ms=concat_duration_ms if slice_index == 0 else 0,
+            log_fields=slice_fields,
+        )
+        if status != "committed":
+            current_batch.reset()
+            return FlushOutcome(
+                status=status,
+                message_ids=message_ids,
+                reason=flush_reason,
+                error=error,
+                committed_slices=slice_index,
+            )
+    current_batch.reset()
+    return FlushOutcome(status="committed", message_ids=message_ids, reason=flush_reason)
+
+
+def _insert_table_slice(
+    combined_table: pa.Table,
+    context: Any,
+    *,
+    insert_token: str,
+    dry_run_enabled: bool,
+    flush_reason: str,
+    message_count: int,
+    estimated_payload_bytes: int,
+    concat_duration_ms: int,
+    log_fields: Dict[str, Any],
+) -> Tuple[str, Optional[BaseException]]:
+    """Serialize and insert one slice of a sub-batch; returns ``(status, error)``."""
+    insert_format = resolve_insert_format()
+    payload: Union[bytes, StreamingInsertPayload]
+    serialize_duration_ms = 0
+    if env_flag("CLICKHOUSE_STREAMING_INSERT", default=False):
+        # Serialization overlaps the upload; the stage is logged once the footer is written.
+        def log_streamed(streamed_payload: StreamingInsertPayload) -> None:
+            observe_serialized_payload(insert_format, combined_table, streamed_payload.bytes_written)
+            log_stage(
+                "sub_batch_serialized",
+                insert_token=insert_token,
+                **log_fields,
+                insert_format=insert_format.name,
+                row_count=combined_table.num_rows,
+                estimated_payload_bytes=estimated_payload_bytes,
+                payload_bytes=streamed_payload.bytes_written,
+                duration_ms=int(round(streamed_payload.encode_seconds * 1000)),
+                streamed=True,
+                remaining_time_ms=get_remaining_time_ms(context),
+            )
+
+        payload = StreamingInsertPayload(
+            combined_table,
+            row_group_rows=resolve_streaming_row_group_rows(),
+            insert_format=insert_format,
+            on_complete=log_streamed,
+        )
+    else:
+        serialize_started = time.perf_counter()
+        payload = serialize_table(combined_table, insert_format)
+        serialize_duration_ms = elapsed_ms(serialize_started)
+        observe_serialized_payload(insert_format, combined_table, len(payload), payload)
+        log_stage(
+            "sub_batch_serialized",
+            insert_token=insert_token,
+            **log_fields,
+            insert_format=insert_format.name,
+            row_count=combined_table.num_rows,
+            estimated_payload_bytes=estimated_payload_bytes,
+            payload_bytes=len(payload),
+            duration_ms=serialize_duration_ms,
+            remaining_time_ms=get_remaining_time_ms(context),
+        )
 
     if dry_run_enabled:
+        if isinstance(payload, StreamingInsertPayload):
+            for _chunk in payload:
+                pass
         logger.info(
             "DRY_RUN enabled; skipping ClickHouse insert for %d rows from %d messages",
             combined_table.num_rows,
-            len(message_ids),
+            message_count,
         )
         log_stage(
             "sub_batch_committed",
             outcome="dry_run",
             insert_token=insert_token,
+            **log_fields,
             row_count=combined_table.num_rows,
-            message_count=len(message_ids),
-            payload_bytes=payload_bytes,
+            message_count=message_count,
+            payload_bytes=payload_size_bytes(payload),
             flush_reason=flush_reason,
         )
-        current_batch.reset()
-        return FlushOutcome(status="committed", message_ids=message_ids, reason=flush_reason)
+        record_committed_rows_metric(combined_table)
+        return "committed", None
 
     try:
         request_timeout_seconds = derive_clickhouse_timeout_seconds(context)
@@ -501,54 +1279,80 @@ def flush_current_batch(
             flush_reason=flush_reason,
             blocker="insufficient_remaining_time_after_serialization",
             insert_token=insert_token,
+            **log_fields,
             row_count=combined_table.num_rows,
-            message_count=len(message_ids),
-            payload_bytes=payload_bytes,
+            message_count=message_count,
+            payload_bytes=payload_size_bytes(payload),
             remaining_time_ms=get_remaining_time_ms(context),
             error=str(exc),
         )
-        current_batch.reset()
-        return FlushOutcome(status="no_progress", message_ids=message_ids, reason=flush_reason)
+        return "no_progress", None
 
     insert_started = time.perf_counter()
     try:
-        insert_into_clickhouse(
-            parquet_payload,
+        insert_result = insert_into_clickhouse(
+            payload,
             combined_table.num_rows,
             timeout_seconds=request_timeout_seconds,
             insert_token=insert_token,
         )
     except Exception as exc:  # pylint: disable=broad-except
         logger.exception("ClickHouse insert failed for sub-batch %s: %s", insert_token, exc)
+        adaptive_fields: Dict[str, Any] = {}
+        controller = get_adaptive_batch_controller()
+        # Rejections of bisected halves say nothing about ClickHouse latency.
+        if controller is not None and flush_reason != BISECT_FLUSH_REASON:
+            controller.record_failure(min_rows=resolve_adaptive_min_rows_per_insert())
+            adaptive_fields = controller.log_fields()
         log_stage(
             "sub_batch_failed",
             outcome="clickhouse_insert_failed",
             insert_token=insert_token,
+            **log_fields,
             row_count=combined_table.num_rows,
-            message_count=len(message_ids),
-            payload_bytes=payload_bytes,
+            message_count=message_count,
+            payload_bytes=payload_size_bytes(payload),
             flush_reason=flush_reason,
             duration_ms=elapsed_ms(insert_started),
             remaining_time_ms=get_remaining_time_ms(context),
             error=str(exc),
+            **adaptive_fields,
         )
-        current_batch.reset()
-        return FlushOutcome(status="failed", message_ids=message_ids, reason=flush_reason)
+        return "failed", exc
 
+    insert_duration_ms = elapsed_ms(insert_started)
+    adaptive_fields = {}
+    controller = get_adaptive_batch_controller()
+    if controller is not None:
+        controller.observe(
+            combined_table.num_rows,
+            concat_duration_ms + serialize_duration_ms + insert_duration_ms,
+            target_ms=resolve_adaptive_target_flush_ms(),
+            min_rows=resolve_adaptive_min_rows_per_insert(),
+            max_rows=resolve_max_rows_per_insert(),
+        )
+        adaptive_fields = controller.log_fields()
+    connection_stats = clickhouse_connection_stats()
     log_stage(
         "sub_batch_committed",
         outcome="clickhouse_insert_succeeded",
         insert_token=insert_token,
+        **log_fields,
         row_count=combined_table.num_rows,
-        message_count=len(message_ids),
-        payload_bytes=payload_bytes,
+        message_count=message_count,
+        payload_bytes=payload_size_bytes(payload),
         flush_reason=flush_reason,
-        duration_ms=elapsed_ms(insert_started),
+        duration_ms=insert_duration_ms,
         request_timeout_seconds=request_timeout_seconds,
         remaining_time_ms=get_remaining_time_ms(context),
+        clickhouse_connections_opened=connection_stats["connections_opened"],
+        clickhouse_connections_reused=connection_stats["connections_reused"],
+        http_compression=insert_result.content_encoding,
+        wire_bytes=insert_result.wire_bytes,
+        **adaptive_fields,
     )
-    current_batch.reset()
-    return FlushOutcome(status="committed", message_ids=message_ids, reason=flush_reason)
+    record_committed_rows_metric(combined_table)
+    return "committed", None
 
 
 def is_s3_test_event(record: Dict[str, Any]) -> bool:
@@ -607,7 +1411,28 @@ def _extract_from_s3_event_record(s3_record: Dict[str, Any]) -> Iterable[S3Objec
     key = object_info.get("key")
     if not bucket or not key:
         return []
-    yield S3ObjectRef(bucket=bucket, key=unquote_plus(key))
+    size = object_info.get("size")
+    yield S3ObjectRef(
+        bucket=bucket,
+        key=unquote_plus(key),
+        size=size if isinstance(size, int) else None,
+        etag=object_info.get("eTag"),
+    )
+
+
+def fetch_message_table(record: Dict[str, Any]) -> FetchedMessage:
+    """Resolve the S3 references of one SQS record and load them into a table."""
+    s3_refs = list(extract_s3_references(record))
+    if not s3_refs:
+        raise ValueError("SQS record did not contain any S3 references")
+
+    fetch_started = time.perf_counter()
+    table = build_arrow_table_from_s3_objects(s3_refs)
+    return FetchedMessage(
+        s3_refs=s3_refs,
+        table=table,
+        fetch_elapsed_seconds=time.perf_counter() - fetch_started,
+    )
 
 
 def build_arrow_table_from_s3_objects(objects: Iterable[S3ObjectRef]) -> Optional[pa.Table]:
@@ -624,7 +1449,7 @@ def build_arrow_table_from_s3_objects(objects: Iterable[S3ObjectRef]) -> Optiona
 
 def forward_failure_to_dlq(record: Optional[Dict[str, Any]], *, reason: str) -> None:
     """Send irrecoverable messages to an optional DLQ for later triage."""
-    if not _sqs_client or not _FAILURE_DLQ_URL or not record:
+    if not _FAILURE_DLQ_URL or not record:
         return
 
     message_body = record.get("body") if isinstance(record, dict) else None
@@ -640,7 +1465,7 @@ def forward_failure_to_dlq(record: Optional[Dict[str, Any]], *, reason: str) ->
         },
     }
     try:
-        _sqs_client.send_message(
+        _get_sqs_client().send_message(
             QueueUrl=_FAILURE_DLQ_URL,
             MessageBody=message_body or "",
             MessageAttributes=attributes,
@@ -650,6 +1475,15 @@ def forward_failure_to_dlq(record: Optional[Dict[str, Any]], *, reason: str) ->
         logger.error("Failed to send message %s to DLQ: %s", message_id or "<unknown>", exc)
 
 
+def _get_sqs_client() -> Any:
+    global _sqs_client  # noqa: PLW0603 -- created once per container
+    if _sqs_client is None:
+        with _SQS_CLIENT_LOCK:
+            if _sqs_client is None:
+                _sqs_client = boto3.client("sqs")
+    return _sqs_client
+
+
 def find_record_by_id(records: Iterable[Dict[str, Any]], message_id: str) -> Optional[Dict[str, Any]]:
     """Locate a record by messageId for DLQ forwarding on batch insert failures."""
     for record in records:
@@ -659,7 +1493,239 @@ def find_record_by_id(records: Iterable[Dict[str, Any]], message_id: str) -> Opt
 
 
 def load_json_lines_as_table(ref: S3ObjectRef) -> Optional[pa.Table]:
-    """Read a JSON Lines object from S3 into an Arrow table."""
+    """Read a JSON Lines object from S3 into an Arrow table.
+
+    With ``TABLE_CACHE_MAX_BYTES`` set, a table prepared earlier in this
+    container for the same bucket/key/etag is returned without touching S3.
+    """
+    cache = get_table_cache()
+    if cache is None:
+        return _load_json_lines_from_s3(ref)
+    cached = cache.get(ref.bucket, ref.key, ref.etag)
+    if cached is not None:
+        table, tier = cached
+        log_stage("object_cache_hit", bucket=ref.bucket, key=ref.key, tier=tier, row_count=table.num_rows)
+        return table
+    table = _load_json_lines_from_s3(ref)
+    if table is not None:
+        etag = ref.etag
+        if etag is None and "source_etag" in table.column_names and table.num_rows:
+            etag = table.column("source_etag")[0].as_py()
+        cache.put(ref.bucket, ref.key, etag, table)
+    return table
+
+
+class TableCache:
+    """Byte-bounded LRU of normalized tables keyed by S3 bucket/key/etag.
+
+    SQS retries after a failed sub-batch usually land on the same warm
+    container, so keeping recently prepared tables avoids downloading and
+    parsing the same objects again. Entries are keyed by bucket/key and
+    carry the object's etag: a lookup with a different etag misses and the
+    put that follows replaces the entry, so an overwritten object is never
+    served stale. Lookups without an etag always miss.
+
+    Tables evicted from memory are spilled to ``spill_dir`` as Arrow IPC files
+    when configured (itself LRU-bounded by ``spill_max_bytes``) and are memory
+    mapped back on a hit.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: Optional[str] = None, spill_max_bytes: int = 0) -> None:
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes if spill_dir else 0
+        self._lock = threading.Lock()
+        self._memory: "Dict[Tuple[str, str], Tuple[str, pa.Table]]" = {}
+        self._memory_bytes = 0
+        self._spilled: Dict[Tuple[str, str], Tuple[str, str, int]] = {}
+        self._spilled_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            # Files left by an earlier cache instance are not indexed; reclaim the space.
+            for name in os.listdir(self.spill_dir):
+                if name.endswith(".arrow"):
+                    os.remove(os.path.join(self.spill_dir, name))
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "spilled_entries": len(self._spilled),
+                "spilled_bytes": self._spilled_bytes,
+            }
+
+    def get(self, bucket: str, key: str, etag: Optional[str]) -> Optional[Tuple[pa.Table, str]]:
+        """Return ``(table, tier)`` for an unchanged object, tier being memory or disk."""
+        identity = (bucket, key)
+        etag = _normalize_etag(etag)
+        with self._lock:
+            if etag is None:
+                self.misses += 1
+                return None
+            entry = self._memory.get(identity)
+            if entry is not None and entry[0] == etag:
+                self._memory[identity] = self._memory.pop(identity)  # most recently used
+                self.hits += 1
+                return entry[1], "memory"
+            spilled = self._spilled.get(identity)
+            if spilled is not None and spilled[0] == etag:
+                del self._spilled[identity]
+                self._spilled_bytes -= spilled[2]
+                table = self._read_spilled(spilled[1])
+                if table is not None:
+                    self.hits += 1
+                    self._store(identity, etag, table)
+                    return table, "disk"
+            # A different etag is a miss; the put that follows replaces the stale entry.
+            self.misses += 1
+            return None
+
+    def put(self, bucket: str, key: str, etag: Optional[str], table: pa.Table) -> None:
+        etag = _normalize_etag(etag)
+        if etag is None or table.nbytes > self.max_bytes:
+            return
+        identity = (bucket, key)
+        with self._lock:
+            previous = self._memory.pop(identity, None)
+            if previous is not None:
+                self._memory_bytes -= previous[1].nbytes
+            spilled = self._spilled.pop(identity, None)
+            if spilled is not None:
+                self._spilled_bytes -= spilled[2]
+                self._remove_file(spilled[1])
+            self._store(identity, etag, table)
+
+    def _store(self, identity: Tuple[str, str], etag: str, table: pa.Table) -> None:
+        self._memory[identity] = (etag, table)
+        self._memory_bytes += table.nbytes
+        while self._memory_bytes > self.max_bytes and self._memory:
+            oldest = next(iter(self._memory))
+            old_etag, old_table = self._memory.pop(oldest)
+            self._memory_bytes -= old_table.nbytes
+            self._spill(oldest, old_etag, old_table)
+
+    def _spill(self, identity: Tuple[str, str], etag: str, table: pa.Table) -> None:
+        if not self.spill_dir or table.nbytes > self.spill_max_bytes:
+            return
+        digest = hashlib.sha256(f"{identity[0]}/{identity[1]}".encode("utf-8")).hexdigest()[:32]
+        path = os.path.join(self.spill_dir, f"{digest}.arrow")
+        try:
+            with pa.OSFile(path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            size = os.path.getsize(path)
+        except OSError as exc:
+            logger.warning("Could not spill cached table for s3://%s/%s: %s", identity[0], identity[1], exc)
+            self._remove_file(path)
+            return
+        self._spilled[identity] = (etag, path, size)
+        self._spilled_bytes += size
+        while self._spilled_bytes > self.spill_max_bytes and self._spilled:
+            oldest = next(iter(self._spilled))
+            _etag, old_path, old_size = self._spilled.pop(oldest)
+            self._spilled_bytes -= old_size
+            self._remove_file(old_path)
+
+    @staticmethod
+    def _read_spilled(path: str) -> Optional[pa.Table]:
+        try:
+            with pa.memory_map(path, "r") as source:
+                table = pa.ipc.open_file(source).read_all()
+        except (OSError, pa.ArrowException) as exc:
+            logger.warning("Discarding unreadable spilled table %s: %s", path, exc)
+            table = None
+        TableCache._remove_file(path)
+        return table
+
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_table_cache() -> Optional[TableCache]:
+    """Return the container-wide table cache, or None when it is disabled."""
+    global _TABLE_CACHE  # noqa: PLW0603 -- persists across warm invocations
+    max_bytes = resolve_table_cache_max_bytes()
+    if max_bytes <= 0:
+        return None
+    spill_dir = os.getenv("TABLE_CACHE_DIR") or None
+    spill_max_bytes = resolve_table_cache_dir_max_bytes()
+    with _TABLE_CACHE_LOCK:
+        current = _TABLE_CACHE
+        if (
+            current is None
+            or current.max_bytes != max_bytes
+            or current.spill_dir != spill_dir
+            or current.spill_max_bytes != (spill_max_bytes if spill_dir else 0)
+        ):
+            _TABLE_CACHE = TableCache(max_bytes, spill_dir, spill_max_bytes)
+        return _TABLE_CACHE
+
+
+class QuarantinedLines:
+    """Bad lines of one S3 object, written to ``QUARANTINE_SINK`` as JSONL.
+
+    The sink object name is derived from the source bucket, key and ETag, so a
+    retried message overwrites its earlier quarantine file instead of adding one.
+    """
+
+    def __init__(self, ref: S3ObjectRef, etag: Optional[str], sink: str) -> None:
+        self.ref = ref
+        self.etag = _normalize_etag(etag)
+        self.sink = sink
+        self.records: List[Dict[str, Any]] = []
+
+    def add(self, line_number: int, raw_line: bytes, exc: BaseException) -> None:
+        self.records.append(
+            {
+                "source_file": f"s3://{self.ref.bucket}/{self.ref.key}",
+                "source_etag": self.etag,
+                "line_number": line_number,
+                "error": f"{type(exc).__name__}: {exc}",
+                "raw_line": raw_line.decode("utf-8", errors="replace"),
+            }
+        )
+
+    def check_error_rate(self, line_count: int) -> None:
+        max_rate = resolve_quarantine_max_error_rate()
+        allowed = int(line_count * max_rate)
+        if len(self.records) > allowed:
+            first = self.records[0]
+            raise ValueError(
+                f"{len(self.records)} of {line_count} lines in s3://{self.ref.bucket}/{self.ref.key} failed, "
+                f"above QUARANTINE_MAX_ERROR_RATE={max_rate}; first at line {first['line_number']}: {first['error']}"
+            )
+
+    def write(self) -> str:
+        name = f"{self.ref.bucket}/{self.ref.key}.{self.etag or 'no-etag'}.quarantine.jsonl"
+        body = b"".join(
+            json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n" for record in self.records
+        )
+        if self.sink.startswith("s3://"):
+            bucket, prefix = _split_s3_uri(self.sink)
+            key = f"{prefix}/{name}" if prefix else name
+            s3_client.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/x-ndjson")
+            return f"s3://{bucket}/{key}"
+        path = os.path.join(self.sink, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as handle:
+            handle.write(body)
+        return path
+
+
+def _load_json_lines_from_s3(ref: S3ObjectRef) -> Optional[pa.Table]:
     ensure_pyarrow_available()
     max_bytes_env = os.getenv("MAX_S3_OBJECT_BYTES")
     max_bytes = int(max_bytes_env) if max_bytes_env else None
@@ -667,9 +1733,19 @@ def load_json_lines_as_table(ref: S3ObjectRef) -> Optional[pa.Table]:
 
     fetch_started = time.perf_counter()
 
-    response = s3_client.get_object(Bucket=ref.bucket, Key=ref.key)
+    ranged_threshold = resolve_s3_ranged_get_threshold_bytes()
+    part_size = resolve_s3_range_part_bytes()
+    first_request_ranged = bool(ranged_threshold and ref.size is not None and ref.size > ranged_threshold)
+    if first_request_ranged:
+        # The event already says the object is large: fetch only the first part.
+        response = s3_client.get_object(Bucket=ref.bucket, Key=ref.key, Range=f"bytes=0-{part_size - 1}")
+    else:
+        response = s3_client.get_object(Bucket=ref.bucket, Key=ref.key)
+    # Fetch and normalize time are summed as they interleave with parsing;
+    # parse_ms in ``object_parsed`` is whatever remains of the object's wall time.
+    stage_seconds = {"fetch": time.perf_counter() - fetch_started, "normalize": 0.0}
     body = response["Body"]
-    content_length = response.get("ContentLength")
+    content_length = _object_size_from_response(response)
     if content_length is not None:
         logger.info(
             "Object size for s3://%s/%s is %.2f MB",
@@ -678,44 +1754,154 @@ def load_json_lines_as_table(ref: S3ObjectRef) -> Optional[pa.Table]:
             content_length / (1024 * 1024),
         )
 
-    if max_bytes is not None:
-        # peek at the content length provided by S3 to fail early
-        object_size = response.get("ContentLength")
-        if object_size and object_size > max_bytes:
-            raise ValueError(
-                f"S3 object s3://{ref.bucket}/{ref.key} is {object_size} bytes which exceeds MAX_S3_OBJECT_BYTES"
-            )
+    oversized = max_bytes is not None and content_length is not None and content_length > max_bytes
+    if oversized:
+        log_stage(
+            "object_streaming",
+            bucket=ref.bucket,
+            key=ref.key,
+            object_bytes=content_length,
+            max_object_bytes=max_bytes,
+        )
 
-    rows: List[Dict[str, Any]] = []
+    raw_chunks: Optional[Iterator[bytes]] = None
+    # The event size can be stale: an object overwritten with a smaller one may
+    # fall under the threshold, but a ranged first GET still returned only its
+    # first part, so the rest must be fetched by range as well.
+    partial_first_body = first_request_ranged and content_length is not None and content_length > part_size
+    if content_length is not None and (
+        partial_first_body or (ranged_threshold and content_length > ranged_threshold)
+    ):
+        reader = RangedObjectReader(
+            ref,
+            body,
+            size=content_length,
+            etag=response.get("ETag"),
+            part_size=part_size,
+            concurrency=resolve_s3_range_concurrency(),
+        )
+        raw_chunks = reader.iter_chunks()
+    elif hasattr(body, "iter_chunks"):
+        raw_chunks = _iter_then_close(body.iter_chunks(chunk_size=_S3_READ_CHUNK_BYTES), body)
+    if raw_chunks is not None:
+        raw_chunks = _timed_iter(raw_chunks, stage_seconds, "fetch")
+
+    line_iter: Iterable[bytes]
+    decompressor: Optional[ObjectDecompressor] = None
+    if raw_chunks is None:
+        # Bodies that only expose ``iter_lines`` cannot be sniffed; treat them as plain JSONL.
+        line_iter = _timed_iter(
+            _iter_then_close(body.iter_lines(chunk_size=_S3_READ_CHUNK_BYTES), body), stage_seconds, "fetch"
+        )
+    else:
+        first_chunk = next(raw_chunks, b"")
+        raw_chunks = itertools.chain([first_chunk], raw_chunks)
+        codec = detect_object_compression(ref.key, response.get("ContentEncoding"), first_chunk)
+        if codec is not None:
+            decompressor = ObjectDecompressor(raw_chunks, codec)
+            raw_chunks = decompressor.iter_chunks()
+        line_iter = iter_lines_from_chunks(raw_chunks)
+    def log_object_parsed(table: pa.Table, **fields: Any) -> None:
+        duration_seconds = time.perf_counter() - fetch_started
+        decompress_seconds = decompressor.decompress_seconds if decompressor else 0.0
+        parse_seconds = duration_seconds - stage_seconds["fetch"] - stage_seconds["normalize"] - decompress_seconds
+        log_stage(
+            "object_parsed",
+            bucket=ref.bucket,
+            key=ref.key,
+            object_bytes=content_length,
+            uncompressed_bytes=decompressor.uncompressed_bytes if decompressor else content_length,
+            row_count=table.num_rows,
+            **fields,
+            fetch_ms=round(stage_seconds["fetch"] * 1000, 3),
+            parse_ms=round(max(0.0, parse_seconds) * 1000, 3),
+            normalize_ms=round(stage_seconds["normalize"] * 1000, 3),
+            duration_ms=elapsed_ms(fetch_started),
+        )
+
+    batches: List[pa.Table] = []
+    # Statements and physical lines already turned into ``batches`` by the Arrow reader.
+    first_statement = 0
+    first_physical_line = 1
+    if resolve_jsonl_ingestion_mode() == "arrow" and not oversized:
+        arrow_chunks = raw_chunks if raw_chunks is not None else (line + b"\n" for line in line_iter)
+        arrow_read = _load_json_lines_with_arrow_reader(ref, arrow_chunks, etag=response.get("ETag"))
+        normalize_started = time.perf_counter()
+        batches = [normalize_table_schema(table) for table in arrow_read.tables]
+        stage_seconds["normalize"] += time.perf_counter() - normalize_started
+        if arrow_read.remaining_lines is None and batches:
+            if decompressor is not None:
+                _log_object_decompressed(ref, decompressor)
+            table = batches[0] if len(batches) == 1 else pa.concat_tables(batches)
+            logger.info(
+                "Parsed %d rows from s3://%s/%s with the Arrow JSON reader in %.2fs",
+                table.num_rows,
+                ref.bucket,
+                ref.key,
+                time.perf_counter() - fetch_started,
+            )
+            log_object_parsed(table, ingestion_mode="arrow", batch_count=len(batches))
+            return table
+        line_iter = arrow_read.remaining_lines or iter(())
+        first_statement = arrow_read.statement_count
+        first_physical_line = arrow_read.physical_line_count + 1
+
+    builder = XapiColumnBuilder(bucket=ref.bucket, key=ref.key, etag=response.get("ETag"))
+    batch_rows = resolve_jsonl_batch_rows()
+    # Arrow bytes held for this object alone: the finished batches plus the
+    # batch being converted. Unlike pa.total_allocated_bytes() this excludes
+    # concurrent fetches, the table cache and the accumulated sub-batch.
+    retained_arrow_bytes = sum(table.nbytes for table in batches)
+    peak_arrow_bytes = retained_arrow_bytes
     log_interval_seconds = float(os.getenv("ITER_LOG_INTERVAL_SECONDS", "5"))
     next_log_deadline = fetch_started + log_interval_seconds
 
-    processed_rows = 0
+    def finish_batch() -> None:
+        # Converting every ``batch_rows`` rows releases the per-row Python values,
+        # so memory tracks the Arrow columns rather than the whole object.
+        nonlocal peak_arrow_bytes, retained_arrow_bytes
+        try:
+            built = builder.finish()
+            normalize_started = time.perf_counter()
+            normalized = normalize_table_schema(built)
+            stage_seconds["normalize"] += time.perf_counter() - normalize_started
+        except Exception as exc:  # pylint: disable=broad-except
+            raise ValueError(f"Unable to convert rows from s3://{ref.bucket}/{ref.key} into Arrow table") from exc
+        batches.append(normalized)
+        peak_arrow_bytes = max(peak_arrow_bytes, retained_arrow_bytes + built.nbytes + normalized.nbytes)
+        retained_arrow_bytes += normalized.nbytes
+
+    processed_rows = first_statement
+    quarantine_sink = resolve_quarantine_sink()
+    quarantined = QuarantinedLines(ref, response.get("ETag"), quarantine_sink) if quarantine_sink else None
 
-    for physical_line, raw_line in enumerate(body.iter_lines(chunk_size=1024 * 64), start=1):
+    for physical_line, raw_line in enumerate(line_iter, start=first_physical_line):
         if not raw_line:
             continue
+        # A quarantined line keeps its statement number, so the good rows get the
+        # same source_line (and event identity) as if the bad line were fixed.
+        processed_rows += 1
         try:
             statement = json.loads(raw_line)
-            processed_rows += 1
-            transformed = transform_xapi_statement(
-                statement,
-                raw_bytes=raw_line,
-                bucket=ref.bucket,
-                key=ref.key,
-                etag=response.get("ETag"),
-                line_number=processed_rows,
-            )
-            rows.append(transformed)
+            builder.append(statement, raw_bytes=raw_line, line_number=processed_rows)
         except json.JSONDecodeError as exc:
+            if quarantined is not None:
+                quarantined.add(physical_line, raw_line, exc)
+                continue
             raise ValueError(
                 f"Invalid JSON in s3://{ref.bucket}/{ref.key}: {raw_line[:200]!r}"
             ) from exc
         except Exception as exc:  # pylint: disable=broad-except
+            if quarantined is not None:
+                quarantined.add(physical_line, raw_line, exc)
+                continue
             raise ValueError(
                 f"Failed to transform JSON in s3://{ref.bucket}/{ref.key}: line {physical_line}"
             ) from exc
 
+        if builder.num_rows >= batch_rows:
+            finish_batch()
+
         now = time.perf_counter()
         if now >= next_log_deadline:
             logger.debug(
@@ -728,30 +1914,607 @@ def load_json_lines_as_table(ref: S3ObjectRef) -> Optional[pa.Table]:
             )
             next_log_deadline = now + log_interval_seconds
 
-    if not rows:
+    if builder.num_rows:
+        finish_batch()
+    if decompressor is not None:
+        _log_object_decompressed(ref, decompressor)
+    if quarantined is not None and quarantined.records:
+        quarantined.check_error_rate(processed_rows)
+        # Written before the good rows are returned: if the sink is unavailable
+        # the message fails and is retried rather than dropping the bad lines.
+        quarantine_uri = quarantined.write()
+        log_stage(
+            "object_rows_quarantined",
+            bucket=ref.bucket,
+            key=ref.key,
+            quarantined_rows=len(quarantined.records),
+            line_count=processed_rows,
+            error_rate=round(len(quarantined.records) / processed_rows, 6),
+            first_error=quarantined.records[0]["error"],
+            quarantine_uri=quarantine_uri,
+        )
+
+    if not batches:
         logger.info("S3 object s3://%s/%s contained no JSON rows", ref.bucket, ref.key)
         return None
 
+    # Zero-copy: the batches become the table's chunks. An oversized object is
+    # therefore held as Arrow columns (not Python rows) until its message is
+    # inserted; arrow_peak_bytes reports how large that got.
+    table = batches[0] if len(batches) == 1 else pa.concat_tables(batches)
+    logger.debug(
+        "Constructed Arrow table with %d rows and schema %s from s3://%s/%s",
+        table.num_rows,
+        table.schema,
+        ref.bucket,
+        ref.key,
+    )
+    logger.info(
+        "Parsed %d rows from s3://%s/%s in %.2fs",
+        table.num_rows,
+        ref.bucket,
+        ref.key,
+        time.perf_counter() - fetch_started,
+    )
+    log_object_parsed(
+        table,
+        ingestion_mode="python",
+        batch_count=len(batches),
+        streamed=oversized,
+        arrow_peak_bytes=peak_arrow_bytes,
+    )
+    return table
+
+
+def _timed_iter(items: Iterable[Any], totals: Dict[str, float], key: str) -> Iterator[Any]:
+    """Yield from ``items`` while adding the time spent waiting on it to ``totals[key]``.
+
+    Also the point where a cancelled prefetch stops reading from S3.
+    """
+    iterator = iter(items)
+    while True:
+        raise_if_fetch_cancelled()
+        started = time.perf_counter()
+        item = next(iterator, None)
+        totals[key] += time.perf_counter() - started
+        if item is None:
+            return
+        yield item
+
+
+def _iter_then_close(items: Iterable[Any], body: Any) -> Iterator[Any]:
+    """Yield from ``items`` and close ``body`` once they are exhausted or abandoned."""
     try:
-        table = pa.Table.from_pylist(rows)
-        table = normalize_table_schema(table)
-        logger.debug(
-            "Constructed Arrow table with %d rows and schema %s from s3://%s/%s",
-            table.num_rows,
-            table.schema,
-            ref.bucket,
-            ref.key,
-        )
-        logger.info(
-            "Parsed %d rows from s3://%s/%s in %.2fs",
-            table.num_rows,
-            ref.bucket,
-            ref.key,
-            time.perf_counter() - fetch_started,
-        )
-        return table
-    except Exception as exc:  # pylint: disable=broad-except
-        raise ValueError(f"Unable to convert rows from s3://{ref.bucket}/{ref.key} into Arrow table") from exc
+        yield from items
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+def _object_size_from_response(response: Dict[str, Any]) -> Optional[int]:
+    """Total object size, reading it from ``ContentRange`` for ranged responses."""
+    content_range = response.get("ContentRange")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    return response.get("ContentLength")
+
+
+class RangedObjectReader:
+    """Download one S3 object as ordered chunks using parallel Range requests.
+
+    The first part is read from the already-open ``first_body``; later parts are
+    fetched by a small pool that stays at most ``concurrency`` parts ahead of
+    the consumer, so parsing starts on early parts while later ones download
+    and memory stays bounded. Parts are pinned to ``etag`` with ``IfMatch``
+    so an overwrite mid-download fails instead of mixing object versions.
+    When the consumer stops early, part downloads still running abort at their
+    next chunk and are waited for, so none outlives the object.
+    """
+
+    def __init__(
+        self,
+        ref: S3ObjectRef,
+        first_body: Any,
+        *,
+        size: int,
+        etag: Optional[str],
+        part_size: int,
+        concurrency: int,
+    ) -> None:
+        self._ref = ref
+        self._first_body = first_body
+        self._size = size
+        self._etag = etag
+        self._part_size = part_size
+        self._concurrency = max(1, concurrency)
+        self._cancelled = threading.Event()
+
+    @property
+    def part_count(self) -> int:
+        return max(1, math.ceil(self._size / self._part_size))
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        executor = ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="s3-range")
+        pending: "deque[Future]" = deque()
+        next_part = 1
+        try:
+            while next_part < self.part_count and len(pending) < self._concurrency:
+                pending.append(executor.submit(self._fetch_part, next_part))
+                next_part += 1
+            first = self._first_body.read(min(self._part_size, self._size))
+            self._check_part_length(0, first)
+            yield first
+            while pending:
+                chunk = pending.popleft().result()
+                if next_part < self.part_count:
+                    pending.append(executor.submit(self._fetch_part, next_part))
+                    next_part += 1
+                yield chunk
+        finally:
+            self._cancelled.set()
+            self._first_body.close()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _fetch_part(self, index: int) -> bytes:
+        start = index * self._part_size
+        end = min(self._size, start + self._part_size) - 1
+        kwargs: Dict[str, Any] = {"Bucket": self._ref.bucket, "Key": self._ref.key, "Range": f"bytes={start}-{end}"}
+        if self._etag:
+            kwargs["IfMatch"] = self._etag
+        body = s3_client.get_object(**kwargs)["Body"]
+        chunks: List[bytes] = []
+        try:
+            for chunk in body.iter_chunks(chunk_size=_S3_READ_CHUNK_BYTES):
+                if self._cancelled.is_set():
+                    raise FetchCancelled()
+                chunks.append(chunk)
+        finally:
+            body.close()
+        data = b"".join(chunks)
+        self._check_part_length(index, data)
+        return data
+
+    def _check_part_length(self, index: int, data: bytes) -> None:
+        start = index * self._part_size
+        expected = min(self._size, start + self._part_size) - start
+        if len(data) != expected:
+            raise ValueError(
+                f"Short read for s3://{self._ref.bucket}/{self._ref.key} part {index}: "
+                f"expected {expected} bytes, got {len(data)}"
+            )
+
+
+def iter_lines_from_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Split byte chunks into lines exactly like botocore's ``StreamingBody.iter_lines``."""
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).splitlines(True)
+        for line in lines[:-1]:
+            yield line.splitlines()[0]
+        pending = lines[-1] if lines else b""
+    if pending:
+        yield pending.splitlines()[0]
+
+
+def detect_object_compression(key: str, content_encoding: Optional[str], head: bytes) -> Optional[str]:
+    """Pick the codec for an S3 object, or None for plain JSONL.
+
+    ``S3_OBJECT_COMPRESSION`` wins when set to a codec or ``none``; in ``auto``
+    mode the object's ``ContentEncoding`` is checked first, then the key suffix,
+    then the leading magic bytes.
+    """
+    configured = resolve_s3_object_compression()
+    if configured != "auto":
+        return None if configured == "none" else configured
+    for token in (content_encoding or "").lower().split(","):
+        codec = _OBJECT_CONTENT_ENCODINGS.get(token.strip())
+        if codec:
+            return codec
+    lowered_key = key.lower()
+    for suffix, codec in _OBJECT_COMPRESSION_SUFFIXES:
+        if lowered_key.endswith(suffix):
+            return codec
+    for magic, codec in _OBJECT_COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+class _ChunkSource(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks."""
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        super().__init__()
+        self._chunks = chunks
+        self._pending = b""
+        self.bytes_read = 0
+        self.wait_seconds = 0.0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        if not self._pending:
+            started = time.perf_counter()
+            self._pending = next(self._chunks, b"")
+            self.wait_seconds += time.perf_counter() - started
+            self.bytes_read += len(self._pending)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+class ObjectDecompressor:
+    """Decode a compressed S3 object chunk by chunk with Arrow's codecs.
+
+    Only one decompressed chunk is held at a time, so a 10x-compressed object
+    never expands in memory. ``decompress_seconds`` excludes time spent waiting
+    on the network for the next compressed chunk.
+    """
+
+    def __init__(self, chunks: Iterator[bytes], codec: str) -> None:
+        self.codec = codec
+        self._source = _ChunkSource(chunks)
+        self.uncompressed_bytes = 0
+        self.decompress_seconds = 0.0
+
+    @property
+    def compressed_bytes(self) -> int:
+        return self._source.bytes_read
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        stream = pa.CompressedInputStream(pa.PythonFile(self._source, mode="r"), self.codec)
+        try:
+            while True:
+                started = time.perf_counter()
+                waited_before = self._source.wait_seconds
+                try:
+                    chunk = stream.read(_S3_READ_CHUNK_BYTES)
+                except (OSError, pa.ArrowException) as exc:
+                    raise ValueError(f"Unable to decompress {self.codec} object: {exc}") from exc
+                self.decompress_seconds += (time.perf_counter() - started) - (
+                    self._source.wait_seconds - waited_before
+                )
+                if not chunk:
+                    return
+                self.uncompressed_bytes += len(chunk)
+                yield chunk
+        finally:
+            stream.close()
+
+
+def _log_object_decompressed(ref: S3ObjectRef, decompressor: ObjectDecompressor) -> None:
+    ratio = decompressor.uncompressed_bytes / decompressor.compressed_bytes if decompressor.compressed_bytes else None
+    log_stage(
+        "object_decompressed",
+        bucket=ref.bucket,
+        key=ref.key,
+        compression=decompressor.codec,
+        compressed_bytes=decompressor.compressed_bytes,
+        uncompressed_bytes=decompressor.uncompressed_bytes,
+        compression_ratio=round(ratio, 2) if ratio is not None else None,
+        decompress_ms=round(decompressor.decompress_seconds * 1000, 3),
+    )
+
+
+def process_max_rss_bytes() -> Optional[int]:
+    """Peak resident set size of this process so far (Linux reports KiB)."""
+    if resource is None:
+        return None
+    return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024
+
+
+@dataclass
+class ArrowReadResult:
+    """Rows read by ``_load_json_lines_with_arrow_reader`` before it finished or gave up."""
+
+    tables: List[pa.Table] = field(default_factory=list)
+    statement_count: int = 0
+    physical_line_count: int = 0
+    # Set when the reader rejected a block: that block's lines and everything
+    # after it, to be parsed on the per-line path.
+    remaining_lines: Optional[Iterator[bytes]] = None
+
+
+def _load_json_lines_with_arrow_reader(
+    ref: S3ObjectRef,
+    chunks: Iterable[bytes],
+    *,
+    etag: Optional[str],
+) -> ArrowReadResult:
+    """Parse a JSONL object with ``pyarrow.json`` and derive raw_events columns.
+
+    The decompressed chunks are read in blocks of whole lines of about
+    ``_ARROW_JSON_BLOCK_BYTES``, so only one block of text is held at a time.
+    When the reader rejects a block (malformed lines or values that match no
+    type of the explicit xAPI schema) the rows read so far are kept and the
+    rest of the object is returned as lines for the per-line path, so errors
+    keep their line number.
+    """
+    source_file = f"s3://{ref.bucket}/{ref.key}"
+    source_etag = _normalize_etag(etag)
+    # Variant kinds that worked for the previous block; objects rarely mix them.
+    kinds: Dict[str, str] = {}
+    read = ArrowReadResult()
+    blocks = _iter_jsonl_blocks(chunks, _ARROW_JSON_BLOCK_BYTES)
+    for block in blocks:
+        physical_lines = block.splitlines()
+        lines = [line for line in physical_lines if line]
+        if lines:
+            try:
+                parsed = _read_json_block(block, len(lines), kinds)
+                table = _derive_raw_events_from_arrow(
+                    parsed,
+                    lines,
+                    source_file=source_file,
+                    source_etag=source_etag,
+                    first_source_line=read.statement_count + 1,
+                )
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.info(
+                    "Arrow JSON reader rejected s3://%s/%s after line %d (%s); falling back to per-line parsing",
+                    ref.bucket,
+                    ref.key,
+                    read.physical_line_count,
+                    exc,
+                )
+                read.remaining_lines = itertools.chain(physical_lines, iter_lines_from_chunks(blocks))
+                return read
+            read.tables.append(table)
+        read.statement_count += len(lines)
+        read.physical_line_count += len(physical_lines)
+    return read
+
+
+def _read_json_block(block: bytes, line_count: int, kinds: Dict[str, str]) -> pa.Table:
+    """Read one block with the xAPI schema, switching variant fields as the reader requires.
+
+    ``pyarrow.json`` cannot read a number as a string or keep a value as raw
+    JSON, so a field in ``_XAPI_ARROW_VARIANT_KINDS`` is read with the type for
+    the kind the reader reports and the block is read again. ``kinds`` is
+    updated in place; a block mixing kinds in one field raises.
+    """
+    tried: Set[Tuple[str, str]] = set()
+    while True:
+        try:
+            parsed = pa_json.read_json(
+                pa.BufferReader(block),
+                parse_options=pa_json.ParseOptions(
+                    explicit_schema=_get_xapi_arrow_schema(kinds),
+                    unexpected_field_behavior="ignore",
+                ),
+            )
+        except pa.ArrowInvalid as exc:
+            change = _ARROW_JSON_KIND_CHANGE_RE.search(str(exc))
+            if change is None:
+                raise
+            path, kind = change.group("path"), change.group("kind")
+            if kind not in _XAPI_ARROW_VARIANT_KINDS.get(path, ()) or (path, kind) in tried:
+                raise
+            tried.add((path, kind))
+            kinds[path] = kind
+            continue
+        if parsed.num_rows != line_count:
+            raise ValueError(f"Arrow JSON reader produced {parsed.num_rows} rows for {line_count} lines")
+        return parsed
+
+
+def _iter_jsonl_blocks(chunks: Iterable[bytes], block_bytes: int) -> Iterator[bytes]:
+    """Regroup byte chunks into blocks of whole lines of about ``block_bytes``.
+
+    Each block ends at the first newline past ``block_bytes``, so
+    ``bytes.splitlines`` on each block gives the same lines as
+    ``iter_lines_from_chunks`` on the whole stream.
+    """
+    parts: List[bytes] = []
+    size = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        # Only a chunk with a newline can complete a block; this keeps a line
+        # longer than a block from being re-joined on every chunk.
+        if size < block_bytes or b"\n" not in chunk:
+            continue
+        data = b"".join(parts)
+        start = 0
+        while len(data) - start >= block_bytes:
+            cut = data.find(b"\n", start + block_bytes - 1) + 1
+            if not cut:
+                break
+            yield data[start:cut]
+            start = cut
+        rest = data[start:]
+        parts = [rest] if rest else []
+        size = len(rest)
+    if size:
+        yield b"".join(parts)
+
+
+def _derive_raw_events_from_arrow(
+    parsed: pa.Table,
+    lines: List[bytes],
+    *,
+    source_file: str,
+    source_etag: Optional[str],
+    first_source_line: int = 1,
+) -> pa.Table:
+    """Compute raw_events columns from a table read with ``_get_xapi_arrow_schema``.
+
+    Mirrors ``_xapi_row_values`` with Arrow compute. JSON-valued fields the reader
+    cannot keep as text (object feedback, responses without an ``input``) are
+    re-serialized in Python for just the rows that carry them.
+    """
+    type_map = _get_clickhouse_type_map()
+    row_count = parsed.num_rows
+
+    def field_of(column: Any, *path: str) -> Any:
+        for name in path:
+            column = pc.struct_field(column, name)
+        return column
+
+    def first_truthy(*candidates: Any) -> Any:
+        # Python's ``a or b``: fall through on null and on "" / 0 values.
+        chosen = candidates[-1]
+        for candidate in reversed(candidates[:-1]):
+            falsy = "" if pa.types.is_string(candidate.type) else 0
+            truthy = pc.fill_null(pc.not_equal(candidate, falsy), False)
+            chosen = pc.if_else(truthy, candidate, chosen)
+        return chosen
+
+    def top_level(name: str) -> "pa.Array":
+        return parsed.column(name).combine_chunks()
+
+    context_ext = field_of(top_level("context"), "extensions")
+    actor = top_level("actor")
+    result = top_level("result")
+    result_ext = field_of(result, "extensions")
+    obj = top_level("object")
+    definition = field_of(obj, "definition")
+
+    def oli(name: str) -> Any:
+        return field_of(context_ext, f"http://oli.cmu.edu/extensions/{name}")
+
+    def video(column: Any, name: str) -> Any:
+        return field_of(column, f"https://w3id.org/xapi/video/extensions/{name}")
+
+    verb_id = pc.fill_null(field_of(top_level("verb"), "id"), "")
+    object_type = pc.fill_null(field_of(definition, "type"), "")
+    event_type = pa.scalar("unknown")
+    for expected_verb, expected_type, label in reversed(_VERB_OBJECT_EVENT_TYPES):
+        matches = pc.and_(pc.equal(verb_id, expected_verb), pc.equal(object_type, expected_type))
+        event_type = pc.if_else(matches, label, event_type)
+    event_type = pc.if_else(pc.is_in(verb_id, pa.array(sorted(_VIDEO_VERBS))), "video", event_type)
+
+    account_name = field_of(actor, "account", "name")
+    # Python's ``name or mbox`` for a numeric or a string name; 0 is falsy as well.
+    account_falsy = "" if pa.types.is_string(account_name.type) else 0
+    account_truthy = pc.fill_null(pc.not_equal(account_name, account_falsy), False)
+    user_id = pc.if_else(account_truthy, pc.cast(account_name, pa.string()), field_of(actor, "mbox"))
+
+    timestamp_text = pc.utf8_trim_whitespace(top_level("timestamp"))
+    timestamp_text = pc.if_else(pc.equal(timestamp_text, ""), pa.scalar(None, pa.string()), timestamp_text)
+
+    # String-valued responses and feedback are used as they are.
+    no_rows = pa.repeat(False, row_count)
+    response = field_of(result, "response")
+    response_needs_python = no_rows
+    if pa.types.is_struct(response.type):
+        response_struct = response
+        response_input = field_of(response_struct, "input")
+        response_has_input = pc.fill_null(pc.not_equal(response_input, ""), False)
+        response = pc.if_else(response_has_input, response_input, pa.scalar(None, pa.string()))
+        response_needs_python = pc.and_(pc.is_valid(response_struct), pc.invert(response_has_input))
+    feedback = field_of(result_ext, "http://oli.cmu.edu/extensions/feedback")
+    feedback_needs_python = no_rows
+    if pa.types.is_struct(feedback.type):
+        feedback_needs_python = pc.is_valid(feedback)
+        feedback = pa.nulls(row_count, pa.string())
+    response, feedback = _reserialize_json_valued_columns(
+        lines,
+        response=response,
+        response_mask=response_needs_python,
+        feedback=feedback,
+        feedback_mask=feedback_needs_python,
+    )
+
+    attached = oli("attached_objectives")
+    attached_objectives = pc.binary_join_element_wise(
+        "[", pc.binary_join(pc.cast(attached, pa.list_(pa.string())), ", "), "]", ""
+    )
+
+    columns: Dict[str, Any] = {
+        "user_id": user_id,
+        "home_page": field_of(actor, "account", "homePage"),
+        "section_id": oli("section_id"),
+        "project_id": oli("project_id"),
+        "publication_id": oli("publication_id"),
+        "timestamp": _build_timestamp_array(timestamp_text, type_map["timestamp"]),
+        "event_type": event_type,
+        "verb_id": verb_id,
+        "page_id": oli("page_id"),
+        "content_element_id": first_truthy(field_of(result_ext, "content_element_id"), oli("content_element_id")),
+        "video_url": pc.if_else(pc.equal(event_type, "video"), field_of(obj, "id"), pa.scalar(None, pa.string())),
+        "video_time": video(result_ext, "time"),
+        "video_length": first_truthy(
+            video(result_ext, "length"),
+            video(context_ext, "length"),
+            video(field_of(definition, "extensions"), "length"),
+        ),
+        "video_progress": video(result_ext, "progress"),
+        "video_played_segments": video(result_ext, "played-segments"),
+        "video_seek_from": video(result_ext, "time-from"),
+        "video_seek_to": video(result_ext, "time-to"),
+        "activity_attempt_guid": oli("activity_attempt_guid"),
+        "activity_attempt_number": oli("activity_attempt_number"),
+        "page_attempt_guid": oli("page_attempt_guid"),
+        "page_attempt_number": oli("page_attempt_number"),
+        "part_attempt_guid": oli("part_attempt_guid"),
+        "part_attempt_number": oli("part_attempt_number"),
+        "activity_id": oli("activity_id"),
+        "activity_revision_id": oli("activity_revision_id"),
+        "part_id": oli("part_id"),
+        "page_sub_type": field_of(definition, "subType"),
+        "score": field_of(result, "score", "raw"),
+        "out_of": field_of(result, "score", "max"),
+        "scaled_score": field_of(result, "score", "scaled"),
+        "success": field_of(result, "success"),
+        "completion": field_of(result, "completion"),
+        "response": response,
+        "feedback": feedback,
+        "hints_requested": pc.list_value_length(oli("hints_requested")),
+        "attached_objectives": attached_objectives,
+        "session_id": oli("session_id"),
+        "event_hash": compute_event_hashes(lines),
+        "source_file": pa.repeat(pa.scalar(source_file, pa.string()), row_count),
+        "source_etag": pa.repeat(pa.scalar(source_etag, pa.string()), row_count),
+        "source_line": pa.array(range(first_source_line, first_source_line + row_count), type=pa.uint32()),
+    }
+
+    arrays = []
+    for column_name in DEFAULT_CLICKHOUSE_INSERT_COLUMNS:
+        column = columns[column_name]
+        if isinstance(column, pa.Scalar):
+            column = pa.repeat(column, row_count)
+        expected_type = type_map[column_name]
+        if not column.type.equals(expected_type):
+            column = column.cast(expected_type)
+        arrays.append(column)
+    return pa.Table.from_arrays(arrays, names=DEFAULT_CLICKHOUSE_INSERT_COLUMNS)
+
+
+def _reserialize_json_valued_columns(
+    lines: List[bytes],
+    *,
+    response: Any,
+    response_mask: Any,
+    feedback: Any,
+    feedback_mask: Any,
+) -> Tuple[Any, Any]:
+    response_mask = pc.fill_null(response_mask, False)
+    feedback_mask = pc.fill_null(feedback_mask, False)
+    needs_python = pc.or_(response_mask, feedback_mask)
+    if not pc.any(needs_python).as_py():
+        return response, feedback
+
+    response_flags = response_mask.to_pylist()
+    feedback_flags = feedback_mask.to_pylist()
+    response_values: List[Optional[str]] = []
+    feedback_values: List[Optional[str]] = []
+    for index in pc.indices_nonzero(needs_python).to_pylist():
+        result = json.loads(lines[index]).get("result", {}) or {}
+        if response_flags[index]:
+            response_values.append(_response_value(result))
+        if feedback_flags[index]:
+            feedback_values.append(_feedback_value(result.get("extensions", {}) or {}))
+
+    if response_values:
+        response = pc.replace_with_mask(response, response_mask, pa.array(response_values, type=pa.string()))
+    if feedback_values:
+        feedback = pc.replace_with_mask(feedback, feedback_mask, pa.array(feedback_values, type=pa.string()))
+    return response, feedback
 
 
 def concatenate_tables(tables: List[pa.Table]) -> pa.Table:
@@ -763,12 +2526,155 @@ def concatenate_tables(tables: List[pa.Table]) -> pa.Table:
     return pa.concat_tables(tables, promote_options="default")
 
 
-def table_to_parquet(table: pa.Table) -> bytes:
-    ensure_pyarrow_available()
-    compression = os.getenv("PARQUET_COMPRESSION", "snappy")
-    buffer = io.BytesIO()
-    pq.write_table(table, buffer, compression=compression)
-    return buffer.getvalue()
+def table_to_parquet(table: pa.Table) -> bytes:
+    ensure_pyarrow_available()
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=resolve_parquet_compression())
+    return buffer.getvalue()
+
+
+def table_to_arrow_stream(table: pa.Table) -> bytes:
+    ensure_pyarrow_available()
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def table_to_arrow_file(table: pa.Table) -> bytes:
+    ensure_pyarrow_available()
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _open_parquet_writer(sink: Any, schema: "pa.Schema") -> Any:
+    return pq.ParquetWriter(sink, schema, compression=resolve_parquet_compression())
+
+
+def _open_arrow_stream_writer(sink: Any, schema: "pa.Schema") -> Any:
+    return pa.ipc.new_stream(sink, schema)
+
+
+def _open_arrow_file_writer(sink: Any, schema: "pa.Schema") -> Any:
+    return pa.ipc.new_file(sink, schema)
+
+
+@dataclass(frozen=True)
+class InsertFormat:
+    """ClickHouse input format together with the encoders that produce it.
+
+    ``encode`` serializes a whole table into request-body bytes and
+    ``open_writer`` returns an incremental writer (``write_table``/``close``)
+    used by ``StreamingInsertPayload``.
+    """
+
+    name: str
+    encode: Callable[["pa.Table"], bytes]
+    open_writer: Callable[[Any, "pa.Schema"], Any]
+
+
+INSERT_FORMATS: Dict[str, InsertFormat] = {
+    insert_format.name.lower(): insert_format
+    for insert_format in (
+        InsertFormat("Parquet", table_to_parquet, _open_parquet_writer),
+        InsertFormat("ArrowStream", table_to_arrow_stream, _open_arrow_stream_writer),
+        InsertFormat("Arrow", table_to_arrow_file, _open_arrow_file_writer),
+    )
+}
+
+
+def resolve_insert_format() -> InsertFormat:
+    raw_value = os.getenv("CLICKHOUSE_INSERT_FORMAT", "Parquet").strip()
+    insert_format = INSERT_FORMATS.get(raw_value.lower())
+    if insert_format is None:
+        raise ValueError(
+            f"Unsupported CLICKHOUSE_INSERT_FORMAT {raw_value!r}; expected one of "
+            + ", ".join(fmt.name for fmt in INSERT_FORMATS.values())
+        )
+    return insert_format
+
+
+def serialize_table(table: pa.Table, insert_format: Optional[InsertFormat] = None) -> bytes:
+    return (insert_format or resolve_insert_format()).encode(table)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back in chunks."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._parts: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        chunk = bytes(data)
+        self._parts.append(chunk)
+        return len(chunk)
+
+    def drain(self) -> bytes:
+        chunk = b"".join(self._parts)
+        self._parts.clear()
+        return chunk
+
+
+class StreamingInsertPayload:
+    """Request body that encodes a table one row group (or record batch) at a time.
+
+    Iterating yields each row group as soon as it is written, so requests sends
+    the body with chunked transfer encoding and peak payload memory stays around
+    one row group instead of the full serialized sub-batch. ``on_complete`` runs
+    once the footer has been produced.
+    """
+
+    def __init__(
+        self,
+        table: pa.Table,
+        *,
+        row_group_rows: int,
+        insert_format: Optional[InsertFormat] = None,
+        on_complete: Optional[Callable[["StreamingInsertPayload"], None]] = None,
+    ) -> None:
+        self._table = table
+        self._row_group_rows = max(1, row_group_rows)
+        self._insert_format = insert_format or resolve_insert_format()
+        self._on_complete = on_complete
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+        self.completed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        ensure_pyarrow_available()
+        sink = _ChunkSink()
+        started = time.perf_counter()
+        writer = self._insert_format.open_writer(sink, self._table.schema)
+        for offset in range(0, self._table.num_rows, self._row_group_rows):
+            writer.write_table(self._table.slice(offset, self._row_group_rows))
+            chunk = sink.drain()
+            self.encode_seconds += time.perf_counter() - started
+            if chunk:
+                self.bytes_written += len(chunk)
+                yield chunk
+            started = time.perf_counter()
+        writer.close()
+        chunk = sink.drain()
+        self.encode_seconds += time.perf_counter() - started
+        self.completed = True
+        if chunk:
+            self.bytes_written += len(chunk)
+        if self._on_complete is not None:
+            self._on_complete(self)
+        if chunk:
+            yield chunk
+
+
+def payload_size_bytes(payload: Union[bytes, StreamingInsertPayload]) -> int:
+    if isinstance(payload, StreamingInsertPayload):
+        return payload.bytes_written
+    return len(payload)
 
 
 def normalize_table_schema(table: pa.Table) -> pa.Table:
@@ -791,18 +2697,46 @@ def normalize_table_schema(table: pa.Table) -> pa.Table:
     return _project_table_to_clickhouse_columns(table)
 
 
-def _coerce_iso8601_timestamp_column(column: pa.ChunkedArray) -> pa.Array:
-    ensure_pyarrow_available()
-    values = column.to_pylist()
-    parsed: List[Optional[datetime]] = []
-    for raw in values:
-        if raw is None:
-            parsed.append(None)
-            continue
-        parsed.append(_parse_iso8601_timestamp(raw))
+# Offset-qualified ISO-8601 timestamps that Arrow's cast parser accepts once the
+# fractional part is trimmed to microseconds. Anything else takes the Python path.
+_ISO8601_FAST_PATH_PATTERN = r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:?\d{2})$"
+
 
+def _coerce_iso8601_timestamp_column(column: Any) -> pa.Array:
+    """Parse ISO-8601 strings into UTC millisecond timestamps.
+
+    Well-formed values are converted in bulk with Arrow compute; only the rows the
+    fast path rejects (naive or unusual layouts, invalid dates) are handed to
+    ``_parse_iso8601_timestamp``.
+    """
+    ensure_pyarrow_available()
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if pa.types.is_null(column.type):
+        column = column.cast(pa.string())
+    target_type = pa.timestamp("ms", tz="UTC")
+
+    text = pc.utf8_trim_whitespace(column)
+    fast_mask = pc.fill_null(pc.match_substring_regex(text, _ISO8601_FAST_PATH_PATTERN), False)
+    # Match the Python parser, which truncates fractions beyond microseconds.
+    trimmed = pc.replace_substring_regex(text, r"(\.\d{6})\d+", r"\1")
+    try:
+        fast_values = pc.if_else(fast_mask, trimmed, pa.scalar(None, pa.string()))
+        micros = fast_values.cast(pa.timestamp("us", tz="UTC"))
+        converted = pc.floor_temporal(micros, unit="millisecond").cast(target_type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # e.g. an out-of-range month; let the Python parser report the bad value.
+        fast_mask = pa.repeat(pa.scalar(False), len(column))
+        converted = pa.nulls(len(column), target_type)
+
+    slow_mask = pc.and_(pc.invert(fast_mask), pc.is_valid(column))
+    if not pc.any(slow_mask).as_py():
+        return converted
+
+    slow_values = pc.filter(column, slow_mask).to_pylist()
+    parsed = [_parse_iso8601_timestamp(raw) for raw in slow_values]
     # Normalize everything to UTC millisecond precision to match ClickHouse DateTime64(3)
-    return pa.array(parsed, type=pa.timestamp("ms", tz="UTC"))
+    return pc.replace_with_mask(converted, slow_mask, pa.array(parsed, type=target_type))
 
 
 def _parse_iso8601_timestamp(raw: Any) -> datetime:
@@ -925,9 +2859,211 @@ def _get_clickhouse_type_map() -> Dict[str, "pa.DataType"]:
             "source_etag": pa.string(),
             "source_line": pa.uint32(),
         }
+    hash_type = resolve_event_hash_spec().arrow_type
+    if not _CLICKHOUSE_TYPE_MAP["event_hash"].equals(hash_type):
+        _CLICKHOUSE_TYPE_MAP = {**_CLICKHOUSE_TYPE_MAP, "event_hash": hash_type}
     return _CLICKHOUSE_TYPE_MAP
 
 
+def _get_xapi_arrow_schema(kinds: Optional[Dict[str, str]] = None) -> "pa.Schema":
+    """Explicit nested schema for the xAPI fields read by ``_xapi_row_values``.
+
+    Types follow what Torus emits. ``kinds`` picks the JSON kind read for each
+    field in ``_XAPI_ARROW_VARIANT_KINDS`` (a numeric or string account name,
+    an object or string response and feedback). Values matching none of the
+    types (for example string-valued ids) are rejected by the reader and take
+    the per-line path instead.
+    """
+    ensure_pyarrow_available()
+    chosen = {path: options[0] for path, options in _XAPI_ARROW_VARIANT_KINDS.items()}
+    chosen.update(kinds or {})
+    cache_key = tuple(sorted(chosen.items()))
+    schema = _XAPI_ARROW_SCHEMAS.get(cache_key)
+    if schema is None:
+        oli = "http://oli.cmu.edu/extensions/"
+        video = "https://w3id.org/xapi/video/extensions/"
+        variant_types = {
+            "/actor/account/name": {"number": pa.int64(), "string": pa.string()},
+            "/result/response": {"object": pa.struct([("input", pa.string())]), "string": pa.string()},
+            # Only presence of an object is read; its value is re-serialized in Python.
+            f"/result/extensions/{oli}feedback": {"object": pa.struct([]), "string": pa.string()},
+        }
+
+        def variant(path: str) -> "pa.DataType":
+            return variant_types[path][chosen[path]]
+
+        schema = pa.schema(
+            [
+                (
+                    "actor",
+                    pa.struct(
+                        [
+                            ("mbox", pa.string()),
+                            (
+                                "account",
+                                pa.struct([("name", variant("/actor/account/name")), ("homePage", pa.string())]),
+                            ),
+                        ]
+                    ),
+                ),
+                ("verb", pa.struct([("id", pa.string())])),
+                (
+                    "object",
+                    pa.struct(
+                        [
+                            ("id", pa.string()),
+                            (
+                                "definition",
+                                pa.struct(
+                                    [
+                                        ("type", pa.string()),
+                                        ("subType", pa.string()),
+                                        ("extensions", pa.struct([(f"{video}length", pa.float64())])),
+                                    ]
+                                ),
+                            ),
+                        ]
+                    ),
+                ),
+                (
+                    "result",
+                    pa.struct(
+                        [
+                            ("success", pa.bool_()),
+                            ("completion", pa.bool_()),
+                            ("response", variant("/result/response")),
+                            (
+                                "score",
+                                pa.struct(
+                                    [("raw", pa.float64()), ("max", pa.float64()), ("scaled", pa.float64())]
+                                ),
+                            ),
+                            (
+                                "extensions",
+                                pa.struct(
+                                    [
+                                        ("content_element_id", pa.string()),
+                                        (f"{video}time", pa.float64()),
+                                        (f"{video}length", pa.float64()),
+                                        (f"{video}progress", pa.float64()),
+                                        (f"{video}played-segments", pa.string()),
+                                        (f"{video}time-from", pa.float64()),
+                                        (f"{video}time-to", pa.float64()),
+                                        (f"{oli}feedback", variant(f"/result/extensions/{oli}feedback")),
+                                    ]
+                                ),
+                            ),
+                        ]
+                    ),
+                ),
+                (
+                    "context",
+                    pa.struct(
+                        [
+                            (
+                                "extensions",
+                                pa.struct(
+                                    [
+                                        (f"{oli}section_id", pa.int64()),
+                                        (f"{oli}project_id", pa.int64()),
+                                        (f"{oli}publication_id", pa.int64()),
+                                        (f"{oli}page_id", pa.int64()),
+                                        (f"{oli}content_element_id", pa.string()),
+                                        (f"{oli}activity_attempt_guid", pa.string()),
+                                        (f"{oli}activity_attempt_number", pa.int64()),
+                                        (f"{oli}page_attempt_guid", pa.string()),
+                                        (f"{oli}page_attempt_number", pa.int64()),
+                                        (f"{oli}part_attempt_guid", pa.string()),
+                                        (f"{oli}part_attempt_number", pa.int64()),
+                                        (f"{oli}activity_id", pa.int64()),
+                                        (f"{oli}activity_revision_id", pa.int64()),
+                                        (f"{oli}part_id", pa.string()),
+                                        (f"{oli}session_id", pa.string()),
+                                        (f"{oli}hints_requested", pa.list_(pa.string())),
+                                        (f"{oli}attached_objectives", pa.list_(pa.int64())),
+                                        (f"{video}length", pa.float64()),
+                                    ]
+                                ),
+                            )
+                        ]
+                    ),
+                ),
+                ("timestamp", pa.string()),
+            ]
+        )
+        _XAPI_ARROW_SCHEMAS[cache_key] = schema
+    return schema
+
+
+def _sha256_digest(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def _blake2b128_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+@dataclass(frozen=True)
+class EventHashSpec:
+    mode: str
+    output: str
+    digest: Callable[[bytes], bytes]
+    digest_size: int
+
+    @property
+    def arrow_type(self) -> "pa.DataType":
+        if self.output == "binary":
+            return pa.binary(self.digest_size)
+        return pa.string()
+
+
+def resolve_event_hash_spec() -> EventHashSpec:
+    mode = os.getenv("EVENT_HASH_MODE", "sha256").strip().lower()
+    output = os.getenv("EVENT_HASH_OUTPUT", "hex").strip().lower()
+    if output not in {"hex", "binary"}:
+        raise ValueError(f"Unsupported EVENT_HASH_OUTPUT: {output}")
+    if mode == "sha256":
+        return EventHashSpec(mode, output, _sha256_digest, 32)
+    if mode == "blake2b128":
+        return EventHashSpec(mode, output, _blake2b128_digest, 16)
+    if mode == "xxh3_128":
+        if xxhash is None:
+            raise RuntimeError(
+                "EVENT_HASH_MODE=xxh3_128 requires the xxhash package; install it from the optional "
+                "section of requirements.txt"
+            )
+        return EventHashSpec(mode, output, xxhash.xxh3_128_digest, 16)
+    raise ValueError(f"Unsupported EVENT_HASH_MODE: {mode}")
+
+
+def event_hash_value(raw_bytes: bytes) -> Any:
+    """Hash a single raw line the way ``compute_event_hashes`` would."""
+    spec = resolve_event_hash_spec()
+    digest = spec.digest(raw_bytes)
+    return digest if spec.output == "binary" else digest.hex()
+
+
+def compute_event_hashes(lines: List[bytes]) -> "pa.Array":
+    """Hash raw JSON lines into an ``event_hash`` array using the configured mode."""
+    spec = resolve_event_hash_spec()
+    digest = spec.digest
+    return _event_hash_array_from_digests([digest(line) for line in lines], spec)
+
+
+def _event_hash_array_from_digests(digests: List[bytes], spec: EventHashSpec) -> "pa.Array":
+    # Build the array straight from one joined buffer instead of one Python
+    # object per row; every digest (and its hex form) has the same width.
+    count = len(digests)
+    joined = b"".join(digests)
+    if spec.output == "binary":
+        return pa.Array.from_buffers(spec.arrow_type, count, [None, pa.py_buffer(joined)])
+    width = spec.digest_size * 2
+    offsets = pa.array(range(0, (count + 1) * width, width), type=pa.int32())
+    return pa.Array.from_buffers(
+        pa.string(), count, [None, offsets.buffers()[1], pa.py_buffer(joined.hex().encode("ascii"))]
+    )
+
+
 def transform_xapi_statement(
     statement: Dict[str, Any],
     *,
@@ -938,6 +3074,92 @@ def transform_xapi_statement(
     line_number: int,
 ) -> Dict[str, Any]:
     """Map an xAPI statement into the raw_events column structure."""
+    values = _xapi_row_values(
+        statement,
+        event_hash=event_hash_value(raw_bytes),
+        source_file=f"s3://{bucket}/{key}",
+        source_etag=_normalize_etag(etag),
+        line_number=line_number,
+    )
+    return dict(zip(DEFAULT_CLICKHOUSE_INSERT_COLUMNS, values))
+
+
+class XapiColumnBuilder:
+    """Accumulate transformed xAPI statements directly into per-column buffers.
+
+    Columns follow ``DEFAULT_CLICKHOUSE_INSERT_COLUMNS`` and are materialized
+    with the explicit types from ``_get_clickhouse_type_map`` so the resulting
+    table needs neither schema inference nor a second cast pass.
+    """
+
+    def __init__(self, *, bucket: str, key: str, etag: Optional[str]) -> None:
+        ensure_pyarrow_available()
+        self._source_file = f"s3://{bucket}/{key}"
+        self._source_etag = _normalize_etag(etag)
+        self._buffers: List[List[Any]] = [[] for _ in DEFAULT_CLICKHOUSE_INSERT_COLUMNS]
+        self._appenders = [buffer.append for buffer in self._buffers]
+        self._hash_spec = resolve_event_hash_spec()
+        self.num_rows = 0
+
+    def append(self, statement: Dict[str, Any], *, raw_bytes: bytes, line_number: int) -> None:
+        # Raw digests are collected here and turned into one array in ``finish``.
+        values = _xapi_row_values(
+            statement,
+            event_hash=self._hash_spec.digest(raw_bytes),
+            source_file=self._source_file,
+            source_etag=self._source_etag,
+            line_number=line_number,
+        )
+        for append, value in zip(self._appenders, values):
+            append(value)
+        self.num_rows += 1
+
+    def finish(self) -> "pa.Table":
+        type_map = _get_clickhouse_type_map()
+        arrays = []
+        for column_name, buffer in zip(DEFAULT_CLICKHOUSE_INSERT_COLUMNS, self._buffers):
+            if column_name == "timestamp":
+                arrays.append(
+                    _build_timestamp_array(pa.array(buffer, type=pa.string()), type_map[column_name])
+                )
+            elif column_name == "event_hash":
+                arrays.append(_event_hash_array_from_digests(buffer, self._hash_spec))
+            else:
+                arrays.append(pa.array(buffer, type=type_map[column_name]))
+            buffer.clear()
+        self.num_rows = 0
+        return pa.Table.from_arrays(arrays, names=DEFAULT_CLICKHOUSE_INSERT_COLUMNS)
+
+
+def _build_timestamp_array(raw: "pa.Array", expected_type: "pa.DataType") -> "pa.Array":
+    try:
+        return _coerce_iso8601_timestamp_column(raw)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.warning(
+            "Failed to coerce timestamp column to Arrow timestamp: %s",
+            exc,
+        )
+    try:
+        return raw.cast(expected_type)
+    except Exception as exc:  # pylint: disable=broad-except
+        raise ValueError(
+            f"Column 'timestamp' cannot be cast from {raw.type} to {expected_type}"
+        ) from exc
+
+
+def _normalize_etag(etag: Optional[str]) -> Optional[str]:
+    return etag.strip('"') if isinstance(etag, str) else etag
+
+
+def _xapi_row_values(
+    statement: Dict[str, Any],
+    *,
+    event_hash: Any,
+    source_file: str,
+    source_etag: Optional[str],
+    line_number: int,
+) -> Tuple[Any, ...]:
+    """Return raw_events values in ``DEFAULT_CLICKHOUSE_INSERT_COLUMNS`` order."""
 
     context = statement.get("context", {}) or {}
     extensions = context.get("extensions", {}) or {}
@@ -1009,15 +3231,8 @@ def transform_xapi_statement(
     if session_id is not None and not isinstance(session_id, str):
         session_id = str(session_id)
 
-    feedback = result_extensions.get("http://oli.cmu.edu/extensions/feedback")
-    if feedback is not None and not isinstance(feedback, str):
-        feedback = json.dumps(feedback)
-
-    response_value = result.get("response")
-    if isinstance(response_value, dict):
-        response_value = response_value.get("input") or json.dumps(response_value)
-    elif response_value is not None and not isinstance(response_value, str):
-        response_value = str(response_value)
+    feedback = _feedback_value(result_extensions)
+    response_value = _response_value(result)
 
     attached_objectives = extensions.get("http://oli.cmu.edu/extensions/attached_objectives")
     if attached_objectives is not None and not isinstance(attached_objectives, str):
@@ -1029,106 +3244,130 @@ def transform_xapi_statement(
     else:
         hints_requested_value = _safe_int(hints_requested)
 
-    raw_hash = hashlib.sha256(raw_bytes).hexdigest()
-
-    transformed: Dict[str, Any] = {
-        "user_id": user_id,
-        "home_page": home_page,
-        "section_id": section_id,
-        "project_id": project_id,
-        "publication_id": publication_id,
-        "timestamp": timestamp_raw,
-        "event_type": event_type,
-        "verb_id": verb_id,
-        "page_id": _safe_int(extensions.get("http://oli.cmu.edu/extensions/page_id")),
-        "content_element_id": content_element_id,
-        "video_url": video_url,
-        "video_time": _safe_float(result_extensions.get("https://w3id.org/xapi/video/extensions/time")),
-        "video_length": _safe_float(
+    # Order must match DEFAULT_CLICKHOUSE_INSERT_COLUMNS.
+    return (
+        user_id,
+        home_page,
+        section_id,
+        project_id,
+        publication_id,
+        timestamp_raw,  # timestamp
+        event_type,
+        verb_id,
+        _safe_int(extensions.get("http://oli.cmu.edu/extensions/page_id")),  # page_id
+        content_element_id,
+        video_url,
+        _safe_float(result_extensions.get("https://w3id.org/xapi/video/extensions/time")),  # video_time
+        _safe_float(  # video_length
             result_extensions.get("https://w3id.org/xapi/video/extensions/length")
             or extensions.get("https://w3id.org/xapi/video/extensions/length")
             or object_extensions.get("https://w3id.org/xapi/video/extensions/length")
         ),
-        "video_progress": _safe_float(
+        _safe_float(  # video_progress
             result_extensions.get("https://w3id.org/xapi/video/extensions/progress")
         ),
-        "video_played_segments": video_played_segments,
-        "video_seek_from": _safe_float(
+        video_played_segments,
+        _safe_float(  # video_seek_from
             result_extensions.get("https://w3id.org/xapi/video/extensions/time-from")
         ),
-        "video_seek_to": _safe_float(
+        _safe_float(  # video_seek_to
             result_extensions.get("https://w3id.org/xapi/video/extensions/time-to")
         ),
-        "activity_attempt_guid": activity_attempt_guid,
-        "activity_attempt_number": _safe_int(
+        activity_attempt_guid,
+        _safe_int(  # activity_attempt_number
             extensions.get("http://oli.cmu.edu/extensions/activity_attempt_number")
         ),
-        "page_attempt_guid": page_attempt_guid,
-        "page_attempt_number": _safe_int(
+        page_attempt_guid,
+        _safe_int(  # page_attempt_number
             extensions.get("http://oli.cmu.edu/extensions/page_attempt_number")
         ),
-        "part_attempt_guid": part_attempt_guid,
-        "part_attempt_number": _safe_int(
+        part_attempt_guid,
+        _safe_int(  # part_attempt_number
             extensions.get("http://oli.cmu.edu/extensions/part_attempt_number")
         ),
-        "activity_id": _safe_int(extensions.get("http://oli.cmu.edu/extensions/activity_id")),
-        "activity_revision_id": _safe_int(
+        _safe_int(extensions.get("http://oli.cmu.edu/extensions/activity_id")),  # activity_id
+        _safe_int(  # activity_revision_id
             extensions.get("http://oli.cmu.edu/extensions/activity_revision_id")
         ),
-        "part_id": part_id,
-        "page_sub_type": object_definition.get("subType"),
-        "score": _safe_float(_get_nested(result, ["score", "raw"])),
-        "out_of": _safe_float(_get_nested(result, ["score", "max"])),
-        "scaled_score": _safe_float(_get_nested(result, ["score", "scaled"])),
-        "success": _coerce_bool(result.get("success")),
-        "completion": _coerce_bool(result.get("completion")),
-        "response": response_value,
-        "feedback": feedback,
-        "hints_requested": hints_requested_value,
-        "attached_objectives": attached_objectives,
-        "session_id": session_id,
-        "event_hash": raw_hash,
-        "source_file": f"s3://{bucket}/{key}",
-        "source_etag": etag.strip('"') if isinstance(etag, str) else etag,
-        "source_line": line_number,
-    }
+        part_id,
+        object_definition.get("subType"),  # page_sub_type
+        _safe_float(_get_nested(result, ["score", "raw"])),  # score
+        _safe_float(_get_nested(result, ["score", "max"])),  # out_of
+        _safe_float(_get_nested(result, ["score", "scaled"])),  # scaled_score
+        _coerce_bool(result.get("success")),  # success
+        _coerce_bool(result.get("completion")),  # completion
+        response_value,  # response
+        feedback,
+        hints_requested_value,  # hints_requested
+        attached_objectives,
+        session_id,
+        event_hash,
+        source_file,
+        source_etag,
+        line_number,
+    )
 
-    return transformed
 
+def _feedback_value(result_extensions: Dict[str, Any]) -> Optional[str]:
+    feedback = result_extensions.get("http://oli.cmu.edu/extensions/feedback")
+    if feedback is not None and not isinstance(feedback, str):
+        feedback = json.dumps(feedback)
+    return feedback
 
-def _determine_event_type(verb_id: str, object_type: str) -> str:
-    verb_id = verb_id or ""
-    object_type = object_type or ""
 
-    video_verbs = {
+def _response_value(result: Dict[str, Any]) -> Optional[str]:
+    response_value = result.get("response")
+    if isinstance(response_value, dict):
+        response_value = response_value.get("input") or json.dumps(response_value)
+    elif response_value is not None and not isinstance(response_value, str):
+        response_value = str(response_value)
+    return response_value
+
+
+_VIDEO_VERBS = frozenset(
+    {
         "https://w3id.org/xapi/video/verbs/played",
         "https://w3id.org/xapi/video/verbs/paused",
         "https://w3id.org/xapi/video/verbs/seeked",
         "https://w3id.org/xapi/video/verbs/completed",
         "http://adlnet.gov/expapi/verbs/experienced",
     }
-    if verb_id in video_verbs:
+)
+
+# (verb_id, object definition type, event_type) evaluated after the video verbs.
+_VERB_OBJECT_EVENT_TYPES = [
+    (
+        "http://adlnet.gov/expapi/verbs/completed",
+        "http://oli.cmu.edu/extensions/activity_attempt",
+        "activity_attempt",
+    ),
+    (
+        "http://adlnet.gov/expapi/verbs/completed",
+        "http://oli.cmu.edu/extensions/page_attempt",
+        "page_attempt",
+    ),
+    (
+        "http://id.tincanapi.com/verb/viewed",
+        "http://oli.cmu.edu/extensions/types/page",
+        "page_viewed",
+    ),
+    (
+        "http://adlnet.gov/expapi/verbs/completed",
+        "http://adlnet.gov/expapi/activities/question",
+        "part_attempt",
+    ),
+]
+
+
+def _determine_event_type(verb_id: str, object_type: str) -> str:
+    verb_id = verb_id or ""
+    object_type = object_type or ""
+
+    if verb_id in _VIDEO_VERBS:
         return "video"
-    if (
-        verb_id == "http://adlnet.gov/expapi/verbs/completed"
-        and object_type == "http://oli.cmu.edu/extensions/activity_attempt"
-    ):
-        return "activity_attempt"
-    if (
-        verb_id == "http://adlnet.gov/expapi/verbs/completed"
-        and object_type == "http://oli.cmu.edu/extensions/page_attempt"
-    ):
-        return "page_attempt"
-    if (
-        verb_id == "http://id.tincanapi.com/verb/viewed"
-        and object_type == "http://oli.cmu.edu/extensions/types/page"
-    ):
-        return "page_viewed"
-    if (
-        verb_id == "http://adlnet.gov/expapi/verbs/completed"
-        and object_type == "http://adlnet.gov/expapi/activities/question"
-    ):
-        return "part_attempt"
+    for expected_verb, expected_type, event_type in _VERB_OBJECT_EVENT_TYPES:
+        if verb_id == expected_verb and object_type == expected_type:
+            return event_type
     return "unknown"
 
 
@@ -1215,24 +3454,64 @@ def _extract_hostname(url: str) -> Optional[str]:
         return None
 
 
+class ClickHouseInsertError(RuntimeError):
+    """ClickHouse answered an insert with an HTTP error status."""
+
+    def __init__(self, status_code: int, response_text: str) -> None:
+        super().__init__(f"ClickHouse insert failed with status {status_code}: {response_text}")
+        self.status_code = status_code
+
+
+@dataclass(frozen=True)
+class InsertResult:
+    summary: Dict[str, Any]
+    content_encoding: str
+    wire_bytes: int
+    duration_seconds: float
+
+
 def insert_into_clickhouse(
-    parquet_payload: bytes,
+    payload: Union[bytes, Iterable[bytes]],
     row_count: int,
     *,
     timeout_seconds: Optional[float] = None,
     insert_token: Optional[str] = None,
-) -> None:
+) -> InsertResult:
+    """POST an encoded sub-batch, compressing the body if configured."""
     url = resolve_clickhouse_url()
     query = build_insert_query()
     params = {"query": query}
     params.update(parse_clickhouse_settings())
+    if insert_token and env_flag("CLICKHOUSE_INSERT_DEDUPLICATION", default=True):
+        params["insert_deduplication_token"] = insert_token
 
     timeout = timeout_seconds or float(os.getenv("CLICKHOUSE_TIMEOUT_SECONDS", "30"))
     headers = {"Content-Type": "application/octet-stream"}
     if insert_token:
         headers["X-Insert-Token"] = insert_token
 
-    logger.debug("Sending %d rows to ClickHouse via %s", row_count, url)
+    content_encoding = resolve_http_compression()
+    chunks: Optional[Iterator[bytes]] = None
+    if content_encoding == "auto":
+        chunks = _iter_payload_chunks(payload)
+        first_chunk = next(chunks, b"")
+        chunks = itertools.chain([first_chunk], chunks)
+        content_encoding = choose_http_compression(bytes(first_chunk[:_AUTO_COMPRESSION_SAMPLE_BYTES]))
+
+    body: Union[bytes, Iterable[bytes]]
+    counted: Optional[_CountingBody] = None
+    if content_encoding != "none":
+        ensure_pyarrow_available()
+        headers["Content-Encoding"] = content_encoding
+        counted = CompressedRequestBody(chunks if chunks is not None else _iter_payload_chunks(payload), content_encoding)
+        body = counted
+    elif chunks is not None or not isinstance(payload, (bytes, bytearray)):
+        counted = _CountingBody(chunks if chunks is not None else payload)
+        body = counted
+    else:
+        body = payload
+
+    logger.debug("Sending %d rows to ClickHouse via %s (content encoding %s)", row_count, url, content_encoding)
 
     auth = None
     user = os.getenv("CLICKHOUSE_USER")
@@ -1240,20 +3519,194 @@ def insert_into_clickhouse(
     if user and password is not None:
         auth = HTTPBasicAuth(user, password)
 
-    response = requests.post(  # noqa: S113 -- AWS Lambda sandbox restricts sockets but requests is acceptable here
+    started = time.perf_counter()
+    response = get_clickhouse_session().post(
         url,
         params=params,
-        data=parquet_payload,
+        data=body,
         headers=headers,
         timeout=timeout,
         auth=auth,
     )
+    duration_seconds = time.perf_counter() - started
     if response.status_code >= 400:
-        raise RuntimeError(
-            f"ClickHouse insert failed with status {response.status_code}: {response.text}"
-        )
+        raise ClickHouseInsertError(response.status_code, response.text)
 
     logger.debug("ClickHouse response: %s", response.text.strip())
+    wire_bytes = counted.bytes_out if counted is not None else len(payload)
+    record_upload_throughput(wire_bytes, duration_seconds)
+    return InsertResult(
+        summary=parse_clickhouse_summary(response.headers.get("X-ClickHouse-Summary")),
+        content_encoding=content_encoding,
+        wire_bytes=wire_bytes,
+        duration_seconds=duration_seconds,
+    )
+
+
+def _iter_payload_chunks(payload: Union[bytes, Iterable[bytes]]) -> Iterator[bytes]:
+    if isinstance(payload, (bytes, bytearray)):
+        view = memoryview(payload)
+        for offset in range(0, len(view), _HTTP_COMPRESSION_CHUNK_BYTES):
+            yield view[offset : offset + _HTTP_COMPRESSION_CHUNK_BYTES]
+        return
+    yield from payload
+
+
+class _CountingBody:
+    """Iterable request body that records how many bytes were sent."""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = chunks
+        self.bytes_out = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._chunks:
+            self.bytes_out += len(chunk)
+            yield chunk
+
+
+class CompressedRequestBody(_CountingBody):
+    """Iterable request body that compresses payload chunks as they are sent.
+
+    Uses an Arrow ``CompressedOutputStream`` so gzip, zstd and lz4 (frame)
+    output matches what ClickHouse expects for the ``Content-Encoding`` header.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], codec: str) -> None:
+        super().__init__(chunks)
+        self._codec = codec
+        self.bytes_in = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        sink = _ChunkSink()
+        stream = pa.CompressedOutputStream(sink, self._codec)
+        for chunk in self._chunks:
+            self.bytes_in += len(chunk)
+            stream.write(chunk)
+            compressed = sink.drain()
+            if compressed:
+                self.bytes_out += len(compressed)
+                yield compressed
+        stream.close()
+        compressed = sink.drain()
+        if compressed:
+            self.bytes_out += len(compressed)
+            yield compressed
+
+
+def choose_http_compression(sample: bytes) -> str:
+    """Pick the codec that minimizes estimated compress-plus-upload time for ``sample``."""
+    if not sample:
+        return "none"
+    throughput = _UPLOAD_BYTES_PER_SECOND or _DEFAULT_UPLOAD_BYTES_PER_SECOND
+    best_codec = "none"
+    best_seconds = len(sample) / throughput
+    for codec in _AUTO_COMPRESSION_CANDIDATES:
+        started = time.perf_counter()
+        compressed_size = len(pa.compress(sample, codec=codec, asbytes=True))
+        estimated_seconds = (time.perf_counter() - started) + compressed_size / throughput
+        if estimated_seconds < best_seconds:
+            best_codec, best_seconds = codec, estimated_seconds
+    return best_codec
+
+
+def record_upload_throughput(wire_bytes: int, duration_seconds: float) -> None:
+    # The request duration includes server-side insert time, so this slightly
+    # underestimates raw network throughput and biases auto mode toward compressing.
+    global _UPLOAD_BYTES_PER_SECOND  # noqa: PLW0603 -- tracked across warm invocations
+    if wire_bytes < _UPLOAD_THROUGHPUT_MIN_SAMPLE_BYTES or duration_seconds <= 0:
+        return
+    observed = wire_bytes / duration_seconds
+    if _UPLOAD_BYTES_PER_SECOND is None:
+        _UPLOAD_BYTES_PER_SECOND = observed
+    else:
+        _UPLOAD_BYTES_PER_SECOND += _UPLOAD_THROUGHPUT_EWMA_ALPHA * (observed - _UPLOAD_BYTES_PER_SECOND)
+
+
+def parse_clickhouse_summary(header_value: Optional[str]) -> Dict[str, Any]:
+    """Decode the ``X-ClickHouse-Summary`` header, converting numeric strings to ints."""
+    if not header_value:
+        return {}
+    try:
+        summary = json.loads(header_value)
+    except ValueError:
+        return {}
+    if not isinstance(summary, dict):
+        return {}
+    parsed: Dict[str, Any] = {}
+    for key, value in summary.items():
+        try:
+            parsed[key] = int(value)
+        except (TypeError, ValueError):
+            parsed[key] = value
+    return parsed
+
+
+class _KeepAliveHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets send TCP keepalive probes."""
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        if env_flag("CLICKHOUSE_TCP_KEEPALIVE", default=True):
+            socket_options = list(HTTPConnection.default_socket_options)
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30))
+            kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_clickhouse_session() -> requests.Session:
+    """Return the module-level pooled session used for ClickHouse inserts."""
+    global _CLICKHOUSE_SESSION  # noqa: PLW0603 -- reused across warm invocations
+    if _CLICKHOUSE_SESSION is not None:
+        return _CLICKHOUSE_SESSION
+    with _CLICKHOUSE_SESSION_LOCK:
+        if _CLICKHOUSE_SESSION is not None:
+            return _CLICKHOUSE_SESSION
+        # Only connection establishment is retried: once a request body has been
+        # sent, a replay could duplicate the insert.
+        retries = Retry(
+            total=None,
+            connect=resolve_clickhouse_connect_retries(),
+            read=0,
+            status=0,
+            other=0,
+            allowed_methods=None,
+            backoff_factor=0.2,
+            raise_on_status=False,
+        )
+        pool_size = resolve_clickhouse_pool_size()
+        adapter = _KeepAliveHTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _CLICKHOUSE_SESSION = session
+    return _CLICKHOUSE_SESSION
+
+
+def clickhouse_connection_stats() -> Dict[str, int]:
+    """Cumulative connection counters of the pooled ClickHouse session."""
+    stats = {"connections_opened": 0, "requests_sent": 0, "connections_reused": 0}
+    if _CLICKHOUSE_SESSION is None:
+        return stats
+    seen = set()
+    for adapter in _CLICKHOUSE_SESSION.adapters.values():
+        if id(adapter) in seen or not isinstance(adapter, HTTPAdapter):
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            stats["connections_opened"] += pool.num_connections
+            stats["requests_sent"] += pool.num_requests
+    stats["connections_reused"] = max(0, stats["requests_sent"] - stats["connections_opened"])
+    return stats
 
 
 def resolve_clickhouse_url() -> str:
@@ -1289,9 +3742,21 @@ def resolve_clickhouse_url() -> str:
     return f"{protocol}://{host}:{port}{path}".rstrip("/")
 
 
+_FORMAT_CLAUSE_RE = re.compile(r"\bFORMAT\s+(\w+)\s*;?\s*$", re.IGNORECASE)
+
+
 def build_insert_query() -> str:
     override = os.getenv("CLICKHOUSE_INSERT_SQL")
     if override:
+        # The payload is encoded with CLICKHOUSE_INSERT_FORMAT, so a mismatched
+        # FORMAT clause would only surface as a ClickHouse parse error per batch.
+        insert_format = resolve_insert_format()
+        match = _FORMAT_CLAUSE_RE.search(override)
+        if match is None or match.group(1).lower() != insert_format.name.lower():
+            raise ValueError(
+                f"CLICKHOUSE_INSERT_SQL must end with FORMAT {insert_format.name} "
+                "to match CLICKHOUSE_INSERT_FORMAT"
+            )
         return override
 
     database = os.getenv("CLICKHOUSE_DATABASE")
@@ -1307,7 +3772,7 @@ def build_insert_query() -> str:
 
     return (
         f"INSERT INTO {quote_identifier(database)}.{quote_identifier(table)}"
-        f"{column_clause} FORMAT Parquet"
+        f"{column_clause} FORMAT {resolve_insert_format().name}"
     )
 
 
@@ -1355,6 +3820,144 @@ def env_flag(name: str, default: bool = False) -> bool:
 def log_stage(stage: str, **fields: Any) -> None:
     payload = {"stage": stage, **fields}
     logger.info("ETL stage %s", json.dumps(payload, sort_keys=True, default=str))
+    metrics = _INVOCATION_METRICS
+    if metrics is not None:
+        metrics.record_stage(stage, fields)
+
+
+class InvocationMetrics:
+    """Aggregate ``log_stage`` fields into CloudWatch EMF metrics for one invocation.
+
+    Values are summed in memory and written as a fixed number of EMF records
+    when the invocation ends, so the cost does not grow with the number of
+    messages or sub-batches. ``remaining_time_ms`` fields feed a minimum
+    (``MinRemainingTime``) that shows how close invocations run to the timeout.
+    """
+
+    def __init__(self, namespace: str, dimensions: List[str], dimension_values: Dict[str, str]) -> None:
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self.dimension_values = dimension_values
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._values: Dict[str, float] = {}
+        self._units: Dict[str, str] = {}
+        self._min_remaining_time_ms: Optional[int] = None
+        self._event_type_rows: Dict[str, int] = {}
+
+    def _add(self, name: str, value: float, unit: str) -> None:
+        self._values[name] = self._values.get(name, 0) + value
+        self._units[name] = unit
+
+    def record_stage(self, stage: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            for field_name, metric_name, unit in _EMF_STAGE_METRICS.get(stage, ()):
+                value = fields.get(field_name)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._add(metric_name, value, unit)
+            if stage in _EMF_STAGE_COUNTS:
+                self._add(_EMF_STAGE_COUNTS[stage], 1, "Count")
+            if stage == "sub_batch_flush_start" and fields.get("flush_reason"):
+                self._add(f"Flushes_{fields['flush_reason']}", 1, "Count")
+            remaining = fields.get("remaining_time_ms")
+            if isinstance(remaining, int) and (
+                self._min_remaining_time_ms is None or remaining < self._min_remaining_time_ms
+            ):
+                self._min_remaining_time_ms = remaining
+
+    def record_committed_rows(self, table: pa.Table) -> None:
+        """Count committed rows per event_type when EventType is a dimension."""
+        if "EventType" not in self.dimensions or "event_type" not in table.column_names:
+            return
+        counts = pc.value_counts(table.column("event_type")).to_pylist()
+        with self._lock:
+            for entry in counts:
+                event_type = entry["values"] if entry["values"] is not None else "unknown"
+                self._event_type_rows[event_type] = self._event_type_rows.get(event_type, 0) + entry["counts"]
+
+    def documents(self, timestamp_ms: Optional[int] = None) -> List[Dict[str, Any]]:
+        timestamp_ms = timestamp_ms if timestamp_ms is not None else int(time.time() * 1000)
+        with self._lock:
+            values = dict(self._values)
+            units = dict(self._units)
+            values["InvocationDuration"] = elapsed_ms(self._started)
+            units["InvocationDuration"] = "Milliseconds"
+            if self._min_remaining_time_ms is not None:
+                values["MinRemainingTime"] = self._min_remaining_time_ms
+                units["MinRemainingTime"] = "Milliseconds"
+            event_type_rows = dict(self._event_type_rows)
+
+        base_dimensions = [name for name in self.dimensions if name != "EventType"]
+        documents = [self._document(timestamp_ms, base_dimensions, self.dimension_values, values, units)]
+        for event_type, rows in sorted(event_type_rows.items()):
+            documents.append(
+                self._document(
+                    timestamp_ms,
+                    base_dimensions + ["EventType"],
+                    {**self.dimension_values, "EventType": event_type},
+                    {"RowsCommitted": rows},
+                    {"RowsCommitted": "Count"},
+                )
+            )
+        return documents
+
+    def _document(
+        self,
+        timestamp_ms: int,
+        dimensions: List[str],
+        dimension_values: Dict[str, str],
+        values: Dict[str, float],
+        units: Dict[str, str],
+    ) -> Dict[str, Any]:
+        document: Dict[str, Any] = {
+            "_aws": {
+                "Timestamp": timestamp_ms,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [dimensions],
+                        "Metrics": [{"Name": name, "Unit": units[name]} for name in sorted(values)],
+                    }
+                ],
+            }
+        }
+        document.update({name: dimension_values.get(name, "unknown") for name in dimensions})
+        document.update(values)
+        return document
+
+
+def start_invocation_metrics(context: Any) -> Optional[InvocationMetrics]:
+    """Begin EMF aggregation for this invocation, or clear it when EMF is off."""
+    global _INVOCATION_METRICS  # noqa: PLW0603 -- one invocation at a time per container
+    if not env_flag("EMF_METRICS", default=False):
+        _INVOCATION_METRICS = None
+        return None
+    dimensions = resolve_emf_dimensions()
+    dimension_values = {
+        "FunctionName": getattr(context, "function_name", None)
+        or os.getenv("AWS_LAMBDA_FUNCTION_NAME")
+        or "unknown",
+        "InsertFormat": resolve_insert_format().name,
+    }
+    _INVOCATION_METRICS = InvocationMetrics(resolve_emf_namespace(), dimensions, dimension_values)
+    return _INVOCATION_METRICS
+
+
+def record_committed_rows_metric(table: pa.Table) -> None:
+    metrics = _INVOCATION_METRICS
+    if metrics is not None:
+        metrics.record_committed_rows(table)
+
+
+def emit_invocation_metrics() -> None:
+    """Print the aggregated EMF records to stdout, where CloudWatch Logs extracts them."""
+    global _INVOCATION_METRICS  # noqa: PLW0603 -- one invocation at a time per container
+    metrics, _INVOCATION_METRICS = _INVOCATION_METRICS, None
+    if metrics is None:
+        return
+    for document in metrics.documents():
+        # EMF must be the whole log line, so bypass the logger's formatting.
+        print(json.dumps(document, separators=(",", ":")), flush=True)
 
 
 def elapsed_ms(started_at: float) -> int:
@@ -1381,6 +3984,29 @@ def resolve_max_rows_per_insert() -> int:
     return max(resolve_target_rows_per_insert(), int(os.getenv("MAX_ROWS_PER_INSERT", "30000")))
 
 
+def resolve_effective_target_rows_per_insert() -> int:
+    controller = get_adaptive_batch_controller()
+    if controller is None:
+        return resolve_target_rows_per_insert()
+    return controller.current_target(resolve_adaptive_min_rows_per_insert(), resolve_max_rows_per_insert())
+
+
+def resolve_adaptive_min_rows_per_insert() -> int:
+    return max(1, int(os.getenv("ADAPTIVE_MIN_ROWS_PER_INSERT", "1000")))
+
+
+def resolve_adaptive_target_flush_ms() -> int:
+    return max(1, int(os.getenv("ADAPTIVE_TARGET_FLUSH_MS", "2000")))
+
+
+def resolve_jsonl_batch_rows() -> int:
+    return max(1, int(os.getenv("JSONL_BATCH_ROWS", "10000")))
+
+
+def resolve_payload_estimator_calibration_rows() -> int:
+    return max(0, int(os.getenv("PAYLOAD_ESTIMATOR_CALIBRATION_ROWS", "2000")))
+
+
 def resolve_max_parquet_bytes_per_insert() -> int:
     return max(1, int(os.getenv("MAX_PARQUET_BYTES_PER_INSERT", str(16 * 1024 * 1024))))
 
@@ -1393,6 +4019,106 @@ def resolve_lambda_timeout_safety_margin_ms() -> int:
     return max(1, int(os.getenv("LAMBDA_TIMEOUT_SAFETY_MARGIN_MS", "5000")))
 
 
+def resolve_jsonl_ingestion_mode() -> str:
+    mode = os.getenv("JSONL_INGESTION_MODE", "python").strip().lower()
+    if mode not in {"python", "arrow"}:
+        raise ValueError(f"Unsupported JSONL_INGESTION_MODE: {mode}")
+    return mode
+
+
+def resolve_parquet_compression() -> str:
+    return os.getenv("PARQUET_COMPRESSION", "snappy")
+
+
+def resolve_streaming_row_group_rows() -> int:
+    return max(1, int(os.getenv("STREAMING_ROW_GROUP_ROWS", "5000")))
+
+
+def resolve_http_compression() -> str:
+    value = os.getenv("CLICKHOUSE_HTTP_COMPRESSION", "none").strip().lower()
+    if value in ("", "none", "identity"):
+        return "none"
+    if value != "auto" and value not in _HTTP_COMPRESSION_CODECS:
+        raise ValueError(f"Unsupported CLICKHOUSE_HTTP_COMPRESSION: {value}")
+    return value
+
+
+def resolve_clickhouse_pool_size() -> int:
+    return max(1, int(os.getenv("CLICKHOUSE_POOL_SIZE", "4")))
+
+
+def resolve_clickhouse_connect_retries() -> int:
+    return max(0, int(os.getenv("CLICKHOUSE_CONNECT_RETRIES", "2")))
+
+
+def resolve_s3_ranged_get_threshold_bytes() -> int:
+    return max(0, int(os.getenv("S3_RANGED_GET_THRESHOLD_BYTES", str(64 * 1024 * 1024))))
+
+
+def resolve_s3_range_part_bytes() -> int:
+    return max(1, int(os.getenv("S3_RANGE_PART_BYTES", str(8 * 1024 * 1024))))
+
+
+def resolve_s3_object_compression() -> str:
+    value = os.getenv("S3_OBJECT_COMPRESSION", "auto").strip().lower()
+    if value in ("", "auto"):
+        return "auto"
+    if value in ("none", "identity"):
+        return "none"
+    if value not in _OBJECT_COMPRESSION_CODECS:
+        raise ValueError(f"Unsupported S3_OBJECT_COMPRESSION: {value}")
+    return value
+
+
+def resolve_profile_sample_rate() -> float:
+    return min(1.0, max(0.0, float(os.getenv("PROFILE_SAMPLE_RATE", "0") or 0)))
+
+
+def resolve_profile_interval_ms() -> float:
+    return max(1.0, float(os.getenv("PROFILE_INTERVAL_MS", "10")))
+
+
+def resolve_profile_top_n() -> int:
+    return max(1, int(os.getenv("PROFILE_TOP_N", "15")))
+
+
+def resolve_profile_tracemalloc_frames() -> int:
+    return max(0, int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "1")))
+
+
+def resolve_table_cache_max_bytes() -> int:
+    return max(0, int(os.getenv("TABLE_CACHE_MAX_BYTES", "0")))
+
+
+def resolve_table_cache_dir_max_bytes() -> int:
+    return max(0, int(os.getenv("TABLE_CACHE_DIR_MAX_BYTES", str(512 * 1024 * 1024))))
+
+
+def resolve_quarantine_sink() -> Optional[str]:
+    return os.getenv("QUARANTINE_SINK") or None
+
+
+def resolve_quarantine_max_error_rate() -> float:
+    return min(1.0, max(0.0, float(os.getenv("QUARANTINE_MAX_ERROR_RATE", "0.05"))))
+
+
+def resolve_emf_namespace() -> str:
+    return os.getenv("EMF_NAMESPACE", "").strip() or "XapiEtlProcessor"
+
+
+def resolve_emf_dimensions() -> List[str]:
+    raw = os.getenv("EMF_DIMENSIONS", "FunctionName")
+    dimensions = [name.strip() for name in raw.split(",") if name.strip()]
+    for name in dimensions:
+        if name not in _EMF_DIMENSION_NAMES:
+            raise ValueError(f"Unsupported EMF_DIMENSIONS entry: {name}")
+    return dimensions
+
+
+def resolve_max_inflight_inserts() -> int:
+    return max(0, int(os.getenv("MAX_INFLIGHT_INSERTS", "0")))
+
+
 def resolve_max_messages_per_invocation_to_process() -> Optional[int]:
     raw = os.getenv("MAX_MESSAGES_PER_INVOCATION_TO_PROCESS")
     if raw in {None, ""}:
@@ -1400,6 +4126,128 @@ def resolve_max_messages_per_invocation_to_process() -> Optional[int]:
     return max(1, int(raw))
 
 
+class PayloadSizeEstimator:
+    """Predict serialized payload bytes from in-memory Arrow column sizes.
+
+    Keeps an EWMA of serialized/in-memory bytes per column. Parquet payloads
+    are learned per column from the file footer; other formats and streamed
+    payloads only update the table-wide ratio, which also covers columns
+    without history. Before any observation the estimate equals ``nbytes``.
+    """
+
+    _EWMA_ALPHA = 0.3
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._column_ratios: Dict[str, float] = {}
+        self._table_ratio: Optional[float] = None
+        self.observations = 0
+        self.calibration_attempted = False
+
+    def estimate(self, table: "pa.Table") -> int:
+        with self._lock:
+            default_ratio = self._table_ratio if self._table_ratio is not None else 1.0
+            total = 0.0
+            for name, column in zip(table.column_names, table.columns):
+                total += column.nbytes * self._column_ratios.get(name, default_ratio)
+        return int(total)
+
+    def observe(
+        self,
+        table: "pa.Table",
+        payload_bytes: int,
+        column_bytes: Optional[Dict[str, int]] = None,
+    ) -> None:
+        table_nbytes = estimate_table_size_bytes(table)
+        if table_nbytes <= 0 or payload_bytes <= 0:
+            return
+        with self._lock:
+            self._table_ratio = self._blend(self._table_ratio, payload_bytes / table_nbytes)
+            for name, column in zip(table.column_names, table.columns):
+                serialized = (column_bytes or {}).get(name)
+                if serialized is None or column.nbytes <= 0:
+                    continue
+                self._column_ratios[name] = self._blend(self._column_ratios.get(name), serialized / column.nbytes)
+            self.observations += 1
+
+    def _blend(self, current: Optional[float], sample: float) -> float:
+        if current is None:
+            return sample
+        return current + self._EWMA_ALPHA * (sample - current)
+
+    def table_ratio(self) -> Optional[float]:
+        with self._lock:
+            return self._table_ratio
+
+
+def get_payload_size_estimator(format_name: str) -> PayloadSizeEstimator:
+    with _PAYLOAD_SIZE_ESTIMATORS_LOCK:
+        estimator = _PAYLOAD_SIZE_ESTIMATORS.get(format_name)
+        if estimator is None:
+            estimator = _PAYLOAD_SIZE_ESTIMATORS[format_name] = PayloadSizeEstimator()
+        return estimator
+
+
+def parquet_column_sizes(metadata: "pq.FileMetaData") -> Dict[str, int]:
+    """Sum compressed column-chunk sizes per top-level column from a Parquet footer."""
+    sizes: Dict[str, int] = {}
+    for row_group_index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(row_group_index)
+        for column_index in range(row_group.num_columns):
+            chunk = row_group.column(column_index)
+            name = chunk.path_in_schema.split(".", 1)[0]
+            sizes[name] = sizes.get(name, 0) + chunk.total_compressed_size
+    return sizes
+
+
+def observe_serialized_payload(
+    insert_format: InsertFormat,
+    table: "pa.Table",
+    payload_bytes: int,
+    payload: Optional[bytes] = None,
+) -> None:
+    """Feed one serialized payload back into the estimator for its format."""
+    column_bytes = None
+    if payload is not None and insert_format.name == "Parquet":
+        column_bytes = parquet_column_sizes(pq.read_metadata(pa.BufferReader(payload)))
+    get_payload_size_estimator(insert_format.name).observe(table, payload_bytes, column_bytes)
+
+
+def estimate_payload_bytes(table: "pa.Table") -> int:
+    """Estimate serialized insert-payload bytes for ``table`` in the configured format."""
+    insert_format = resolve_insert_format()
+    estimator = get_payload_size_estimator(insert_format.name)
+    if not estimator.calibration_attempted:
+        calibrate_payload_size_estimator(estimator, table, insert_format)
+    return estimator.estimate(table)
+
+
+def calibrate_payload_size_estimator(
+    estimator: PayloadSizeEstimator, table: "pa.Table", insert_format: InsertFormat
+) -> None:
+    # Flag first so a failing calibration is not retried for every message.
+    estimator.calibration_attempted = True
+    sample_rows = resolve_payload_estimator_calibration_rows()
+    if sample_rows <= 0 or table.num_rows == 0 or estimator.observations:
+        return
+    sample = table.slice(0, sample_rows)
+    try:
+        started = time.perf_counter()
+        payload = insert_format.encode(sample)
+        observe_serialized_payload(insert_format, sample, len(payload), payload)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.warning("Payload size estimator calibration failed: %s", exc)
+        return
+    log_stage(
+        "payload_estimator_calibrated",
+        insert_format=insert_format.name,
+        row_count=sample.num_rows,
+        in_memory_bytes=estimate_table_size_bytes(sample),
+        payload_bytes=len(payload),
+        duration_ms=elapsed_ms(started),
+    )
+
+
 def estimate_table_size_bytes(table: "pa.Table") -> int:
     table_nbytes = getattr(table, "nbytes", None)
     if table_nbytes is None:
@@ -1417,7 +4265,7 @@ def determine_flush_reason(current_batch: BatchAccumulator, *, force: bool) -> O
         return "max_rows_reached"
     if current_batch.estimated_bytes >= resolve_max_parquet_bytes_per_insert():
         return "payload_ceiling_reached"
-    if current_batch.total_rows >= resolve_target_rows_per_insert():
+    if current_batch.total_rows >= resolve_effective_target_rows_per_insert():
         return "target_rows_reached"
     if force:
         return "forced_flush"
@@ -1462,6 +4310,53 @@ def remaining_message_ids(records: Iterable[Dict[str, Any]]) -> List[str]:
     ]
 
 
+_SOURCE_IDENTITY_COLUMNS = ("source_file", "source_etag", "source_line")
+
+
+def source_sort_key(table: "pa.Table") -> Tuple[str, int]:
+    """Order prepared tables by their first source object and line."""
+    if table.num_rows == 0 or "source_line" not in table.column_names:
+        return ("", 0)
+    source_file = table.column("source_file")[0].as_py() if "source_file" in table.column_names else None
+    source_line = table.column("source_line")[0].as_py()
+    return (source_file or "", source_line or 0)
+
+
+def build_source_insert_token(tables: List["pa.Table"]) -> Optional[str]:
+    """Derive an insert deduplication token from the source objects in a sub-batch.
+
+    The token covers every (source_file, source_etag) pair with its min/max
+    source_line and row count, so a retried sub-batch built from the same
+    object versions yields the same token regardless of SQS message IDs.
+    Returns None when the tables do not carry the source identity columns.
+    """
+    ranges: Dict[Tuple[str, str], List[int]] = {}
+    for table in tables:
+        if any(name not in table.column_names for name in _SOURCE_IDENTITY_COLUMNS):
+            return None
+        if table.num_rows == 0:
+            continue
+        grouped = table.group_by(["source_file", "source_etag"]).aggregate(
+            [("source_line", "min"), ("source_line", "max"), ("source_line", "count")]
+        )
+        for row in grouped.to_pylist():
+            key = (row["source_file"] or "", row["source_etag"] or "")
+            current = ranges.get(key)
+            if current is None:
+                ranges[key] = [row["source_line_min"], row["source_line_max"], row["source_line_count"]]
+            else:
+                current[0] = min(current[0], row["source_line_min"])
+                current[1] = max(current[1], row["source_line_max"])
+                current[2] += row["source_line_count"]
+    if not ranges:
+        return None
+    identity = "\n".join(
+        f"{source_file}|{source_etag}|{line_min}|{line_max}|{count}"
+        for (source_file, source_etag), (line_min, line_max, count) in sorted(ranges.items())
+    )
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()[:32]
+
+
 def build_insert_token(message_ids: List[str], row_count: int) -> str:
     digest = hashlib.sha256(
         f"{','.join(message_ids)}:{row_count}".encode("utf-8")
@@ -1474,7 +4369,13 @@ def is_diagnostics_request(event: Any) -> bool:
 
 
 def collect_runtime_diagnostics(event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    diagnostics: Dict[str, Any] = {
+    diagnostics = _runtime_summary()
+    maybe_add_s3_check(diagnostics, event)
+    return diagnostics
+
+
+def _runtime_summary() -> Dict[str, Any]:
+    summary: Dict[str, Any] = {
         "runtime": RUNTIME_METADATA,
         "environment": {
             "dry_run": env_flag("DRY_RUN", default=False),
@@ -1485,16 +4386,15 @@ def collect_runtime_diagnostics(event: Optional[Dict[str, Any]] = None) -> Dict[
         "dependencies": {},
     }
     if PYARROW_IMPORT_ERROR is None:
-        diagnostics["dependencies"]["pyarrow"] = getattr(pa, "__version__", "unknown")
+        summary["dependencies"]["pyarrow"] = getattr(pa, "__version__", "unknown")
     else:
-        diagnostics["dependencies"]["pyarrow_error"] = str(PYARROW_IMPORT_ERROR)
+        summary["dependencies"]["pyarrow_error"] = str(PYARROW_IMPORT_ERROR)
     try:
         numpy_module = importlib.import_module("numpy")
-        diagnostics["dependencies"]["numpy"] = getattr(numpy_module, "__version__", "unknown")
+        summary["dependencies"]["numpy"] = getattr(numpy_module, "__version__", "unknown")
     except Exception as exc:  # pylint: disable=broad-except
-        diagnostics["dependencies"]["numpy_error"] = str(exc)
-    maybe_add_s3_check(diagnostics, event)
-    return diagnostics
+        summary["dependencies"]["numpy_error"] = str(exc)
+    return summary
 
 
 def maybe_add_s3_check(diagnostics: Dict[str, Any], event: Optional[Dict[str, Any]]) -> None:
@@ -1557,6 +4457,197 @@ def maybe_add_s3_check(diagnostics: Dict[str, Any], event: Optional[Dict[str, An
         }
 
 
+class SamplingProfiler:
+    """Low-overhead wall-clock profiler that samples every thread's stack.
+
+    A daemon thread wakes every ``interval_seconds`` and walks
+    ``sys._current_frames()``, counting the innermost frame (self time) and each
+    distinct function on the stack (cumulative time). Only threads running code
+    from this module are sampled, and their stacks are cut at the outermost
+    frame of this module, so the Lambda runtime and idle pool workers do not
+    drown out prefetch and insert work.
+
+    When tracemalloc is enabled the sampler also takes a snapshot each time
+    traced memory grows 25% past the previous snapshot, so the allocation sites
+    reported are the ones live near the invocation's peak rather than at its end.
+    """
+
+    _PEAK_SNAPSHOT_GROWTH = 1.25
+    _MIN_SNAPSHOT_BYTES = 1024 * 1024
+
+    def __init__(self, interval_seconds: float, tracemalloc_frames: int) -> None:
+        self.interval_seconds = interval_seconds
+        self.tracemalloc_frames = tracemalloc_frames
+        self.sample_count = 0
+        self._self_samples: Dict[str, int] = {}
+        self._cumulative_samples: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = 0.0
+        self._duration_seconds = 0.0
+        self._owns_tracemalloc = False
+        self._peak_snapshot: Optional[tracemalloc.Snapshot] = None
+        self._peak_snapshot_bytes = 0
+
+    def start(self) -> None:
+        if self.tracemalloc_frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracemalloc_frames)
+            self._owns_tracemalloc = True
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._duration_seconds = time.perf_counter() - self._started
+        if tracemalloc.is_tracing():
+            self._maybe_snapshot(force=self._peak_snapshot is None)
+
+    def _run(self) -> None:
+        sampler_id = threading.get_ident()
+        while not self._stop.wait(self.interval_seconds):
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id != sampler_id:
+                    self._record_stack(frame)
+            self.sample_count += 1
+            if tracemalloc.is_tracing():
+                self._maybe_snapshot()
+
+    def _record_stack(self, frame: Any) -> None:
+        stack = []
+        outermost = -1
+        while frame is not None:
+            if frame.f_code.co_filename == __file__:
+                outermost = len(stack)
+            stack.append(frame)
+            frame = frame.f_back
+        if outermost < 0:
+            return
+        labels = [_frame_label(stack_frame) for stack_frame in stack[: outermost + 1]]
+        self._self_samples[labels[0]] = self._self_samples.get(labels[0], 0) + 1
+        for label in set(labels):
+            self._cumulative_samples[label] = self._cumulative_samples.get(label, 0) + 1
+
+    def _maybe_snapshot(self, force: bool = False) -> None:
+        current, _peak = tracemalloc.get_traced_memory()
+        threshold = max(self._MIN_SNAPSHOT_BYTES, self._peak_snapshot_bytes * self._PEAK_SNAPSHOT_GROWTH)
+        if force or current > threshold:
+            self._peak_snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),)
+            )
+            self._peak_snapshot_bytes = current
+
+    def summary(self, top_n: int) -> Dict[str, Any]:
+        interval_ms = self.interval_seconds * 1000
+
+        def top(samples: Dict[str, int]) -> List[Dict[str, Any]]:
+            ranked = sorted(samples.items(), key=lambda item: item[1], reverse=True)[:top_n]
+            return [
+                {"function": label, "samples": count, "approx_ms": round(count * interval_ms, 1)}
+                for label, count in ranked
+            ]
+
+        result: Dict[str, Any] = {
+            "duration_ms": round(self._duration_seconds * 1000, 3),
+            "interval_ms": interval_ms,
+            "sample_count": self.sample_count,
+            "top_self": top(self._self_samples),
+            "top_cumulative": top(self._cumulative_samples),
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            result["traced_current_bytes"] = current
+            result["traced_peak_bytes"] = peak
+        if self._peak_snapshot is not None:
+            result["snapshot_bytes"] = self._peak_snapshot_bytes
+            result["top_allocations"] = [
+                {
+                    "site": f"{stat.traceback[0].filename.rsplit('/', 1)[-1]}:{stat.traceback[0].lineno}",
+                    "bytes": stat.size,
+                    "blocks": stat.count,
+                }
+                for stat in self._peak_snapshot.statistics("lineno")[:top_n]
+            ]
+        return result
+
+    def close(self) -> None:
+        self._peak_snapshot = None
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+
+
+def _frame_label(frame: Any) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+
+
+def start_invocation_profile(event: Any) -> Optional[SamplingProfiler]:
+    """Start profiling when the event asks for it or the invocation is sampled."""
+    requested = isinstance(event, dict) and bool(event.get("profile"))
+    sample_rate = resolve_profile_sample_rate()
+    if not requested and not (sample_rate > 0 and random.random() < sample_rate):
+        return None
+    profiler = SamplingProfiler(resolve_profile_interval_ms() / 1000, resolve_profile_tracemalloc_frames())
+    profiler.start()
+    return profiler
+
+
+def finish_invocation_profile(profiler: SamplingProfiler, context: Any) -> None:
+    """Stop ``profiler`` and write its summary to the logs and ``PROFILE_S3_URI``."""
+    try:
+        profiler.stop()
+        top_n = resolve_profile_top_n()
+        profile = profiler.summary(top_n)
+        request_id = getattr(context, "aws_request_id", None)
+        log_stage(
+            "invocation_profile",
+            request_id=request_id,
+            duration_ms=profile["duration_ms"],
+            sample_count=profile["sample_count"],
+            top_self=profile["top_self"][:5],
+            top_cumulative=profile["top_cumulative"][:5],
+            top_allocations=profile.get("top_allocations", [])[:5],
+            traced_peak_bytes=profile.get("traced_peak_bytes"),
+            max_rss_bytes=process_max_rss_bytes(),
+        )
+        destination = os.getenv("PROFILE_S3_URI")
+        if destination:
+            bucket, prefix = _split_s3_uri(destination)
+            key = "/".join(
+                part
+                for part in (
+                    prefix,
+                    datetime.now(timezone.utc).strftime("%Y/%m/%d"),
+                    f"{request_id or int(time.time() * 1000)}.json",
+                )
+                if part
+            )
+            document = {"request_id": request_id, "runtime": _runtime_summary(), "profile": profile}
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=json.dumps(document, default=str).encode("utf-8"),
+                ContentType="application/json",
+            )
+            logger.info("Wrote invocation profile to s3://%s/%s", bucket, key)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.warning("Failed to record invocation profile: %s", exc)
+    finally:
+        profiler.close()
+
+
+def _split_s3_uri(uri: str) -> Tuple[str, str]:
+    parsed = urlparse(uri)
+    if parsed.scheme != "s3" or not parsed.netloc:
+        raise ValueError(f"Expected an s3://bucket/prefix URI, got {uri!r}")
+    return parsed.netloc, parsed.path.strip("/")
+
+
 def ensure_pyarrow_available() -> None:
     if PYARROW_IMPORT_ERROR is not None:
         raise RuntimeError(
@@ -1572,9 +4663,50 @@ __all__ = [
     "build_arrow_table_from_s3_objects",
     "load_json_lines_as_table",
     "table_to_parquet",
+    "serialize_table",
+    "resolve_insert_format",
     "insert_into_clickhouse",
     "collect_runtime_diagnostics",
     "env_flag",
     "ensure_pyarrow_available",
     "transform_xapi_statement",
 ]
+
+
+def _prewarm_arrow() -> None:
+    """Run one statement through parse, normalize and serialize during init.
+
+    Arrow registers compute kernels, loads codecs and imports submodules on
+    first use; doing that here moves the cost into the init phase instead of
+    the first invocation.
+    """
+    statement = {
+        "actor": {"account": {"name": 1, "homePage": "https://example.edu"}},
+        "verb": {"id": "http://adlnet.gov/expapi/verbs/completed"},
+        "object": {"id": "prewarm", "definition": {"type": "http://adlnet.gov/expapi/activities/question"}},
+        "context": {"extensions": {"http://oli.cmu.edu/extensions/section_id": 1}},
+        "result": {"score": {"raw": 1, "max": 1}},
+        "timestamp": "2025-01-01T00:00:00.000Z",
+    }
+    raw_line = json.dumps(statement).encode("utf-8")
+    builder = XapiColumnBuilder(bucket="prewarm", key="prewarm.jsonl", etag=None)
+    builder.append(statement, raw_bytes=raw_line, line_number=1)
+    table = normalize_table_schema(builder.finish())
+    serialize_table(table, resolve_insert_format())
+    if resolve_jsonl_ingestion_mode() == "arrow":
+        _load_json_lines_with_arrow_reader(
+            S3ObjectRef(bucket="prewarm", key="prewarm.jsonl"), [raw_line + b"\n"], etag=None
+        )
+
+
+_record_init_step("module_definitions")
+# Fail the cold start, not every object, on a bad EVENT_HASH_MODE or a missing xxhash.
+resolve_event_hash_spec()
+if PYARROW_IMPORT_ERROR is None and env_flag("PREWARM_ARROW", default=False):
+    try:
+        _prewarm_arrow()
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.warning("Arrow prewarm failed: %s", exc)
+    _record_init_step("prewarm_arrow")
+RUNTIME_METADATA["init_total_ms"] = round((time.perf_counter() - _MODULE_INIT_STARTED) * 1000, 3)
+logger.info("Lambda cold start runtime metadata: %s", json.dumps(RUNTIME_METADATA))
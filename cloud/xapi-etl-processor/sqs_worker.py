@@ -0,0 +1,352 @@
+"""Long-running SQS worker that runs the Lambda ETL pipeline outside Lambda.
+
+Each worker long-polls the queue, gathers up to ``--batch-size`` messages
+within ``--batch-window-seconds`` (like an event source mapping's batching
+window), hands them to ``lambda_function.process_sqs_event`` in the same
+record shape Lambda uses and deletes every message that is not reported in
+``batchItemFailures``. Failed and untouched messages are left to become
+visible again after the visibility timeout, so redrive policies behave as they
+do for the Lambda.
+
+The visibility timeout plays the role of the Lambda timeout: the context passed
+to the pipeline reports the time left before the oldest message in the batch
+becomes visible again, so ``MIN_REMAINING_TIME_TO_START_INSERT_MS`` and the
+request-timeout derivation work unchanged. On SIGTERM or SIGINT workers stop
+polling and the batch in progress gets ``--drain-seconds`` to finish; messages
+it cannot insert in that time are not deleted. Every pipeline knob is read from
+the environment as in Lambda.
+
+Workers run as threads (``--threads``) in each of ``--processes`` processes.
+Parsing is CPU bound, so scale with processes first; ``EMF_METRICS`` assumes
+one batch at a time per process and requires ``--threads 1``.
+
+Usage::
+
+    python sqs_worker.py --queue-url https://sqs.us-east-1.amazonaws.com/123456789012/xapi-etl \\
+        --processes 4 --batch-size 100
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+
+import lambda_function
+
+logger = logging.getLogger("sqs_worker")
+
+# ReceiveMessage and DeleteMessageBatch accept at most ten entries per call.
+_SQS_MAX_BATCH_ENTRIES = 10
+_SQS_MAX_WAIT_TIME_SECONDS = 20
+
+
+@dataclass(frozen=True)
+class WorkerConfig:
+    queue_url: str
+    batch_size: int = 10
+    batch_window_seconds: float = 0.0
+    wait_time_seconds: int = _SQS_MAX_WAIT_TIME_SECONDS
+    visibility_timeout_seconds: int = 900
+    drain_seconds: float = 60.0
+    threads: int = 1
+    processes: int = 1
+    name: str = "xapi-etl-sqs-worker"
+
+
+class DrainSignal:
+    """Shared stop flag; once requested, in-flight batches get ``drain_seconds`` more."""
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.deadline: Optional[float] = None
+
+    def request(self, drain_seconds: float) -> None:
+        if not self.event.is_set():
+            self.deadline = time.monotonic() + drain_seconds
+            self.event.set()
+
+    def is_set(self) -> bool:
+        return self.event.is_set()
+
+
+class WorkerContext:
+    """Lambda-context stand-in whose remaining time ends at the visibility deadline."""
+
+    def __init__(self, deadline: float, drain: DrainSignal, function_name: str) -> None:
+        self._deadline = deadline
+        self._drain = drain
+        self.function_name = function_name
+        self.aws_request_id = uuid.uuid4().hex
+
+    def get_remaining_time_in_millis(self) -> int:
+        deadline = self._deadline
+        if self._drain.deadline is not None:
+            deadline = min(deadline, self._drain.deadline)
+        return max(0, int((deadline - time.monotonic()) * 1000))
+
+
+def to_lambda_record(message: Dict[str, Any], queue_url: str) -> Dict[str, Any]:
+    """Shape a ReceiveMessage entry like the records of a Lambda SQS event."""
+    return {
+        "messageId": message["MessageId"],
+        "receiptHandle": message["ReceiptHandle"],
+        "body": message.get("Body", ""),
+        "attributes": message.get("Attributes", {}),
+        "messageAttributes": message.get("MessageAttributes", {}),
+        "md5OfBody": message.get("MD5OfBody"),
+        "eventSource": "aws:sqs",
+        "eventSourceARN": queue_url,
+    }
+
+
+class SqsWorker:
+    """Receive, process and delete SQS batches until ``drain`` is requested."""
+
+    def __init__(self, config: WorkerConfig, sqs_client: Any, drain: DrainSignal) -> None:
+        self.config = config
+        self.sqs_client = sqs_client
+        self.drain = drain
+        self.batches = 0
+        self.deleted_messages = 0
+        self.failed_messages = 0
+
+    def run(self) -> None:
+        while not self.drain.is_set():
+            try:
+                self.run_once()
+            except Exception as exc:  # pylint: disable=broad-except
+                # Undeleted messages reappear after the visibility timeout.
+                logger.exception("SQS worker batch failed: %s", exc)
+                self.drain.event.wait(1.0)
+        lambda_function.log_stage(
+            "worker_stopped",
+            batches=self.batches,
+            deleted_messages=self.deleted_messages,
+            failed_messages=self.failed_messages,
+        )
+
+    def run_once(self) -> int:
+        """Process one batch; returns the number of messages received."""
+        messages, deadline = self.receive_batch()
+        if not messages:
+            return 0
+        records = [to_lambda_record(message, self.config.queue_url) for message in messages]
+        context = WorkerContext(deadline, self.drain, self.config.name)
+        result = lambda_function.process_sqs_event({"Records": records}, context)
+        failed = {item["itemIdentifier"] for item in result.get("batchItemFailures", [])}
+        done = [record for record in records if record["messageId"] not in failed]
+        self.delete_messages(done)
+        self.batches += 1
+        self.deleted_messages += len(done)
+        self.failed_messages += len(records) - len(done)
+        return len(records)
+
+    def receive_batch(self) -> Tuple[List[Dict[str, Any]], float]:
+        config = self.config
+        messages: Dict[str, Dict[str, Any]] = {}
+        deadline = 0.0
+        window_end: Optional[float] = None
+        while len(messages) < config.batch_size and not self.drain.is_set():
+            if window_end is None:
+                wait_seconds = config.wait_time_seconds
+            else:
+                remaining_window = window_end - time.monotonic()
+                if remaining_window <= 0:
+                    break
+                wait_seconds = min(config.wait_time_seconds, math.ceil(remaining_window))
+            requested_at = time.monotonic()
+            response = self.sqs_client.receive_message(
+                QueueUrl=config.queue_url,
+                MaxNumberOfMessages=min(_SQS_MAX_BATCH_ENTRIES, config.batch_size - len(messages)),
+                WaitTimeSeconds=wait_seconds,
+                VisibilityTimeout=config.visibility_timeout_seconds,
+                AttributeNames=["All"],
+                MessageAttributeNames=["All"],
+            )
+            received = response.get("Messages", [])
+            if not received:
+                if window_end is None:
+                    # Nothing arrived during the long poll; let ``run`` poll again.
+                    return [], 0.0
+                continue
+            if window_end is None:
+                # The oldest message becomes visible again first, so it sets the deadline.
+                deadline = requested_at + config.visibility_timeout_seconds
+                window_end = requested_at + config.batch_window_seconds
+            for message in received:
+                # A redelivered duplicate keeps only its newest receipt handle.
+                messages[message["MessageId"]] = message
+        return list(messages.values()), deadline
+
+    def delete_messages(self, records: List[Dict[str, Any]]) -> None:
+        for start in range(0, len(records), _SQS_MAX_BATCH_ENTRIES):
+            chunk = records[start : start + _SQS_MAX_BATCH_ENTRIES]
+            response = self.sqs_client.delete_message_batch(
+                QueueUrl=self.config.queue_url,
+                Entries=[
+                    {"Id": str(index), "ReceiptHandle": record["receiptHandle"]}
+                    for index, record in enumerate(chunk)
+                ],
+            )
+            for failure in response.get("Failed", []):
+                record = chunk[int(failure["Id"])]
+                logger.warning(
+                    "Could not delete SQS message %s (%s); it will be redelivered and deduplicated on insert",
+                    record["messageId"],
+                    failure.get("Message") or failure.get("Code"),
+                )
+
+
+def create_sqs_client(config: WorkerConfig) -> Any:
+    # Long polls hold the connection for up to WaitTimeSeconds.
+    return boto3.client(
+        "sqs",
+        config=Config(
+            read_timeout=config.wait_time_seconds + 10,
+            max_pool_connections=max(10, config.threads * 2),
+        ),
+    )
+
+
+def run_workers(config: WorkerConfig, drain: Optional[DrainSignal] = None, sqs_client: Any = None) -> List[SqsWorker]:
+    """Run ``config.threads`` workers in this process until ``drain`` is requested."""
+    drain = drain or DrainSignal()
+    sqs_client = sqs_client or create_sqs_client(config)
+    workers = [SqsWorker(config, sqs_client, drain) for _ in range(config.threads)]
+    threads = [
+        threading.Thread(target=worker.run, name=f"sqs-worker-{index}", daemon=True)
+        for index, worker in enumerate(workers)
+    ]
+    lambda_function.log_stage("worker_started", queue_url=config.queue_url, threads=config.threads, pid=os.getpid())
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        # Joining with a timeout keeps the main thread responsive to signals.
+        while thread.is_alive():
+            thread.join(timeout=1.0)
+    return workers
+
+
+def install_drain_handlers(drain: DrainSignal, drain_seconds: float) -> None:
+    def handle(signum: int, _frame: Any) -> None:
+        logger.info("Received signal %d; draining SQS workers", signum)
+        drain.request(drain_seconds)
+
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+
+
+def _run_worker_process(config: WorkerConfig) -> None:
+    _configure_logging()
+    drain = DrainSignal()
+    install_drain_handlers(drain, config.drain_seconds)
+    run_workers(config, drain)
+
+
+def run_process_pool(config: WorkerConfig) -> int:
+    """Run ``config.processes`` worker processes and forward SIGTERM/SIGINT to them."""
+    spawn = multiprocessing.get_context("spawn")
+    processes = [
+        spawn.Process(target=_run_worker_process, args=(config,), name=f"sqs-worker-process-{index}")
+        for index in range(config.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward(signum: int, _frame: Any) -> None:
+        for process in processes:
+            if process.is_alive() and process.pid is not None:
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+    return max((process.exitcode or 0 for process in processes), default=0)
+
+
+def _configure_logging() -> None:
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format="%(asctime)s %(process)d %(threadName)s %(levelname)s %(name)s %(message)s")
+    logger.setLevel(lambda_function.logger.level)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> WorkerConfig:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queue-url", default=os.getenv("SQS_QUEUE_URL"), help="queue to consume (SQS_QUEUE_URL)")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=int(os.getenv("WORKER_BATCH_SIZE", "10")),
+        help="messages handed to the pipeline at once (WORKER_BATCH_SIZE)",
+    )
+    parser.add_argument(
+        "--batch-window-seconds",
+        type=float,
+        default=float(os.getenv("WORKER_BATCH_WINDOW_SECONDS", "0")),
+        help="how long to keep receiving after the first message (WORKER_BATCH_WINDOW_SECONDS)",
+    )
+    parser.add_argument(
+        "--wait-time-seconds",
+        type=int,
+        default=int(os.getenv("WORKER_WAIT_TIME_SECONDS", str(_SQS_MAX_WAIT_TIME_SECONDS))),
+        help="long-poll duration, 0-20 (WORKER_WAIT_TIME_SECONDS)",
+    )
+    parser.add_argument(
+        "--visibility-timeout-seconds",
+        type=int,
+        default=int(os.getenv("WORKER_VISIBILITY_TIMEOUT_SECONDS", "900")),
+        help="time budget per batch (WORKER_VISIBILITY_TIMEOUT_SECONDS)",
+    )
+    parser.add_argument(
+        "--drain-seconds",
+        type=float,
+        default=float(os.getenv("WORKER_DRAIN_SECONDS", "60")),
+        help="time the batch in progress gets after SIGTERM (WORKER_DRAIN_SECONDS)",
+    )
+    parser.add_argument("--threads", type=int, default=int(os.getenv("WORKER_THREADS", "1")))
+    parser.add_argument("--processes", type=int, default=int(os.getenv("WORKER_PROCESSES", "1")))
+    parser.add_argument("--name", default=os.getenv("WORKER_NAME", "xapi-etl-sqs-worker"), help="EMF FunctionName")
+    args = parser.parse_args(argv)
+
+    if not args.queue_url:
+        parser.error("--queue-url or SQS_QUEUE_URL is required")
+    if not 0 <= args.wait_time_seconds <= _SQS_MAX_WAIT_TIME_SECONDS:
+        parser.error("--wait-time-seconds must be between 0 and 20")
+    if args.threads > 1 and lambda_function.env_flag("EMF_METRICS", default=False):
+        parser.error("EMF_METRICS aggregates one batch at a time per process; use --processes instead of --threads")
+    return WorkerConfig(
+        queue_url=args.queue_url,
+        batch_size=max(1, args.batch_size),
+        batch_window_seconds=max(0.0, args.batch_window_seconds),
+        wait_time_seconds=args.wait_time_seconds,
+        visibility_timeout_seconds=max(1, args.visibility_timeout_seconds),
+        drain_seconds=max(0.0, args.drain_seconds),
+        threads=max(1, args.threads),
+        processes=max(1, args.processes),
+        name=args.name,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    config = parse_args(argv)
+    if config.processes > 1:
+        return run_process_pool(config)
+    _run_worker_process(config)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
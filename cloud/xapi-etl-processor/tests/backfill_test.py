@@ -0,0 +1,218 @@
+import gzip
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+from unittest import SkipTest, TestCase, mock
+
+try:
+    import pytest
+except ModuleNotFoundError:  # pragma: no cover - local fallback when pytest is absent
+    class _PytestShim:
+        @staticmethod
+        def skip(message, allow_module_level=False):
+            raise SkipTest(message)
+
+    pytest = _PytestShim()
+
+try:
+    import pyarrow  # noqa: F401
+except ModuleNotFoundError:
+    pytest.skip("pyarrow is required for these tests; install it or run under Python 3.11", allow_module_level=True)
+
+MODULE_DIR = Path(__file__).resolve().parents[1]
+# Spawned worker processes import ``backfill`` by name.
+if str(MODULE_DIR) not in sys.path:
+    sys.path.insert(0, str(MODULE_DIR))
+
+
+def _load(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, MODULE_DIR / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)  # type: ignore[misc]
+    return module
+
+
+lambda_function = _load("lambda_function")
+backfill = _load("backfill")
+# What a successful insert_into_clickhouse returns; mocks hand it back so the
+# committed-sub-batch log sees the same fields as in production.
+INSERT_RESULT = lambda_function.InsertResult(summary={}, content_encoding="none", wire_bytes=0, duration_seconds=0.0)
+
+
+class LocalS3AndClickHouse:
+    """One HTTP server answering S3 GetObject (path style) and ClickHouse inserts."""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.inserted_rows = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):  # noqa: N802 - http.server naming
+                bucket, _, key = unquote(urlparse(self.path).path).lstrip("/").partition("/")
+                body = server.objects.get((bucket, key))
+                if body is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", f'"{key}"')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):  # noqa: N802 - http.server naming
+                body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+                server.inserted_rows.append(lambda_function.pq.read_table(io.BytesIO(body)).num_rows)
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *_args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class BackfillTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(lambda_function, "s3_client")
+        self.addCleanup(patcher.stop)
+        self.mock_s3 = patcher.start()
+        env = mock.patch.dict(
+            os.environ,
+            {"CLICKHOUSE_DATABASE": "db", "CLICKHOUSE_TABLE": "tbl", "TARGET_ROWS_PER_INSERT": "4"},
+            clear=False,
+        )
+        self.addCleanup(env.stop)
+        env.start()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def _table_with_rows(self, row_count):
+        return lambda_function.pa.Table.from_pylist(
+            [{"event_hash": f"hash-{index}", "source_line": index + 1} for index in range(row_count)]
+        )
+
+    def test_key_sources_read_prefix_listing_inventory_and_manifest(self):
+        self.mock_s3.get_paginator.return_value.paginate.return_value = [
+            {"Contents": [{"Key": "2024/a.jsonl", "Size": 10, "ETag": '"e1"'}, {"Key": "2024/"}]},
+            {"Contents": [{"Key": "2024/b.json"}, {"Key": "2024/c.jsonl", "Size": 20}]},
+        ]
+        listed = list(backfill.iter_prefix_refs("s3://bucket/2024/", suffix=".jsonl"))
+        self.mock_s3.get_paginator.return_value.paginate.assert_called_once_with(Bucket="bucket", Prefix="2024/")
+        self.assertEqual([(ref.key, ref.size, ref.etag) for ref in listed], [("2024/a.jsonl", 10, '"e1"'), ("2024/c.jsonl", 20, None)])
+
+        inventory = self.tmp / "inventory.csv.gz"
+        with gzip.open(inventory, "wt") as handle:
+            handle.write('"bucket","2024/section+1/a%2Bb.jsonl","10"\n"bucket","2024/folder/","0"\n')
+        self.assertEqual(
+            [backfill.object_uri(ref) for ref in backfill.iter_inventory_refs(str(inventory))],
+            ["s3://bucket/2024/section 1/a+b.jsonl"],
+        )
+
+        manifest = self.tmp / "manifest.txt"
+        manifest.write_text("# term 1\ns3://bucket/2024/a.jsonl\n\ns3://other/x.jsonl\n")
+        self.assertEqual(
+            [backfill.object_uri(ref) for ref in backfill.iter_manifest_refs(str(manifest))],
+            ["s3://bucket/2024/a.jsonl", "s3://other/x.jsonl"],
+        )
+
+    def test_backfill_checkpoints_committed_objects_and_resumes(self):
+        refs = [lambda_function.S3ObjectRef(bucket="bucket", key=f"2024/{name}.jsonl") for name in "abcde"]
+        state_file = str(self.tmp / "backfill.state")
+
+        def load(ref):
+            if ref.key == "2024/c.jsonl":
+                raise ValueError("Invalid JSON")
+            return None if ref.key == "2024/e.jsonl" else self._table_with_rows(2)
+
+        with mock.patch.object(lambda_function, "load_json_lines_as_table", side_effect=load) as load_mock:
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT) as insert_mock:
+                result = backfill.run_backfill(refs, state_file=state_file, processes=1, objects_per_task=3)
+
+        self.assertEqual(sorted(result.committed), [f"s3://bucket/2024/{name}.jsonl" for name in "abde"])
+        self.assertEqual(list(result.failed), ["s3://bucket/2024/c.jsonl"])
+        self.assertEqual(result.rows, 6)
+        # a+b reach the 4-row target; d is flushed at the end of the second task.
+        self.assertEqual([call.args[1] for call in insert_mock.call_args_list], [4, 2])
+        self.assertEqual(load_mock.call_count, 5)
+
+        with mock.patch.object(
+            lambda_function, "load_json_lines_as_table", return_value=self._table_with_rows(1)
+        ) as load_mock:
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT):
+                resumed = backfill.run_backfill(refs, state_file=state_file, processes=1, objects_per_task=3)
+
+        self.assertEqual([call.args[0].key for call in load_mock.call_args_list], ["2024/c.jsonl"])
+        self.assertEqual(resumed.committed, ["s3://bucket/2024/c.jsonl"])
+        self.assertEqual(len(backfill.load_checkpoint(state_file)), 5)
+
+    def test_dry_run_is_checkpointed_but_not_skipped_by_a_real_run(self):
+        refs = [lambda_function.S3ObjectRef(bucket="bucket", key=f"2024/{name}.jsonl") for name in "ab"]
+        state_file = str(self.tmp / "backfill.state")
+
+        with mock.patch.object(lambda_function, "load_json_lines_as_table", return_value=self._table_with_rows(2)):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT) as insert_mock:
+                dry = backfill.run_backfill(refs, state_file=state_file, processes=1, objects_per_task=5, dry_run=True)
+                insert_mock.assert_not_called()
+                real = backfill.run_backfill(refs, state_file=state_file, processes=1, objects_per_task=5)
+
+        self.assertEqual(len(dry.committed), 2)
+        self.assertEqual(len(real.committed), 2)
+        self.assertEqual(insert_mock.call_count, 1)
+        statuses = [json.loads(line)["status"] for line in Path(state_file).read_text().splitlines()]
+        self.assertEqual(statuses, ["dry_run", "dry_run", "committed", "committed"])
+
+    def test_process_pool_ingests_every_object_once(self):
+        line = json.dumps({"id": "evt", "actor": {"account": {"name": 1000}}}).encode("utf-8")
+        objects = {("bucket", f"2024/{index}.jsonl"): b"\n".join([line] * (index + 1)) for index in range(6)}
+        refs = [lambda_function.S3ObjectRef(bucket=bucket, key=key) for bucket, key in objects]
+        state_file = str(self.tmp / "backfill.state")
+
+        with LocalS3AndClickHouse(objects) as server:
+            with mock.patch.dict(
+                os.environ,
+                {
+                    "AWS_ENDPOINT_URL_S3": server.url,
+                    "AWS_ACCESS_KEY_ID": "test",
+                    "AWS_SECRET_ACCESS_KEY": "test",
+                    "AWS_DEFAULT_REGION": "us-east-1",
+                    "CLICKHOUSE_URL": server.url,
+                    "TARGET_ROWS_PER_INSERT": "1000",
+                },
+                clear=False,
+            ), mock.patch.dict(sys.modules, {"lambda_function": backfill.lambda_function}):
+                # Pickling resolves S3ObjectRef by module name; other test files reload lambda_function.
+                result = backfill.run_backfill(refs, state_file=state_file, processes=2, objects_per_task=2)
+
+        self.assertEqual(result.failed, {})
+        self.assertEqual(sorted(result.committed), sorted(backfill.object_uri(ref) for ref in refs))
+        self.assertEqual(result.rows, 21)
+        # One insert per two-object task, each from a worker process.
+        self.assertEqual(sorted(server.inserted_rows), [3, 7, 11])
+        self.assertEqual(backfill.load_checkpoint(state_file), set(result.committed))
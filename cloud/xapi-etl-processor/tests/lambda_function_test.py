@@ -1,12 +1,22 @@
+import gzip
 import hashlib
 import importlib.util
+import io
 import json
 import os
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
 from unittest import SkipTest, TestCase, mock
 
+from botocore.response import StreamingBody
+
 try:
     import pytest
 except ModuleNotFoundError:  # pragma: no cover - local fallback when pytest is absent
@@ -28,6 +38,10 @@ lambda_function = importlib.util.module_from_spec(spec)
 sys.modules[spec.name] = lambda_function
 spec.loader.exec_module(lambda_function)  # type: ignore[misc]
 
+# What a successful insert_into_clickhouse returns; mocks hand it back so the
+# committed-sub-batch log sees the same fields as in production.
+INSERT_RESULT = lambda_function.InsertResult(summary={}, content_encoding="none", wire_bytes=0, duration_seconds=0.0)
+
 
 class FakeBody:
     def __init__(self, lines):
@@ -38,6 +52,32 @@ class FakeBody:
             yield line
 
 
+class FakeRangedS3:
+    """get_object stand-in that serves byte ranges of one in-memory object."""
+
+    def __init__(self, data, etag='"etag"', content_encoding=None):
+        self.data = data
+        self.etag = etag
+        self.content_encoding = content_encoding
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get_object(self, **kwargs):
+        with self._lock:
+            self.calls.append(kwargs)
+        response = {"ETag": self.etag}
+        if self.content_encoding:
+            response["ContentEncoding"] = self.content_encoding
+        content = self.data
+        if "Range" in kwargs:
+            start, end = (int(value) for value in kwargs["Range"].split("=", 1)[1].split("-"))
+            content = self.data[start : end + 1]
+            response["ContentRange"] = f"bytes {start}-{start + len(content) - 1}/{len(self.data)}"
+        response["ContentLength"] = len(content)
+        response["Body"] = StreamingBody(io.BytesIO(content), len(content))
+        return response
+
+
 class FakeContext:
     def __init__(self, remaining_time_ms=None):
         self.remaining_time_ms = remaining_time_ms
@@ -48,6 +88,71 @@ class FakeContext:
         return self.remaining_time_ms
 
 
+class FakeClickHouseServer:
+    """Local HTTP stand-in that records insert requests like ClickHouse would receive them."""
+
+    def __init__(self):
+        self.requests = []
+        self.response_headers = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):  # noqa: N802 - http.server naming
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    body = self._read_chunked_body()
+                else:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+                parsed = urlparse(self.path)
+                server.requests.append(
+                    {
+                        "params": {key: values[0] for key, values in parse_qs(parsed.query).items()},
+                        "headers": dict(self.headers),
+                        "body": body,
+                    }
+                )
+                status, response_body = server.respond(server.requests[-1])
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(response_body)))
+                for name, value in server.response_headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            def _read_chunked_body(self):
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b";", 1)[0].strip(), 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return b"".join(chunks)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+
+            def log_message(self, *args):  # silence test output
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def respond(self, _request):
+        return 200, b""
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
 class LambdaFunctionTests(TestCase):
     def setUp(self):
         patcher = mock.patch.object(lambda_function, "s3_client")
@@ -62,6 +167,38 @@ class LambdaFunctionTests(TestCase):
             "LAMBDA_TIMEOUT_SAFETY_MARGIN_MS",
             "CLICKHOUSE_TIMEOUT_SECONDS",
             "MAX_MESSAGES_PER_INVOCATION_TO_PROCESS",
+            "S3_FETCH_CONCURRENCY",
+            "JSONL_INGESTION_MODE",
+            "CLICKHOUSE_STREAMING_INSERT",
+            "STREAMING_ROW_GROUP_ROWS",
+            "MAX_INFLIGHT_INSERTS",
+            "ADAPTIVE_BATCH_SIZING",
+            "ADAPTIVE_TARGET_FLUSH_MS",
+            "ADAPTIVE_MIN_ROWS_PER_INSERT",
+            "PAYLOAD_ESTIMATOR_CALIBRATION_ROWS",
+            "CLICKHOUSE_INSERT_FORMAT",
+            "EVENT_HASH_MODE",
+            "EVENT_HASH_OUTPUT",
+            "JSONL_BATCH_ROWS",
+            "MAX_S3_OBJECT_BYTES",
+            "S3_RANGED_GET_THRESHOLD_BYTES",
+            "S3_RANGE_PART_BYTES",
+            "S3_RANGE_CONCURRENCY",
+            "S3_OBJECT_COMPRESSION",
+            "EMF_METRICS",
+            "EMF_NAMESPACE",
+            "EMF_DIMENSIONS",
+            "PROFILE_SAMPLE_RATE",
+            "PROFILE_INTERVAL_MS",
+            "PROFILE_TOP_N",
+            "PROFILE_TRACEMALLOC_FRAMES",
+            "PROFILE_S3_URI",
+            "TABLE_CACHE_MAX_BYTES",
+            "TABLE_CACHE_DIR",
+            "TABLE_CACHE_DIR_MAX_BYTES",
+            "BISECT_FAILED_SUB_BATCHES",
+            "QUARANTINE_SINK",
+            "QUARANTINE_MAX_ERROR_RATE",
         ]:
             self.addCleanup(lambda name=env_var: os.environ.pop(name, None))
 
@@ -117,7 +254,7 @@ class LambdaFunctionTests(TestCase):
             "Body": FakeBody(['{"user": "alice"}'])
         }
 
-        with mock.patch.object(lambda_function, "insert_into_clickhouse") as insert_mock:
+        with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT) as insert_mock:
             with mock.patch.dict(
                 os.environ,
                 {
@@ -165,7 +302,7 @@ class LambdaFunctionTests(TestCase):
 
         os.environ["DRY_RUN"] = "true"
 
-        with mock.patch.object(lambda_function, "insert_into_clickhouse") as insert_mock:
+        with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT) as insert_mock:
             with mock.patch.dict(
                 os.environ,
                 {
@@ -206,7 +343,7 @@ class LambdaFunctionTests(TestCase):
             "Body": FakeBody(['{"user": }'])
         }
 
-        with mock.patch.object(lambda_function, "insert_into_clickhouse") as insert_mock:
+        with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT) as insert_mock:
             with mock.patch.dict(
                 os.environ,
                 {
@@ -243,6 +380,482 @@ class LambdaFunctionTests(TestCase):
         source_lines = table.column("source_line").to_pylist()
         self.assertEqual(source_lines, [1, 2])
 
+    def test_load_json_lines_streams_oversized_object_in_bounded_batches(self):
+        statements = [
+            {"actor": {"account": {"name": f"user-{index}"}}, "timestamp": "2025-05-21T13:41:06Z"}
+            for index in range(5)
+        ]
+        payload_lines = [json.dumps(item) for item in statements]
+        ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/bulk.jsonl")
+
+        self.mock_s3.get_object.return_value = {"Body": FakeBody(payload_lines), "ETag": '"etag"'}
+        expected = lambda_function.load_json_lines_as_table(ref)
+
+        self.mock_s3.get_object.return_value = {
+            "Body": FakeBody(payload_lines),
+            "ETag": '"etag"',
+            "ContentLength": 10_000,
+        }
+        with mock.patch.dict(
+            os.environ,
+            {"MAX_S3_OBJECT_BYTES": "1000", "JSONL_BATCH_ROWS": "2", "JSONL_INGESTION_MODE": "arrow"},
+            clear=False,
+        ):
+            with mock.patch.object(lambda_function, "_load_json_lines_with_arrow_reader") as arrow_reader:
+                with mock.patch.object(lambda_function, "log_stage") as log_stage:
+                    # Arrow memory held elsewhere in the process, e.g. by another fetch.
+                    other_allocation = lambda_function.pa.allocate_buffer(8 * 1024 * 1024)
+                    table = lambda_function.load_json_lines_as_table(ref)
+                    del other_allocation
+
+        arrow_reader.assert_not_called()
+        self.assertEqual(table.to_pylist(), expected.to_pylist())
+        parsed = [call.kwargs for call in log_stage.call_args_list if call.args[0] == "object_parsed"]
+        self.assertEqual(len(parsed), 1)
+        self.assertEqual(parsed[0]["batch_count"], 3)
+        self.assertTrue(parsed[0]["streamed"])
+        # Per object: at least the finished table, and unaffected by Arrow
+        # memory that other threads or earlier objects hold.
+        self.assertGreaterEqual(parsed[0]["arrow_peak_bytes"], table.nbytes)
+        self.assertLess(parsed[0]["arrow_peak_bytes"], 4 * table.nbytes)
+
+    def test_object_parsed_splits_fetch_parse_and_normalize_time(self):
+        data = b"".join(
+            json.dumps({"actor": {"account": {"name": 1000 + index}}}).encode("utf-8") + b"\n"
+            for index in range(50)
+        )
+        fake_s3 = FakeRangedS3(data)
+
+        def slow_get_object(**kwargs):
+            time.sleep(0.05)
+            return fake_s3.get_object(**kwargs)
+
+        ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/timed.jsonl")
+        for mode in ("python", "arrow"):
+            with self.subTest(mode=mode):
+                with mock.patch.object(lambda_function.s3_client, "get_object", side_effect=slow_get_object):
+                    with mock.patch.dict(os.environ, {"JSONL_INGESTION_MODE": mode}, clear=False):
+                        with mock.patch.object(lambda_function, "log_stage") as log_stage:
+                            lambda_function.load_json_lines_as_table(ref)
+
+                parsed = [call.kwargs for call in log_stage.call_args_list if call.args[0] == "object_parsed"]
+                self.assertEqual(len(parsed), 1)
+                self.assertEqual(parsed[0]["ingestion_mode"], mode)
+                self.assertEqual(parsed[0]["row_count"], 50)
+                self.assertGreaterEqual(parsed[0]["fetch_ms"], 50)
+                self.assertGreater(parsed[0]["normalize_ms"], 0)
+                self.assertLessEqual(
+                    parsed[0]["fetch_ms"] + parsed[0]["parse_ms"] + parsed[0]["normalize_ms"],
+                    parsed[0]["duration_ms"] + 1,
+                )
+
+    def test_table_cache_serves_unchanged_objects_without_s3(self):
+        data = b"".join(
+            json.dumps({"actor": {"account": {"name": 1000 + index}}}).encode("utf-8") + b"\n"
+            for index in range(20)
+        )
+        fake_s3 = FakeRangedS3(data, etag='"v1"')
+        ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/cached.jsonl", etag="v1")
+
+        with mock.patch.object(lambda_function, "_TABLE_CACHE", None):
+            with mock.patch.object(lambda_function, "s3_client", fake_s3):
+                with mock.patch.dict(os.environ, {"TABLE_CACHE_MAX_BYTES": str(1024 * 1024)}, clear=False):
+                    first = lambda_function.load_json_lines_as_table(ref)
+                    second = lambda_function.load_json_lines_as_table(ref)
+                    self.assertEqual(len(fake_s3.calls), 1)
+                    self.assertIs(second, first)
+
+                    # The object was overwritten: the new etag must bypass the cached table.
+                    fake_s3.etag = '"v2"'
+                    lambda_function.load_json_lines_as_table(
+                        lambda_function.S3ObjectRef(bucket="bucket", key="events/cached.jsonl", etag="v2")
+                    )
+                    self.assertEqual(len(fake_s3.calls), 2)
+                    self.assertIsNone(lambda_function.get_table_cache().get("bucket", "events/cached.jsonl", "v1"))
+                    self.assertIsNotNone(lambda_function.get_table_cache().get("bucket", "events/cached.jsonl", "v2"))
+                    stats = lambda_function.get_table_cache().stats()
+
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 3))
+        self.assertEqual(stats["memory_entries"], 1)
+        self.assertTrue(stats["memory_bytes"] > 0)
+
+    def test_table_cache_spills_evicted_tables_to_disk(self):
+        tables = {key: self._table_with_rows(200) for key in ("a", "b")}
+        budget = tables["a"].nbytes + tables["a"].nbytes // 2
+        with tempfile.TemporaryDirectory() as spill_dir:
+            cache = lambda_function.TableCache(budget, spill_dir, spill_max_bytes=10 * 1024 * 1024)
+            cache.put("bucket", "a", '"etag-a"', tables["a"])
+            cache.put("bucket", "b", "etag-b", tables["b"])
+            self.assertEqual(cache.stats()["spilled_entries"], 1)
+            self.assertEqual(len(os.listdir(spill_dir)), 1)
+
+            table, tier = cache.get("bucket", "a", "etag-a")
+            self.assertEqual(tier, "disk")
+            self.assertTrue(table.equals(tables["a"]))
+            # Promoting "a" back to memory pushes "b" out to disk in turn.
+            self.assertEqual(cache.get("bucket", "b", "etag-b")[1], "disk")
+
+            self.assertIsNone(cache.get("bucket", "a", "etag-changed"))
+            cache.put("bucket", "a", "etag-changed", tables["b"])
+            self.assertEqual(cache.get("bucket", "a", "etag-changed")[1], "memory")
+            self.assertEqual(cache.stats()["spilled_entries"] + cache.stats()["memory_entries"], 2)
+            self.assertEqual(len(os.listdir(spill_dir)), cache.stats()["spilled_entries"])
+            self.assertLessEqual(cache.memory_bytes, budget)
+
+    def test_iter_lines_from_chunks_matches_botocore_line_splitting(self):
+        data = b'{"a": 1}\r\n{"b": 2}\n\n{"c": "x\\ny"}\n{"d": 4}'
+        expected = list(StreamingBody(io.BytesIO(data), len(data)).iter_lines(chunk_size=64))
+
+        for chunk_size in (1, 3, 7, len(data)):
+            chunks = [data[offset : offset + chunk_size] for offset in range(0, len(data), chunk_size)]
+            self.assertEqual(list(lambda_function.iter_lines_from_chunks(chunks)), expected, chunk_size)
+
+    def test_s3_pool_covers_ranged_reads_of_every_prefetch_worker(self):
+        for env, expected in (
+            ({"S3_MAX_POOL_CONNECTIONS": "10", "S3_FETCH_CONCURRENCY": "4", "S3_RANGE_CONCURRENCY": "4"}, 20),
+            ({"S3_FETCH_CONCURRENCY": "2", "S3_RANGE_CONCURRENCY": "3"}, 10),
+            ({"S3_FETCH_CONCURRENCY": "8", "S3_RANGE_CONCURRENCY": "6"}, 56),
+            ({"S3_MAX_POOL_CONNECTIONS": "64"}, 64),
+        ):
+            with self.subTest(env=env):
+                with mock.patch.dict(os.environ, env):
+                    self.assertEqual(lambda_function.resolve_s3_max_pool_connections(), expected)
+
+    def test_load_json_lines_downloads_large_objects_with_parallel_ranges(self):
+        statements = [
+            {"actor": {"account": {"name": f"user-{index}"}}, "timestamp": "2025-05-21T13:41:06Z"}
+            for index in range(40)
+        ]
+        data = "\n".join(json.dumps(item) for item in statements).encode("utf-8") + b"\n"
+        self.mock_s3.get_object.return_value = {
+            "Body": FakeBody([json.dumps(item) for item in statements]),
+            "ETag": '"etag"',
+        }
+        expected = lambda_function.load_json_lines_as_table(
+            lambda_function.S3ObjectRef(bucket="bucket", key="events/big.jsonl")
+        ).to_pylist()
+
+        for size_hint in (None, len(data)):
+            with self.subTest(size_hint=size_hint):
+                fake_s3 = FakeRangedS3(data)
+                ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/big.jsonl", size=size_hint)
+                with mock.patch.object(lambda_function, "s3_client", fake_s3):
+                    with mock.patch.dict(
+                        os.environ,
+                        {
+                            "S3_RANGED_GET_THRESHOLD_BYTES": "100",
+                            "S3_RANGE_PART_BYTES": "97",
+                            "S3_RANGE_CONCURRENCY": "3",
+                        },
+                        clear=False,
+                    ):
+                        table = lambda_function.load_json_lines_as_table(ref)
+
+                self.assertEqual(table.to_pylist(), expected)
+                ranged_calls = [call for call in fake_s3.calls if "Range" in call]
+                self.assertEqual(len(ranged_calls), len(fake_s3.calls) - (0 if size_hint else 1))
+                self.assertEqual(len(fake_s3.calls), -(-len(data) // 97))
+                self.assertTrue(all(call.get("IfMatch") == '"etag"' for call in ranged_calls[1 if size_hint else 0 :]))
+
+    def test_ranged_reader_stops_part_downloads_when_consumer_stops(self):
+        data = b"x" * 1000
+        fake_s3 = FakeRangedS3(data)
+        ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/big.jsonl")
+        first_body = fake_s3.get_object(Bucket="bucket", Key=ref.key, Range="bytes=0-99")["Body"]
+        reader = lambda_function.RangedObjectReader(
+            ref, first_body, size=len(data), etag='"etag"', part_size=100, concurrency=4
+        )
+        with mock.patch.object(lambda_function, "s3_client", fake_s3):
+            chunks = reader.iter_chunks()
+            self.assertEqual(next(chunks), data[:100])
+            chunks.close()
+
+        self.assertEqual([thread.name for thread in threading.enumerate() if thread.name.startswith("s3-range")], [])
+        self.assertLessEqual(len(fake_s3.calls), 1 + 4)
+
+    def test_prefetcher_close_stops_running_fetches_before_returning(self):
+        started = threading.Event()
+        outcomes = []
+
+        def fetch(record):
+            if record["messageId"] == "msg-1":
+                return record
+            started.set()
+            try:
+                while True:
+                    lambda_function.raise_if_fetch_cancelled()
+                    time.sleep(0.01)
+            except lambda_function.FetchCancelled:
+                outcomes.append("cancelled")
+                raise
+
+        prefetcher = lambda_function.MessagePrefetcher([self._message("msg-1"), self._message("msg-2")], 2)
+        with mock.patch.object(lambda_function, "fetch_message_table", side_effect=fetch):
+            prefetcher.take(0)
+            self.assertTrue(started.wait(timeout=5))
+            prefetcher.close()
+
+        self.assertEqual(outcomes, ["cancelled"])
+
+    def test_load_json_lines_reads_whole_object_when_event_size_is_stale(self):
+        statements = [{"actor": {"account": {"name": f"user-{index}"}}} for index in range(40)]
+        data = "\n".join(json.dumps(item) for item in statements).encode("utf-8") + b"\n"
+        fake_s3 = FakeRangedS3(data)
+        # The event reports a large object, but it has since been overwritten with
+        # one under the ranged-GET threshold that still spans several parts.
+        ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/big.jsonl", size=len(data) * 10)
+        with mock.patch.object(lambda_function, "s3_client", fake_s3):
+            with mock.patch.dict(
+                os.environ,
+                {"S3_RANGED_GET_THRESHOLD_BYTES": str(len(data) * 2), "S3_RANGE_PART_BYTES": "97"},
+                clear=False,
+            ):
+                table = lambda_function.load_json_lines_as_table(ref)
+
+        self.assertEqual(table.num_rows, len(statements))
+        self.assertEqual(len(fake_s3.calls), -(-len(data) // 97))
+        self.assertTrue(all("Range" in call for call in fake_s3.calls))
+
+    def test_load_json_lines_decompresses_gzip_and_zstd_objects(self):
+        statements = [
+            {"actor": {"account": {"name": f"user-{index}"}}, "timestamp": "2025-05-21T13:41:06Z"}
+            for index in range(200)
+        ]
+        data = "\n".join(json.dumps(item) for item in statements).encode("utf-8") + b"\n"
+        self.mock_s3.get_object.return_value = {
+            "Body": FakeBody([json.dumps(item) for item in statements]),
+            "ETag": '"etag"',
+        }
+        expected = (
+            lambda_function.load_json_lines_as_table(lambda_function.S3ObjectRef(bucket="bucket", key="events/plain.jsonl"))
+            .drop_columns(["source_file"])
+            .to_pylist()
+        )
+
+        cases = [
+            # Concatenated gzip members, detected from the magic bytes only.
+            ("magic", "events/batch.jsonl", gzip.compress(data[:500]) + gzip.compress(data[500:]), None, {}),
+            ("content_encoding", "events/batch.jsonl", lambda_function.pa.compress(data, "zstd", asbytes=True), "zstd", {}),
+            # Suffix detection on top of parallel ranged parts.
+            (
+                "suffix_ranged",
+                "events/batch.jsonl.zst",
+                lambda_function.pa.compress(data, "zstd", asbytes=True),
+                None,
+                {"S3_RANGED_GET_THRESHOLD_BYTES": "100", "S3_RANGE_PART_BYTES": "50"},
+            ),
+        ]
+        for name, key, payload, content_encoding, env in cases:
+            with self.subTest(name):
+                fake_s3 = FakeRangedS3(payload, content_encoding=content_encoding)
+                ref = lambda_function.S3ObjectRef(bucket="bucket", key=key)
+                with mock.patch.object(lambda_function, "s3_client", fake_s3):
+                    with mock.patch.dict(os.environ, env, clear=False):
+                        with self.assertLogs(lambda_function.logger, level="INFO") as captured:
+                            table = lambda_function.load_json_lines_as_table(ref)
+
+                self.assertEqual(table.drop_columns(["source_file"]).to_pylist(), expected)
+                stage = next(
+                    json.loads(line.split("ETL stage ", 1)[1])
+                    for line in captured.output
+                    if '"stage": "object_decompressed"' in line
+                )
+                self.assertEqual(stage["compressed_bytes"], len(payload))
+                self.assertEqual(stage["uncompressed_bytes"], len(data))
+                self.assertGreaterEqual(stage["decompress_ms"], 0)
+
+    def test_load_json_lines_rejects_truncated_compressed_object(self):
+        payload = gzip.compress(b'{"actor": {"mbox": "mailto:a@example.edu"}}\n' * 500)[:-16]
+        with mock.patch.object(lambda_function, "s3_client", FakeRangedS3(payload)):
+            with self.assertRaisesRegex(ValueError, "Unable to decompress gzip"):
+                lambda_function.load_json_lines_as_table(
+                    lambda_function.S3ObjectRef(bucket="bucket", key="events/batch.jsonl.gz")
+                )
+
+    def test_arrow_ingestion_mode_matches_per_line_parsing(self):
+        oli = "http://oli.cmu.edu/extensions/"
+        statements = [
+            {
+                "actor": {"account": {"name": 15474, "homePage": "https://proton.oli.cmu.edu"}},
+                "verb": {"id": "http://adlnet.gov/expapi/verbs/completed"},
+                "object": {"definition": {"type": "http://adlnet.gov/expapi/activities/question"}},
+                "context": {
+                    "extensions": {
+                        f"{oli}section_id": 2161,
+                        f"{oli}hints_requested": ["hint-1"],
+                        f"{oli}attached_objectives": [120498, 7],
+                    }
+                },
+                "result": {
+                    "response": {"files": []},
+                    "extensions": {f"{oli}feedback": {"id": "2475577451", "content": []}},
+                },
+                "timestamp": "2025-05-21T13:41:06Z",
+            },
+            {
+                "actor": {"mbox": "mailto:student@example.edu"},
+                "verb": {"id": "https://w3id.org/xapi/video/verbs/played"},
+                "object": {"id": "https://cdn.example.edu/video.mp4"},
+                "result": {"extensions": {"https://w3id.org/xapi/video/extensions/time": 12}},
+                "timestamp": "2025-05-21T13:41:07.5+00:00",
+            },
+        ]
+        payload_lines = [json.dumps(item) for item in statements]
+        ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/file.jsonl")
+
+        tables = {}
+        for mode in ["python", "arrow"]:
+            self.mock_s3.get_object.return_value = {
+                "Body": FakeBody(["", *payload_lines]),
+                "ETag": '"etag-value"',
+            }
+            with mock.patch.dict(os.environ, {"JSONL_INGESTION_MODE": mode}, clear=False):
+                with mock.patch.object(
+                    lambda_function,
+                    "_derive_raw_events_from_arrow",
+                    wraps=lambda_function._derive_raw_events_from_arrow,
+                ) as derive_mock:
+                    tables[mode] = lambda_function.load_json_lines_as_table(ref)
+            self.assertEqual(derive_mock.called, mode == "arrow")
+
+        self.assertTrue(tables["arrow"].schema.equals(tables["python"].schema))
+        self.assertEqual(tables["arrow"].to_pylist(), tables["python"].to_pylist())
+
+    def test_arrow_ingestion_mode_reads_string_valued_fields_in_blocks(self):
+        oli = "http://oli.cmu.edu/extensions/"
+
+        def statement(index, name, response=None, feedback=None):
+            result = {"extensions": {f"{oli}feedback": feedback}} if feedback is not None else {}
+            if response is not None:
+                result["response"] = response
+            return {
+                "actor": {"account": {"name": name}, "mbox": "mailto:fallback@example.edu"},
+                "verb": {"id": "http://adlnet.gov/expapi/verbs/answered"},
+                "context": {"extensions": {f"{oli}section_id": index}},
+                "result": result,
+                "timestamp": "2025-05-21T13:41:06Z",
+            }
+
+        statements = [
+            statement(0, 15474, {"input": "a"}, {"id": "f"}),
+            statement(1, 0, {"files": []}),
+            # Producers that send string ids, plain-text responses and feedback.
+            statement(2, "user-2", "free text", "Correct!"),
+            statement(3, "", "", ""),
+            statement(4, 15475, "42", {"content": []}),
+            statement(5, "user-5", {"input": "b"}, "Try again"),
+        ]
+        cases = {
+            "variants": (statements, None),
+            # A response no Arrow type can hold only sends its own block per-line.
+            "unreadable_last_block": (
+                statements + [statement(6, "user-6", ["a", "b"])],
+                "after line 6",
+            ),
+        }
+        ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/file.jsonl")
+        for name, (items, fallback) in cases.items():
+            with self.subTest(name):
+                data = b"".join(json.dumps(item).encode("utf-8") + b"\n" for item in items)
+                tables = {}
+                for mode in ["python", "arrow"]:
+                    env = {"JSONL_INGESTION_MODE": mode, "S3_RANGED_GET_THRESHOLD_BYTES": "0"}
+                    with mock.patch.object(lambda_function, "s3_client", FakeRangedS3(data)):
+                        with mock.patch.object(lambda_function, "_ARROW_JSON_BLOCK_BYTES", 1):
+                            with mock.patch.dict(os.environ, env, clear=False):
+                                with mock.patch.object(
+                                    lambda_function,
+                                    "_derive_raw_events_from_arrow",
+                                    wraps=lambda_function._derive_raw_events_from_arrow,
+                                ) as derive_mock:
+                                    with self.assertLogs(lambda_function.logger, level="INFO") as captured:
+                                        tables[mode] = lambda_function.load_json_lines_as_table(ref)
+
+                rejected = [line for line in captured.output if "Arrow JSON reader rejected" in line]
+                if fallback is None:
+                    self.assertEqual(rejected, [])
+                else:
+                    self.assertEqual(len(rejected), 1)
+                    self.assertIn(fallback, rejected[0])
+                # One Arrow block per statement: every block stayed on the fast path.
+                self.assertEqual(derive_mock.call_count, len(statements))
+                self.assertTrue(tables["arrow"].schema.equals(tables["python"].schema))
+                self.assertEqual(tables["arrow"].to_pylist(), tables["python"].to_pylist())
+
+    def test_arrow_ingestion_mode_falls_back_to_per_line_errors(self):
+        self.mock_s3.get_object.return_value = {
+            "Body": FakeBody(['{"actor": {"mbox": "mailto:a@example.edu"}}', '{"actor": }']),
+        }
+
+        with mock.patch.dict(os.environ, {"JSONL_INGESTION_MODE": "arrow"}, clear=False):
+            with self.assertRaisesRegex(ValueError, "Invalid JSON in s3://bucket/events/file.jsonl"):
+                lambda_function.load_json_lines_as_table(
+                    lambda_function.S3ObjectRef(bucket="bucket", key="events/file.jsonl")
+                )
+
+    def test_load_json_lines_quarantines_bad_lines_to_local_sink(self):
+        self.mock_s3.get_object.return_value = {
+            "Body": FakeBody(['{"id": "evt-1"}', '{"actor": }', '{"id": "evt-3"}']),
+            "ETag": '"etag-value"',
+        }
+
+        with tempfile.TemporaryDirectory() as sink:
+            with mock.patch.dict(
+                os.environ,
+                {"JSONL_INGESTION_MODE": "arrow", "QUARANTINE_SINK": sink, "QUARANTINE_MAX_ERROR_RATE": "0.5"},
+                clear=False,
+            ):
+                table = lambda_function.load_json_lines_as_table(
+                    lambda_function.S3ObjectRef(bucket="bucket", key="events/file.jsonl")
+                )
+            quarantine_path = Path(sink, "bucket", "events", "file.jsonl.etag-value.quarantine.jsonl")
+            records = [json.loads(line) for line in quarantine_path.read_text().splitlines()]
+
+        self.assertEqual(table.column("source_line").to_pylist(), [1, 3])
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["source_file"], "s3://bucket/events/file.jsonl")
+        self.assertEqual(records[0]["line_number"], 2)
+        self.assertEqual(records[0]["raw_line"], '{"actor": }')
+        self.assertTrue(records[0]["error"].startswith("JSONDecodeError"))
+
+    def test_load_json_lines_quarantines_to_s3_under_error_rate_ceiling(self):
+        ref = lambda_function.S3ObjectRef(bucket="bucket", key="events/file.jsonl")
+        with mock.patch.dict(
+            os.environ,
+            {"QUARANTINE_SINK": "s3://quarantine/bad-rows/", "QUARANTINE_MAX_ERROR_RATE": "0.5"},
+            clear=False,
+        ):
+            self.mock_s3.get_object.return_value = {
+                "Body": FakeBody(['{"id": "evt-1"}', "not json", '{"id": "evt-3"}']),
+                "ETag": '"etag-value"',
+            }
+            table = lambda_function.load_json_lines_as_table(ref)
+
+            self.assertEqual(table.num_rows, 2)
+            put_kwargs = self.mock_s3.put_object.call_args.kwargs
+            self.assertEqual(put_kwargs["Bucket"], "quarantine")
+            self.assertEqual(put_kwargs["Key"], "bad-rows/bucket/events/file.jsonl.etag-value.quarantine.jsonl")
+            self.assertEqual(json.loads(put_kwargs["Body"])["line_number"], 2)
+
+            self.mock_s3.put_object.reset_mock()
+            self.mock_s3.get_object.return_value = {
+                "Body": FakeBody(['{"id": "evt-1"}', "not json", "[1, 2"]),
+                "ETag": '"etag-value"',
+            }
+            with self.assertRaisesRegex(ValueError, "2 of 3 lines .* QUARANTINE_MAX_ERROR_RATE"):
+                lambda_function.load_json_lines_as_table(ref)
+            self.mock_s3.put_object.assert_not_called()
+
+            # A rate of 0 turns quarantining off: even one bad line fails the object.
+            self.mock_s3.get_object.return_value = {
+                "Body": FakeBody(['{"id": "evt-1"}', "not json", '{"id": "evt-3"}']),
+                "ETag": '"etag-value"',
+            }
+            with mock.patch.dict(os.environ, {"QUARANTINE_MAX_ERROR_RATE": "0"}):
+                with self.assertRaisesRegex(ValueError, "1 of 3 lines .* QUARANTINE_MAX_ERROR_RATE=0.0"):
+                    lambda_function.load_json_lines_as_table(ref)
+            self.mock_s3.put_object.assert_not_called()
+
     def test_lambda_handler_sends_failed_prepare_to_dlq(self):
         body = json.dumps({"bucket": "bucket", "key": "events/file.jsonl"})
         event = {
@@ -376,6 +989,129 @@ class LambdaFunctionTests(TestCase):
         )
         sqs_mock.send_message.assert_not_called()
 
+    def _run_with_poison_message(self, rejection, extra_env):
+        # Row counts 1, 2, 4 and 8 make every sub-batch's row count identify its
+        # messages; any sub-batch containing msg-3 (4 rows) is rejected.
+        event = {"Records": [self._message(f"msg-{index}") for index in range(1, 5)]}
+        insert_row_counts = []
+
+        def reject_poison(_payload, row_count, **_kwargs):
+            insert_row_counts.append(row_count)
+            if row_count & 4:
+                raise rejection
+            return INSERT_RESULT
+
+        with mock.patch.object(
+            lambda_function,
+            "build_arrow_table_from_s3_objects",
+            side_effect=[self._table_with_rows(rows) for rows in (1, 2, 4, 8)],
+        ):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", side_effect=reject_poison):
+                with mock.patch.dict(
+                    os.environ,
+                    {"CLICKHOUSE_DATABASE": "db", "CLICKHOUSE_TABLE": "tbl", "TARGET_ROWS_PER_INSERT": "100",
+                     **extra_env},
+                    clear=False,
+                ):
+                    result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+        return result, insert_row_counts
+
+    def test_lambda_handler_bisects_rejected_sub_batch_to_isolate_poison_message(self):
+        result, insert_row_counts = self._run_with_poison_message(
+            lambda_function.ClickHouseInsertError(400, "Code: 53. TYPE_MISMATCH"),
+            {"BISECT_FAILED_SUB_BATCHES": "true"},
+        )
+
+        self.assertEqual(result["batchItemFailures"], [{"itemIdentifier": "msg-3"}])
+        self.assertEqual(insert_row_counts, [15, 3, 12, 4, 8])
+
+    def test_lambda_handler_does_not_bisect_when_disabled_or_server_unavailable(self):
+        all_failed = [{"itemIdentifier": f"msg-{index}"} for index in range(1, 5)]
+        cases = [
+            (lambda_function.ClickHouseInsertError(400, "TYPE_MISMATCH"), {}),
+            (lambda_function.ClickHouseInsertError(503, "overloaded"), {"BISECT_FAILED_SUB_BATCHES": "true"}),
+            (RuntimeError("connection reset"), {"BISECT_FAILED_SUB_BATCHES": "true"}),
+        ]
+        for rejection, extra_env in cases:
+            with self.subTest(error=str(rejection), env=extra_env):
+                result, insert_row_counts = self._run_with_poison_message(rejection, extra_env)
+                self.assertEqual(result["batchItemFailures"], all_failed)
+                self.assertEqual(insert_row_counts, [15])
+
+    def test_oversized_message_is_inserted_in_slices_of_max_rows(self):
+        event = {"Records": [self._message("msg-1"), self._message("msg-2")]}
+        insert_calls = []
+
+        def capture_insert(_payload, row_count, **kwargs):
+            insert_calls.append((row_count, kwargs["insert_token"]))
+            if len(insert_calls) == 4:
+                raise lambda_function.ClickHouseInsertError(500, "MEMORY_LIMIT_EXCEEDED")
+            return INSERT_RESULT
+
+        with mock.patch.object(
+            lambda_function,
+            "build_arrow_table_from_s3_objects",
+            side_effect=[self._table_with_rows(2500), self._table_with_rows(1200)],
+        ):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", side_effect=capture_insert):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "TARGET_ROWS_PER_INSERT": "1000",
+                        "MAX_ROWS_PER_INSERT": "1000",
+                    },
+                    clear=False,
+                ):
+                    result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        self.assertEqual([rows for rows, _token in insert_calls], [1000, 1000, 500, 1000])
+        first_token = insert_calls[0][1]
+        self.assertEqual(
+            [token for _rows, token in insert_calls[:3]],
+            [first_token, first_token[:-2] + "-1", first_token[:-2] + "-2"],
+        )
+        self.assertTrue(first_token.endswith("-0"))
+        # msg-2 stops after its first slice fails, so only it is retried.
+        self.assertEqual(result["batchItemFailures"], [{"itemIdentifier": "msg-2"}])
+
+    def test_failed_slice_after_committed_slice_is_retried_not_bisected(self):
+        event = {"Records": [self._message("msg-1"), self._message("msg-2")]}
+        insert_calls = []
+
+        def reject_second_slice(_payload, row_count, **kwargs):
+            insert_calls.append((row_count, kwargs["insert_token"]))
+            if kwargs["insert_token"].endswith("-1"):
+                raise lambda_function.ClickHouseInsertError(400, "TYPE_MISMATCH")
+            return INSERT_RESULT
+
+        with mock.patch.object(
+            lambda_function,
+            "build_arrow_table_from_s3_objects",
+            side_effect=[self._table_with_rows(600), self._table_with_rows(600)],
+        ):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", side_effect=reject_second_slice):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "TARGET_ROWS_PER_INSERT": "1000",
+                        "MAX_ROWS_PER_INSERT": "1000",
+                        "BISECT_FAILED_SUB_BATCHES": "true",
+                    },
+                    clear=False,
+                ):
+                    result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        # Slice 0 committed, so bisecting would insert its rows again under new
+        # tokens; the whole sub-batch is retried under the same slice tokens instead.
+        self.assertEqual([rows for rows, _token in insert_calls], [1000, 200])
+        self.assertEqual(
+            result["batchItemFailures"], [{"itemIdentifier": "msg-1"}, {"itemIdentifier": "msg-2"}]
+        )
+
     def test_lambda_handler_flushes_multiple_sub_batches(self):
         event = {
             "Records": [self._message("msg-1"), self._message("msg-2"), self._message("msg-3")]
@@ -385,6 +1121,7 @@ class LambdaFunctionTests(TestCase):
 
         def capture_insert(_payload, row_count, **kwargs):
             insert_calls.append((row_count, kwargs))
+            return INSERT_RESULT
 
         with mock.patch.object(
             lambda_function,
@@ -429,7 +1166,7 @@ class LambdaFunctionTests(TestCase):
             with mock.patch.object(
                 lambda_function,
                 "insert_into_clickhouse",
-                side_effect=[None, RuntimeError("ClickHouse down")],
+                side_effect=[INSERT_RESULT, RuntimeError("ClickHouse down")],
             ):
                 with mock.patch.dict(
                     os.environ,
@@ -445,6 +1182,409 @@ class LambdaFunctionTests(TestCase):
 
         self.assertEqual(result["batchItemFailures"], [{"itemIdentifier": "msg-3"}])
 
+    def test_lambda_handler_emits_one_emf_record_set_per_invocation(self):
+        event = {
+            "Records": [self._message("msg-1"), self._message("msg-2"), self._message("msg-3")]
+        }
+
+        def table_with_event_types(types):
+            table = self._table_with_rows(len(types))
+            return table.append_column("event_type", lambda_function.pa.array(types))
+
+        stdout = io.StringIO()
+        with mock.patch.object(
+            lambda_function,
+            "build_arrow_table_from_s3_objects",
+            side_effect=[
+                table_with_event_types(["video", "part_attempt"]),
+                table_with_event_types(["video", "video"]),
+                table_with_event_types(["page_viewed", "video"]),
+            ],
+        ):
+            with mock.patch.object(
+                lambda_function,
+                "insert_into_clickhouse",
+                side_effect=[INSERT_RESULT, RuntimeError("ClickHouse down")],
+            ):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "TARGET_ROWS_PER_INSERT": "4",
+                        "MAX_ROWS_PER_INSERT": "6",
+                        "EMF_METRICS": "true",
+                        "EMF_NAMESPACE": "EtlTest",
+                        "EMF_DIMENSIONS": "FunctionName,EventType",
+                        "AWS_LAMBDA_FUNCTION_NAME": "xapi-etl",
+                    },
+                    clear=False,
+                ):
+                    with mock.patch("sys.stdout", stdout):
+                        result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        self.assertEqual(result["batchItemFailures"], [{"itemIdentifier": "msg-3"}])
+        documents = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(len(documents), 3)
+        summary = documents[0]
+        directive = summary["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(directive["Namespace"], "EtlTest")
+        self.assertEqual(directive["Dimensions"], [["FunctionName"]])
+        self.assertEqual(summary["FunctionName"], "xapi-etl")
+        self.assertEqual({metric["Name"] for metric in directive["Metrics"]}, set(summary) - {"_aws", "FunctionName"})
+        self.assertEqual(summary["MessagesReceived"], 3)
+        self.assertEqual(summary["RowsCommitted"], 4)
+        self.assertEqual(summary["RowsFailed"], 2)
+        self.assertEqual(summary["SubBatchesCommitted"], 1)
+        self.assertEqual(summary["SubBatchesFailed"], 1)
+        self.assertEqual(summary["MessagesFailed"], 1)
+        self.assertEqual((summary["Flushes_target_rows_reached"], summary["Flushes_end_of_invocation"]), (1, 1))
+        self.assertLessEqual(summary["MinRemainingTime"], 60000)
+        by_event_type = {
+            document["EventType"]: document["RowsCommitted"]
+            for document in documents[1:]
+            if document["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["FunctionName", "EventType"]]
+        }
+        self.assertEqual(by_event_type, {"video": 3, "part_attempt": 1})
+        self.assertIsNone(lambda_function._INVOCATION_METRICS)
+
+    def test_lambda_handler_emits_metrics_when_processing_raises(self):
+        event = {"Records": [self._message("msg-1")]}
+        stdout = io.StringIO()
+
+        with mock.patch.object(
+            lambda_function, "build_arrow_table_from_s3_objects", return_value=self._table_with_rows(2)
+        ):
+            with mock.patch.object(lambda_function, "determine_flush_reason", side_effect=RuntimeError("boom")):
+                with mock.patch.dict(
+                    os.environ,
+                    {"CLICKHOUSE_DATABASE": "db", "CLICKHOUSE_TABLE": "tbl", "EMF_METRICS": "true"},
+                    clear=False,
+                ):
+                    with mock.patch("sys.stdout", stdout):
+                        with self.assertRaisesRegex(RuntimeError, "boom"):
+                            lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        documents = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(documents[0]["MessagesReceived"], 1)
+        self.assertIsNone(lambda_function._INVOCATION_METRICS)
+
+    def test_lambda_handler_profiles_invocation_on_request(self):
+        event = {"profile": True, "Records": [self._message("msg-1")]}
+
+        def slow_object_load(_refs):
+            buffers = [bytearray(1024) for _ in range(2000)]
+            deadline = time.perf_counter() + 0.3
+            while time.perf_counter() < deadline:
+                sum(len(buffer) for buffer in buffers[:100])
+            return self._table_with_rows(2)
+
+        context = FakeContext(remaining_time_ms=60000)
+        context.aws_request_id = "req-1"
+        with mock.patch.object(lambda_function, "build_arrow_table_from_s3_objects", side_effect=slow_object_load):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "PROFILE_INTERVAL_MS": "5",
+                        "PROFILE_S3_URI": "s3://profiles/etl/",
+                    },
+                    clear=False,
+                ):
+                    with mock.patch.object(lambda_function, "log_stage") as log_stage:
+                        result = lambda_function.lambda_handler(event, context)
+
+        self.assertEqual(result["batchItemFailures"], [])
+        self.assertFalse(tracemalloc.is_tracing())
+        profiles = [call.kwargs for call in log_stage.call_args_list if call.args[0] == "invocation_profile"]
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]["request_id"], "req-1")
+        self.assertGreater(profiles[0]["sample_count"], 0)
+        self.assertTrue(1 <= len(profiles[0]["top_cumulative"]) <= 5)
+        self.assertGreater(profiles[0]["traced_peak_bytes"], 0)
+
+        put_kwargs = self.mock_s3.put_object.call_args.kwargs
+        self.assertEqual(put_kwargs["Bucket"], "profiles")
+        self.assertTrue(put_kwargs["Key"].startswith("etl/") and put_kwargs["Key"].endswith("/req-1.json"))
+        document = json.loads(put_kwargs["Body"])
+        self.assertIn("dependencies", document["runtime"])
+        profiled_functions = [entry["function"] for entry in document["profile"]["top_cumulative"]]
+        self.assertTrue(any(name.startswith("slow_object_load ") for name in profiled_functions))
+        self.assertTrue(any(name.startswith("lambda_handler ") for name in profiled_functions))
+        self.assertFalse(any(name.startswith("_bootstrap ") for name in profiled_functions))
+        self.assertTrue(document["profile"]["top_allocations"])
+
+    def test_lambda_handler_skips_profiling_by_default(self):
+        with mock.patch.object(lambda_function, "build_arrow_table_from_s3_objects", return_value=None):
+            with mock.patch.object(lambda_function, "SamplingProfiler") as profiler_class:
+                lambda_function.lambda_handler({"Records": [self._message("msg-1")]}, FakeContext(60000))
+
+        profiler_class.assert_not_called()
+
+    def test_lambda_handler_fetches_messages_concurrently_in_message_order(self):
+        event = {
+            "Records": [self._message("msg-1"), self._message("msg-2"), self._message("msg-3")]
+        }
+        lock = threading.Lock()
+        in_flight = {"current": 0, "peak": 0}
+        payloads = []
+
+        def slow_first_fetch(refs):
+            with lock:
+                in_flight["current"] += 1
+                in_flight["peak"] = max(in_flight["peak"], in_flight["current"])
+            message_id = refs[0].key.split("/")[-1].split(".")[0]
+            time.sleep(0.05 if message_id == "msg-1" else 0.01)
+            with lock:
+                in_flight["current"] -= 1
+            return lambda_function.pa.Table.from_pylist(
+                [{"event_hash": message_id, "source_line": 1}]
+            )
+
+        def capture_insert(payload, _row_count, **_kwargs):
+            payloads.append(payload)
+            return INSERT_RESULT
+
+        with mock.patch.object(
+            lambda_function,
+            "build_arrow_table_from_s3_objects",
+            side_effect=slow_first_fetch,
+        ):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", side_effect=capture_insert):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "S3_FETCH_CONCURRENCY": "3",
+                    },
+                    clear=False,
+                ):
+                    result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        self.assertEqual(result["batchItemFailures"], [])
+        self.assertGreater(in_flight["peak"], 1)
+        self.assertEqual(len(payloads), 1)
+        inserted = lambda_function.pq.read_table(lambda_function.pa.BufferReader(payloads[0]))
+        self.assertEqual(inserted.column("event_hash").to_pylist(), ["msg-1", "msg-2", "msg-3"])
+
+    def test_lambda_handler_prefetch_stops_at_max_messages_per_invocation(self):
+        event = {"Records": [self._message(f"msg-{index}") for index in range(1, 7)]}
+        fetched = []
+        lock = threading.Lock()
+
+        def fetch(refs):
+            with lock:
+                fetched.append(refs[0].key)
+            return self._table_with_rows(1)
+
+        with mock.patch.object(lambda_function, "build_arrow_table_from_s3_objects", side_effect=fetch):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "S3_FETCH_CONCURRENCY": "4",
+                        "MAX_MESSAGES_PER_INVOCATION_TO_PROCESS": "2",
+                    },
+                    clear=False,
+                ):
+                    result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        self.assertEqual(sorted(fetched), ["events/msg-1.jsonl", "events/msg-2.jsonl"])
+        self.assertEqual(
+            [failure["itemIdentifier"] for failure in result["batchItemFailures"]],
+            ["msg-3", "msg-4", "msg-5", "msg-6"],
+        )
+
+    def test_lambda_handler_releases_fetch_and_insert_threads_when_processing_raises(self):
+        event = {"Records": [self._message("msg-1"), self._message("msg-2")]}
+        created = {}
+        prefetcher_cls = lambda_function.MessagePrefetcher
+        pipeline_cls = lambda_function.InsertPipeline
+
+        def track(name, cls):
+            def build(*args, **kwargs):
+                created[name] = cls(*args, **kwargs)
+                return created[name]
+
+            return build
+
+        with mock.patch.object(lambda_function, "MessagePrefetcher", side_effect=track("prefetcher", prefetcher_cls)):
+            with mock.patch.object(lambda_function, "InsertPipeline", side_effect=track("pipeline", pipeline_cls)):
+                with mock.patch.object(
+                    lambda_function,
+                    "build_arrow_table_from_s3_objects",
+                    side_effect=lambda _refs: self._table_with_rows(1),
+                ):
+                    with mock.patch.object(
+                        lambda_function, "determine_flush_reason", side_effect=RuntimeError("boom")
+                    ):
+                        with mock.patch.dict(
+                            os.environ,
+                            {
+                                "CLICKHOUSE_DATABASE": "db",
+                                "CLICKHOUSE_TABLE": "tbl",
+                                "S3_FETCH_CONCURRENCY": "2",
+                                "MAX_INFLIGHT_INSERTS": "1",
+                            },
+                            clear=False,
+                        ):
+                            with self.assertRaisesRegex(RuntimeError, "boom"):
+                                lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        # pylint: disable=protected-access
+        self.assertTrue(created["prefetcher"]._executor._shutdown)
+        self.assertTrue(created["pipeline"]._executor._shutdown)
+
+    def test_lambda_handler_pipelines_insert_with_next_message_preparation(self):
+        event = {
+            "Records": [self._message("msg-1"), self._message("msg-2"), self._message("msg-3")]
+        }
+        second_message_fetched = threading.Event()
+        insert_calls = []
+        overlapped = []
+
+        def fetch(refs):
+            if refs[0].key.endswith("msg-2.jsonl"):
+                second_message_fetched.set()
+            return self._table_with_rows(2)
+
+        lock = threading.Lock()
+
+        def slow_insert(_payload, _row_count, **_kwargs):
+            with lock:
+                insert_calls.append(_row_count)
+                is_first_insert = len(insert_calls) == 1
+            # The first insert only finishes once the handler has moved on to msg-2.
+            if is_first_insert:
+                overlapped.append(second_message_fetched.wait(timeout=5))
+            return INSERT_RESULT
+
+        with mock.patch.object(lambda_function, "build_arrow_table_from_s3_objects", side_effect=fetch):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", side_effect=slow_insert):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "TARGET_ROWS_PER_INSERT": "2",
+                        "S3_FETCH_CONCURRENCY": "1",
+                        "MAX_INFLIGHT_INSERTS": "2",
+                    },
+                    clear=False,
+                ):
+                    result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        self.assertEqual(overlapped, [True])
+        self.assertEqual(len(insert_calls), 3)
+        self.assertEqual(result["batchItemFailures"], [])
+
+    def test_lambda_handler_pipelined_failure_leaves_later_messages_untouched(self):
+        event = {
+            "Records": [
+                self._message("msg-1"),
+                self._message("msg-2"),
+                self._message("msg-3"),
+                self._message("msg-4"),
+            ]
+        }
+        second_message_fetched = threading.Event()
+        calls = []
+
+        def fetch(refs):
+            if refs[0].key.endswith("msg-2.jsonl"):
+                second_message_fetched.set()
+            return self._table_with_rows(2)
+
+        def insert(_payload, _row_count, **_kwargs):
+            calls.append(_row_count)
+            if len(calls) == 1:
+                second_message_fetched.wait(timeout=5)
+                raise RuntimeError("ClickHouse down")
+            return INSERT_RESULT
+
+        with mock.patch.object(lambda_function, "build_arrow_table_from_s3_objects", side_effect=fetch):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", side_effect=insert):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "TARGET_ROWS_PER_INSERT": "2",
+                        "S3_FETCH_CONCURRENCY": "1",
+                        "MAX_INFLIGHT_INSERTS": "1",
+                    },
+                    clear=False,
+                ):
+                    result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+
+        # msg-2 was already in flight when the failure surfaced and commits on its
+        # own; msg-1 failed and msg-3/msg-4 were never inserted.
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            result["batchItemFailures"],
+            [{"itemIdentifier": "msg-1"}, {"itemIdentifier": "msg-3"}, {"itemIdentifier": "msg-4"}],
+        )
+
+    def test_lambda_handler_grows_adaptive_target_after_fast_inserts(self):
+        event = {"Records": [self._message(f"msg-{index}") for index in range(1, 6)]}
+        inserted_row_counts = []
+
+        def capture_insert(_payload, row_count, **_kwargs):
+            inserted_row_counts.append(row_count)
+            return INSERT_RESULT
+
+        with mock.patch.object(lambda_function, "_ADAPTIVE_BATCH_CONTROLLER", None):
+            with mock.patch.object(
+                lambda_function,
+                "build_arrow_table_from_s3_objects",
+                side_effect=lambda _refs: self._table_with_rows(2),
+            ):
+                with mock.patch.object(lambda_function, "insert_into_clickhouse", side_effect=capture_insert):
+                    with mock.patch.dict(
+                        os.environ,
+                        {
+                            "CLICKHOUSE_DATABASE": "db",
+                            "CLICKHOUSE_TABLE": "tbl",
+                            "ADAPTIVE_BATCH_SIZING": "true",
+                            "ADAPTIVE_TARGET_FLUSH_MS": "60000",
+                            "ADAPTIVE_MIN_ROWS_PER_INSERT": "1",
+                            "TARGET_ROWS_PER_INSERT": "2",
+                            "MAX_ROWS_PER_INSERT": "100",
+                        },
+                        clear=False,
+                    ):
+                        result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+                        controller = lambda_function.get_adaptive_batch_controller()
+
+        self.assertEqual(result["batchItemFailures"], [])
+        # The target doubles after each fast flush instead of jumping straight to the ceiling.
+        self.assertEqual(inserted_row_counts, [2, 4, 4])
+        self.assertEqual(controller.observations, 3)
+
+    def test_adaptive_batch_controller_clamps_and_backs_off(self):
+        controller = lambda_function.AdaptiveBatchController(initial_target_rows=10_000)
+
+        # 20k rows in 4s is 0.2 ms/row, so a 2s target wants 10k rows.
+        controller.observe(20_000, 4_000, target_ms=2_000, min_rows=1_000, max_rows=30_000)
+        self.assertEqual(controller.target_rows, 10_000)
+
+        # A very slow flush can only halve the target per observation.
+        controller.observe(10_000, 100_000, target_ms=2_000, min_rows=1_000, max_rows=30_000)
+        self.assertEqual(controller.target_rows, 5_000)
+
+        controller.record_failure(min_rows=1_000)
+        controller.record_failure(min_rows=1_000)
+        controller.record_failure(min_rows=1_000)
+        self.assertEqual(controller.target_rows, 1_000)
+        self.assertEqual(controller.current_target(2_000, 30_000), 2_000)
+        self.assertEqual(controller.log_fields()["adaptive_failures"], 3)
+
     def test_lambda_handler_emits_no_progress_and_returns_prepared_and_untouched_messages(self):
         event = {"Records": [self._message("msg-1"), self._message("msg-2")]}
         context = FakeContext(remaining_time_ms=2000)
@@ -458,7 +1598,7 @@ class LambdaFunctionTests(TestCase):
             "build_arrow_table_from_s3_objects",
             side_effect=prepare_then_exhaust_time,
         ):
-            with mock.patch.object(lambda_function, "insert_into_clickhouse") as insert_mock:
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT) as insert_mock:
                 with mock.patch.dict(
                     os.environ,
                     {
@@ -526,7 +1666,7 @@ class LambdaFunctionTests(TestCase):
             "build_arrow_table_from_s3_objects",
             return_value=self._table_with_rows(2),
         ):
-            with mock.patch.object(lambda_function, "insert_into_clickhouse") as insert_mock:
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT) as insert_mock:
                 with mock.patch.dict(
                     os.environ,
                     {
@@ -581,6 +1721,39 @@ class LambdaFunctionTests(TestCase):
         self.assertIn("runtime", payload)
         self.assertIn("pyarrow", payload["dependencies"])
 
+    def test_runtime_metadata_reports_module_init_timings(self):
+        timings = lambda_function.RUNTIME_METADATA["init_timings_ms"]
+        self.assertEqual(
+            list(timings)[:5],
+            ["import_boto3_requests", "import_pyarrow", "runtime_metadata", "s3_client", "module_definitions"],
+        )
+        self.assertTrue(all(value >= 0 for value in timings.values()))
+        self.assertGreaterEqual(lambda_function.RUNTIME_METADATA["init_total_ms"], sum(timings.values()) - 1)
+
+        result = lambda_function.lambda_handler({"diagnostics": True}, SimpleNamespace())
+        self.assertIn("init_timings_ms", json.loads(result["body"])["runtime"])
+
+    def test_prewarm_arrow_runs_parse_normalize_and_serialize(self):
+        with mock.patch.object(
+            lambda_function, "serialize_table", wraps=lambda_function.serialize_table
+        ) as serialize_mock:
+            lambda_function._prewarm_arrow()
+
+        table = serialize_mock.call_args.args[0]
+        self.assertEqual(table.num_rows, 1)
+        self.assertEqual(table.column("event_type").to_pylist(), ["part_attempt"])
+
+    def test_dlq_client_is_created_on_first_send(self):
+        record = {"messageId": "msg-1", "body": "{}"}
+        with mock.patch.object(lambda_function, "_FAILURE_DLQ_URL", "https://example.com/dlq"):
+            with mock.patch.object(lambda_function, "_sqs_client", None):
+                with mock.patch.object(lambda_function.boto3, "client") as client_factory:
+                    lambda_function.forward_failure_to_dlq(record, reason="first")
+                    lambda_function.forward_failure_to_dlq(record, reason="second")
+
+        client_factory.assert_called_once_with("sqs")
+        self.assertEqual(client_factory.return_value.send_message.call_count, 2)
+
     def test_transform_xapi_statement_maps_expected_fields(self):
         event = {
             "id": "d7f92ff8-4bde-4966-b1e3-f1be9a9098fa",
@@ -793,6 +1966,307 @@ class LambdaFunctionTests(TestCase):
                 for field_name, field_value in expected.items():
                     self.assertEqual(transformed[field_name], field_value)
 
+    def test_xapi_column_builder_matches_row_transform(self):
+        statements = [
+            {
+                "actor": {"account": {"name": "alice", "homePage": "https://proton.oli.cmu.edu"}},
+                "verb": {"id": "http://adlnet.gov/expapi/verbs/completed"},
+                "object": {"definition": {"type": "http://adlnet.gov/expapi/activities/question"}},
+                "context": {"extensions": {"http://oli.cmu.edu/extensions/section_id": "2161"}},
+                "result": {"score": {"raw": 1, "max": 2}, "response": {"input": "a"}},
+                "timestamp": "2025-05-21T13:41:06.123456789Z",
+            },
+            {"actor": {"mbox": "mailto:bob@example.edu"}, "timestamp": None},
+        ]
+        raw_lines = [json.dumps(statement).encode("utf-8") for statement in statements]
+
+        builder = lambda_function.XapiColumnBuilder(bucket="bucket", key="events/file.jsonl", etag='"etag"')
+        for line_number, (statement, raw_line) in enumerate(zip(statements, raw_lines), start=1):
+            builder.append(statement, raw_bytes=raw_line, line_number=line_number)
+        columnar = builder.finish()
+
+        rows = [
+            lambda_function.transform_xapi_statement(
+                statement,
+                raw_bytes=raw_line,
+                bucket="bucket",
+                key="events/file.jsonl",
+                etag='"etag"',
+                line_number=line_number,
+            )
+            for line_number, (statement, raw_line) in enumerate(zip(statements, raw_lines), start=1)
+        ]
+        expected = lambda_function.normalize_table_schema(lambda_function.pa.Table.from_pylist(rows))
+
+        self.assertEqual(columnar.column_names, lambda_function.DEFAULT_CLICKHOUSE_INSERT_COLUMNS)
+        self.assertTrue(columnar.schema.equals(expected.schema))
+        self.assertEqual(columnar.to_pylist(), expected.to_pylist())
+        self.assertEqual(builder.num_rows, 0)
+
+    def test_compute_event_hashes_defaults_to_sha256_hex(self):
+        lines = [b'{"a": 1}', b'{"b": 2}']
+
+        hashes = lambda_function.compute_event_hashes(lines)
+
+        self.assertEqual(hashes.type, lambda_function.pa.string())
+        self.assertEqual(hashes.to_pylist(), [hashlib.sha256(line).hexdigest() for line in lines])
+
+    def test_xapi_column_builder_uses_configured_binary_event_hash(self):
+        statement = {"actor": {"account": {"name": "alice"}}, "timestamp": "2025-05-21T13:41:06Z"}
+        raw_line = json.dumps(statement).encode("utf-8")
+        expected_digest = hashlib.blake2b(raw_line, digest_size=16).digest()
+
+        with mock.patch.dict(
+            os.environ, {"EVENT_HASH_MODE": "blake2b128", "EVENT_HASH_OUTPUT": "binary"}, clear=False
+        ):
+            builder = lambda_function.XapiColumnBuilder(bucket="bucket", key="events/file.jsonl", etag=None)
+            builder.append(statement, raw_bytes=raw_line, line_number=1)
+            table = lambda_function.normalize_table_schema(builder.finish())
+            row = lambda_function.transform_xapi_statement(
+                statement, raw_bytes=raw_line, bucket="bucket", key="events/file.jsonl", etag=None, line_number=1
+            )
+
+        self.assertEqual(table.schema.field("event_hash").type, lambda_function.pa.binary(16))
+        self.assertEqual(table.column("event_hash").to_pylist(), [expected_digest])
+        self.assertEqual(row["event_hash"], expected_digest)
+
+    def test_resolve_event_hash_spec_requires_xxhash_for_xxh3(self):
+        with mock.patch.object(lambda_function, "xxhash", None):
+            with mock.patch.dict(os.environ, {"EVENT_HASH_MODE": "xxh3_128"}, clear=False):
+                with self.assertRaises(RuntimeError):
+                    lambda_function.resolve_event_hash_spec()
+
+    def test_cold_start_fails_when_xxh3_is_configured_without_xxhash(self):
+        cold_spec = importlib.util.spec_from_file_location("lambda_function_cold_start", MODULE_PATH)
+        cold_module = importlib.util.module_from_spec(cold_spec)
+        # A None entry makes ``import xxhash`` raise ImportError even when it is installed.
+        with mock.patch.dict(sys.modules, {"xxhash": None, cold_spec.name: cold_module}):
+            with mock.patch.dict(os.environ, {"EVENT_HASH_MODE": "xxh3_128"}, clear=False):
+                with self.assertRaisesRegex(RuntimeError, "requires the xxhash package"):
+                    cold_spec.loader.exec_module(cold_module)  # type: ignore[union-attr]
+
+    def test_coerce_iso8601_timestamp_column_parses_in_bulk(self):
+        values = [
+            "2025-05-21T13:41:06Z",
+            " 2025-05-21T13:41:06.123456789Z ",
+            "2025-05-21T13:41:06.5+02:00",
+            "1960-01-01T00:00:00.1239-0130",
+            "2025-05-21 13:41:06",
+            None,
+        ]
+        column = lambda_function.pa.chunked_array([lambda_function.pa.array(values)])
+
+        with mock.patch.object(
+            lambda_function,
+            "_parse_iso8601_timestamp",
+            wraps=lambda_function._parse_iso8601_timestamp,
+        ) as parse_mock:
+            converted = lambda_function._coerce_iso8601_timestamp_column(column)
+
+        expected = lambda_function.pa.array(
+            [None if value is None else lambda_function._parse_iso8601_timestamp(value) for value in values],
+            type=lambda_function.pa.timestamp("ms", tz="UTC"),
+        )
+        self.assertTrue(converted.equals(expected))
+        self.assertEqual([call.args[0] for call in parse_mock.call_args_list], ["2025-05-21 13:41:06"])
+
+        with self.assertRaisesRegex(ValueError, "Invalid ISO-8601 timestamp"):
+            lambda_function._coerce_iso8601_timestamp_column(
+                lambda_function.pa.array(["2025-05-21T13:41:06Z", "2025-13-01T00:00:00Z"])
+            )
+
+    def test_insert_into_clickhouse_reuses_pooled_connection(self):
+        with FakeClickHouseServer() as server:
+            with mock.patch.object(lambda_function, "_CLICKHOUSE_SESSION", None):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_URL": server.url,
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                    },
+                    clear=False,
+                ):
+                    lambda_function.insert_into_clickhouse(b"first", 1, insert_token="token-1")
+                    lambda_function.insert_into_clickhouse(b"second", 1, insert_token="token-2")
+                    stats = lambda_function.clickhouse_connection_stats()
+
+        self.assertEqual([request["body"] for request in server.requests], [b"first", b"second"])
+        self.assertEqual(stats, {"connections_opened": 1, "requests_sent": 2, "connections_reused": 1})
+
+    def test_flush_current_batch_streams_parquet_row_groups(self):
+        table = self._table_with_rows(25)
+        batch = lambda_function.BatchAccumulator()
+        batch.add(lambda_function.PreparedMessage(message_id="m1", table=table, object_count=1))
+        context = SimpleNamespace(get_remaining_time_in_millis=lambda: 60_000)
+
+        with FakeClickHouseServer() as server:
+            with mock.patch.object(lambda_function, "_CLICKHOUSE_SESSION", None):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_URL": server.url,
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "CLICKHOUSE_STREAMING_INSERT": "true",
+                        "STREAMING_ROW_GROUP_ROWS": "10",
+                    },
+                    clear=False,
+                ):
+                    outcome = lambda_function.flush_current_batch(
+                        batch, context, dry_run_enabled=False, flush_reason="test"
+                    )
+
+        self.assertEqual(outcome.status, "committed")
+        self.assertEqual(len(server.requests), 1)
+        request = server.requests[0]
+        self.assertEqual(request["headers"].get("Transfer-Encoding"), "chunked")
+        parquet_file = lambda_function.pq.ParquetFile(lambda_function.pa.BufferReader(request["body"]))
+        self.assertEqual(parquet_file.num_row_groups, 3)
+        self.assertTrue(parquet_file.read().equals(table))
+
+    def test_retried_sub_batch_reuses_source_deduplication_token_and_payload(self):
+        def source_table(refs):
+            ref = refs[0]
+            return lambda_function.pa.table(
+                {
+                    "event_hash": [f"{ref.key}-{line}" for line in (1, 2)],
+                    "source_file": [f"s3://{ref.bucket}/{ref.key}"] * 2,
+                    "source_etag": ["etag-" + ref.key] * 2,
+                    "source_line": [1, 2],
+                }
+            )
+
+        first_delivery = {"Records": [self._message("msg-1"), self._message("msg-2")]}
+        # SQS redelivers the same objects under new message IDs and in another order.
+        redelivery = {"Records": [self._message("msg-2"), self._message("msg-1")]}
+        redelivery["Records"][0]["messageId"] = "retry-2"
+        redelivery["Records"][1]["messageId"] = "retry-1"
+
+        with FakeClickHouseServer() as server:
+            with mock.patch.object(lambda_function, "_CLICKHOUSE_SESSION", None):
+                with mock.patch.object(
+                    lambda_function, "build_arrow_table_from_s3_objects", side_effect=source_table
+                ):
+                    with mock.patch.dict(
+                        os.environ,
+                        {"CLICKHOUSE_URL": server.url, "CLICKHOUSE_DATABASE": "db", "CLICKHOUSE_TABLE": "tbl"},
+                        clear=False,
+                    ):
+                        for event in (first_delivery, redelivery):
+                            result = lambda_function.lambda_handler(event, FakeContext(remaining_time_ms=60000))
+                            self.assertEqual(result["batchItemFailures"], [])
+
+        first, retry = server.requests
+        token = first["params"]["insert_deduplication_token"]
+        self.assertEqual(retry["params"]["insert_deduplication_token"], token)
+        self.assertEqual(first["headers"]["X-Insert-Token"], token)
+        self.assertEqual(retry["body"], first["body"])
+
+        changed_etag = source_table([lambda_function.S3ObjectRef(bucket="bucket", key="events/msg-1.jsonl")])
+        changed_etag = changed_etag.set_column(2, "source_etag", lambda_function.pa.array(["other"] * 2))
+        self.assertNotEqual(
+            lambda_function.build_source_insert_token(
+                [changed_etag, source_table([lambda_function.S3ObjectRef(bucket="bucket", key="events/msg-2.jsonl")])]
+            ),
+            token,
+        )
+
+    def test_insert_into_clickhouse_sends_arrow_stream_when_configured(self):
+        table = self._table_with_rows(3)
+
+        with FakeClickHouseServer() as server:
+            server.response_headers["X-ClickHouse-Summary"] = '{"written_rows":"3","elapsed_ns":"1200"}'
+            with mock.patch.object(lambda_function, "_CLICKHOUSE_SESSION", None):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_URL": server.url,
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "CLICKHOUSE_INSERT_FORMAT": "arrowstream",
+                    },
+                    clear=False,
+                ):
+                    payload = lambda_function.serialize_table(table)
+                    result = lambda_function.insert_into_clickhouse(payload, table.num_rows)
+
+        request = server.requests[0]
+        self.assertTrue(request["params"]["query"].endswith("FORMAT ArrowStream"))
+        self.assertTrue(lambda_function.pa.ipc.open_stream(request["body"]).read_all().equals(table))
+        self.assertEqual(result.summary, {"written_rows": 3, "elapsed_ns": 1200})
+
+    def test_insert_into_clickhouse_compresses_body_when_configured(self):
+        payload = b"raw_events row " * 200_000
+        with FakeClickHouseServer() as server:
+            with mock.patch.object(lambda_function, "_CLICKHOUSE_SESSION", None):
+                with mock.patch.dict(
+                    os.environ,
+                    {
+                        "CLICKHOUSE_URL": server.url,
+                        "CLICKHOUSE_DATABASE": "db",
+                        "CLICKHOUSE_TABLE": "tbl",
+                        "CLICKHOUSE_HTTP_COMPRESSION": "zstd",
+                    },
+                    clear=False,
+                ):
+                    result = lambda_function.insert_into_clickhouse(payload, 1)
+
+        request = server.requests[0]
+        self.assertEqual(request["headers"].get("Content-Encoding"), "zstd")
+        self.assertEqual(request["headers"].get("Transfer-Encoding"), "chunked")
+        self.assertEqual(lambda_function.pa.decompress(request["body"], len(payload), codec="zstd"), payload)
+        self.assertEqual(result.wire_bytes, len(request["body"]))
+        self.assertLess(result.wire_bytes, len(payload))
+
+    def test_choose_http_compression_weighs_codec_cost_against_upload_speed(self):
+        compressible = b"verb_id=http://adlnet.gov/expapi/verbs/answered;" * 5000
+        incompressible = os.urandom(len(compressible))
+
+        with mock.patch.object(lambda_function, "_UPLOAD_BYTES_PER_SECOND", 1024 * 1024):
+            self.assertIn(lambda_function.choose_http_compression(compressible), ("lz4", "zstd"))
+        with mock.patch.object(lambda_function, "_UPLOAD_BYTES_PER_SECOND", 1e12):
+            self.assertEqual(lambda_function.choose_http_compression(incompressible), "none")
+
+    def test_resolve_insert_format_rejects_unknown_format(self):
+        with mock.patch.dict(os.environ, {"CLICKHOUSE_INSERT_FORMAT": "RowBinary"}, clear=False):
+            with self.assertRaises(ValueError):
+                lambda_function.resolve_insert_format()
+
+    def _compressible_events_table(self, row_count):
+        return lambda_function.pa.table(
+            {
+                "verb_id": ["http://adlnet.gov/expapi/verbs/answered"] * row_count,
+                "event_hash": [hashlib.sha256(str(index).encode()).hexdigest() for index in range(row_count)],
+                "source_line": list(range(row_count)),
+            }
+        )
+
+    def test_batch_accumulator_estimates_compressed_payload_after_calibration(self):
+        table = self._compressible_events_table(5000)
+        with mock.patch.object(lambda_function, "_PAYLOAD_SIZE_ESTIMATORS", {}):
+            batch = lambda_function.BatchAccumulator()
+            batch.add(lambda_function.PreparedMessage(message_id="m1", table=table, object_count=1))
+        actual_bytes = len(lambda_function.table_to_parquet(table))
+
+        self.assertLess(batch.estimated_bytes, table.nbytes * 0.7)
+        self.assertAlmostEqual(batch.estimated_bytes / actual_bytes, 1.0, delta=0.1)
+
+    def test_payload_size_estimator_learns_per_column_ratios_from_parquet_footer(self):
+        table = self._compressible_events_table(5000)
+        payload = lambda_function.table_to_parquet(table)
+        parquet_format = lambda_function.INSERT_FORMATS["parquet"]
+
+        with mock.patch.object(lambda_function, "_PAYLOAD_SIZE_ESTIMATORS", {}):
+            with mock.patch.dict(os.environ, {"PAYLOAD_ESTIMATOR_CALIBRATION_ROWS": "0"}, clear=False):
+                self.assertEqual(lambda_function.estimate_payload_bytes(table), table.nbytes)
+                lambda_function.observe_serialized_payload(parquet_format, table, len(payload), payload)
+                verb_only = table.select(["verb_id"])
+                estimate = lambda_function.estimate_payload_bytes(verb_only)
+
+        # The repeated verb column compresses far better than the table average.
+        self.assertLess(estimate, verb_only.nbytes * 0.05)
+
     def test_build_insert_query_uses_default_columns(self):
         with mock.patch.dict(
             os.environ,
@@ -811,6 +2285,22 @@ class LambdaFunctionTests(TestCase):
         self.assertNotIn("`attempt_guid`", query)
         self.assertTrue(query.endswith("FORMAT Parquet"))
 
+    def test_build_insert_query_rejects_override_with_mismatched_format(self):
+        override = "INSERT INTO db.raw_events_view FORMAT Parquet"
+        with mock.patch.dict(os.environ, {"CLICKHOUSE_INSERT_SQL": override}, clear=False):
+            self.assertEqual(lambda_function.build_insert_query(), override)
+            for insert_format, sql in (
+                ("ArrowStream", override),
+                ("Parquet", "INSERT INTO db.raw_events_view"),
+            ):
+                with self.subTest(insert_format=insert_format, sql=sql):
+                    with mock.patch.dict(
+                        os.environ,
+                        {"CLICKHOUSE_INSERT_FORMAT": insert_format, "CLICKHOUSE_INSERT_SQL": sql},
+                    ):
+                        with self.assertRaisesRegex(ValueError, f"FORMAT {insert_format}"):
+                            lambda_function.build_insert_query()
+
     def test_build_insert_query_respects_column_override(self):
         with mock.patch.dict(
             os.environ,
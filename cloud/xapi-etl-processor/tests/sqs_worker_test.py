@@ -0,0 +1,165 @@
+import importlib.util
+import json
+import os
+import signal
+import sys
+from pathlib import Path
+from unittest import SkipTest, TestCase, mock
+
+try:
+    import pytest
+except ModuleNotFoundError:  # pragma: no cover - local fallback when pytest is absent
+    class _PytestShim:
+        @staticmethod
+        def skip(message, allow_module_level=False):
+            raise SkipTest(message)
+
+    pytest = _PytestShim()
+
+try:
+    import pyarrow  # noqa: F401
+except ModuleNotFoundError:
+    pytest.skip("pyarrow is required for these tests; install it or run under Python 3.11", allow_module_level=True)
+
+MODULE_DIR = Path(__file__).resolve().parents[1]
+
+
+def _load(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, MODULE_DIR / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)  # type: ignore[misc]
+    return module
+
+
+lambda_function = _load("lambda_function")
+sqs_worker = _load("sqs_worker")
+# What a successful insert_into_clickhouse returns; mocks hand it back so the
+# committed-sub-batch log sees the same fields as in production.
+INSERT_RESULT = lambda_function.InsertResult(summary={}, content_encoding="none", wire_bytes=0, duration_seconds=0.0)
+
+
+class FakeSqs:
+    """In-memory queue with receive/visibility/delete semantics of the SQS API."""
+
+    def __init__(self, message_ids, on_empty=None):
+        self.visible = [
+            {
+                "MessageId": message_id,
+                "Body": json.dumps({"bucket": "bucket", "key": f"events/{message_id}.jsonl"}),
+            }
+            for message_id in message_ids
+        ]
+        self.in_flight = {}
+        self.deleted = []
+        self.receive_calls = []
+        self.on_empty = on_empty
+        self._receipts = 0
+
+    def receive_message(self, **kwargs):
+        self.receive_calls.append(kwargs)
+        received = []
+        while self.visible and len(received) < kwargs["MaxNumberOfMessages"]:
+            message = dict(self.visible.pop(0))
+            self._receipts += 1
+            message["ReceiptHandle"] = f"receipt-{self._receipts}"
+            self.in_flight[message["ReceiptHandle"]] = message
+            received.append(message)
+        if not received and self.on_empty is not None:
+            self.on_empty()
+        return {"Messages": received} if received else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):  # noqa: N803 - boto3 keyword names
+        successful = []
+        for entry in Entries:
+            message = self.in_flight.pop(entry["ReceiptHandle"])
+            self.deleted.append(message["MessageId"])
+            successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": []}
+
+
+class SqsWorkerTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(lambda_function, "s3_client")
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        env = mock.patch.dict(
+            os.environ,
+            {"CLICKHOUSE_DATABASE": "db", "CLICKHOUSE_TABLE": "tbl", "TARGET_ROWS_PER_INSERT": "100"},
+            clear=False,
+        )
+        self.addCleanup(env.stop)
+        env.start()
+
+    def _table_with_rows(self, row_count):
+        return lambda_function.pa.Table.from_pylist(
+            [{"event_hash": f"hash-{index}", "source_line": index + 1} for index in range(row_count)]
+        )
+
+    def _worker(self, sqs, **config):
+        drain = sqs_worker.DrainSignal()
+        if sqs.on_empty is None:
+            sqs.on_empty = lambda: drain.request(0)
+        worker_config = sqs_worker.WorkerConfig(queue_url="https://sqs.local/queue", wait_time_seconds=0, **config)
+        return sqs_worker.SqsWorker(worker_config, sqs, drain), drain
+
+    def test_worker_deletes_committed_messages_and_leaves_failures_in_flight(self):
+        sqs = FakeSqs(["msg-1", "msg-2", "msg-3"])
+        worker, _drain = self._worker(sqs)
+
+        with mock.patch.object(
+            lambda_function,
+            "build_arrow_table_from_s3_objects",
+            side_effect=[self._table_with_rows(2), ValueError("bad object"), self._table_with_rows(3)],
+        ):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", return_value=INSERT_RESULT) as insert_mock:
+                worker.run()
+
+        self.assertEqual(insert_mock.call_count, 1)
+        self.assertEqual(insert_mock.call_args.args[1], 5)
+        self.assertEqual(sorted(sqs.deleted), ["msg-1", "msg-3"])
+        self.assertEqual([message["MessageId"] for message in sqs.in_flight.values()], ["msg-2"])
+        self.assertEqual((worker.batches, worker.deleted_messages, worker.failed_messages), (1, 2, 1))
+
+    def test_worker_fills_batch_across_receives_within_window(self):
+        sqs = FakeSqs([f"msg-{index}" for index in range(12)])
+        worker, _drain = self._worker(sqs, batch_size=12, batch_window_seconds=30)
+
+        messages, deadline = worker.receive_batch()
+
+        self.assertEqual(len(messages), 12)
+        self.assertEqual([call["MaxNumberOfMessages"] for call in sqs.receive_calls], [10, 2])
+        self.assertEqual(sqs.receive_calls[0]["VisibilityTimeout"], 900)
+        context = sqs_worker.WorkerContext(deadline, sqs_worker.DrainSignal(), "worker")
+        self.assertGreater(context.get_remaining_time_in_millis(), 890_000)
+
+    def test_sigterm_drains_batch_in_progress_then_stops_polling(self):
+        sqs = FakeSqs(["msg-1", "msg-2"], on_empty=lambda: self.fail("worker polled after SIGTERM"))
+        worker, drain = self._worker(sqs)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        sqs_worker.install_drain_handlers(drain, drain_seconds=120)
+        remaining_during_insert = []
+
+        def insert_after_sigterm(_payload, _row_count, **_kwargs):
+            os.kill(os.getpid(), signal.SIGTERM)
+            remaining_during_insert.append(worker_context_remaining())
+            return INSERT_RESULT
+
+        def worker_context_remaining():
+            return sqs_worker.WorkerContext(float("inf"), drain, "worker").get_remaining_time_in_millis()
+
+        with mock.patch.object(
+            lambda_function,
+            "build_arrow_table_from_s3_objects",
+            side_effect=[self._table_with_rows(1), self._table_with_rows(1)],
+        ):
+            with mock.patch.object(lambda_function, "insert_into_clickhouse", side_effect=insert_after_sigterm):
+                worker.run()
+
+        self.assertTrue(drain.is_set())
+        self.assertEqual(len(sqs.receive_calls), 1)
+        self.assertEqual(sorted(sqs.deleted), ["msg-1", "msg-2"])
+        self.assertLessEqual(remaining_during_insert[0], 120_000)